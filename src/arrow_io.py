@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with arrays
+import numpy as np
+# To work with Apache Arrow tables and Parquet files (optional, only needed by the
+# functions of this module)
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Import required utility functions and constants from util module
+from util import *
+from vector_calc import after_tax_vec
+from tax_calculator import before_tax_vec
+
+##########################################################
+# Arrow versions of after_tax_combo and before_tax_combo. The input table is never
+# converted to pandas or copied: it is processed batch by batch, incomes and years are
+# read as zero-copy numpy views of the Arrow buffers and provinces as dictionary
+# encoded arrays (so grouping only compares small integer codes). The results are
+# appended to the table as a new column or written directly to a Parquet file.
+
+
+def arrow_combo(table, func, column, parquet_file=None):
+    '''
+    Applies an array function (like after_tax_vec) over the (income, province, year)
+    combos of an Arrow table.
+
+    Parameters
+    ----------
+    table: A pyarrow Table or RecordBatch whose first three columns are income,
+           province (abbreviation) and year. Name of columns are not important.
+    func: The function to apply on the incomes of every (province, year) group. It is
+          called as func(incs, prov, year) and must return an array.
+    column: Name of the column to add for the results.
+    parquet_file: If given, the resulting table is also written to this Parquet file.
+
+    Returns
+    -------
+    The same table (as a pyarrow Table) with the added column.
+    '''
+    if pa is None:
+        raise CustomException("pyarrow is required for the Arrow functions, install it \
+with: pip install pyarrow")
+
+    if isinstance(table, pa.RecordBatch):
+        table = pa.Table.from_batches([table])
+    if table.num_columns < 3:
+        raise CustomException("The table must have at least three columns in this \
+sequence: income, province, year.")
+
+    chunks = []
+    for batch in table.to_batches():
+        if batch.num_rows == 0:
+            continue
+        if batch.column(0).null_count > 0 or batch.column(1).null_count > 0 \
+           or batch.column(2).null_count > 0:
+            raise CustomException("No null is allowed in the income, province and year \
+columns.")
+
+            ### Zero-copy views of the incomes and years (the incomes are cast to float
+            ### once, not per group)
+        incs = batch.column(0).to_numpy(zero_copy_only=True).astype(float, copy=False)
+        years = batch.column(2).to_numpy(zero_copy_only=True)
+
+            ### Provinces as dictionary codes
+        provs = batch.column(1)
+        if not pa.types.is_dictionary(provs.type):
+            provs = pc.dictionary_encode(provs)
+        codes = provs.indices.to_numpy(zero_copy_only=True)
+        prov_names = provs.dictionary.to_pylist()
+
+            ### Group rows by (province code, year): one stable sort puts the rows of
+            ### every group together (in their order), so a group is a slice of it
+        keys, groups = np.unique(codes.astype(np.int64) * 10000 + years,
+                                 return_inverse=True)
+        order = np.argsort(groups, kind='stable')
+        ends = np.cumsum(np.bincount(groups, minlength=len(keys)))
+        derived_incs = np.empty(batch.num_rows)
+        for i, key in enumerate(keys):
+            inds = order[ends[i - 1] if i > 0 else 0:ends[i]]
+            prov = prov_names[key // 10000]
+            year = int(key % 10000)
+            derived_incs[inds] = func(incs[inds], prov, year)
+
+        chunks.append(pa.array(derived_incs))
+
+    results = pa.chunked_array(chunks, type=pa.float64())
+    table = table.append_column(column, results)
+
+    if parquet_file is not None:
+        pq.write_table(table, parquet_file)
+
+    return table
+
+
+def after_tax_combo_arrow(table, parquet_file=None):
+    '''
+    Calculates the after_tax values for given combos of (gross_income, province, year)
+    that are organized in an Arrow table.
+
+    Parameters:
+    ----------
+    table: A pyarrow Table or RecordBatch (see arrow_combo).
+    parquet_file: If given, the result is also written to this Parquet file.
+
+    Returns:
+    -------
+    The same table with an added column (after_tax).
+    '''
+    return arrow_combo(table, after_tax_vec, 'after_tax', parquet_file)
+
+
+def before_tax_combo_arrow(table, parquet_file=None):
+    '''
+    Calculates the before_tax values for given combos of (net_income, province, year)
+    that are organized in an Arrow table.
+
+    Parameters:
+    ----------
+    table: A pyarrow Table or RecordBatch (see arrow_combo).
+    parquet_file: If given, the result is also written to this Parquet file.
+
+    Returns:
+    -------
+    The same table with an added column (before_tax).
+    '''
+    return arrow_combo(table, before_tax_vec, 'before_tax', parquet_file)
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with arrays
+import numpy as np
+# To build the tables once when several threads ask for them
+import threading
+
+# Import required utility functions and constants from util module
+from util import *
+import vector_calc
+# The compiled cents kernel (if numba is installed)
+import kernels
+
+##########################################################
+# Integer cents mode of the net income chain. All amounts are int64 cents and all rates
+# are integers too (parts per million of the amount), so every step is done in integer
+# arithmetic and rounded to a cent with a defined rule. The results do not depend on
+# the platform, on float drift around thresholds or on how the input is chunked.
+# If numba is installed, after_tax_cents runs the same integer operations in one
+# compiled loop (see kernels.net_cents_numba), with identical results.
+# Rates are scaled to parts per million (5.95% -> 59500) and the CPP base contribution
+# ratio (see get_credit) to parts per billion.
+rate_scale = 10 ** 6
+cbc_scale = 10 ** 9
+roundings = ['half_even', 'half_up']
+
+# Cents schedules built in this process, keyed by (province, year)
+cents_schedules = {}
+cents_schedules_lock = threading.Lock()
+derived_caches.append(cents_schedules)
+
+
+def div_round(num, den, rounding='half_even', signed=True):
+    '''
+    Divides integers and rounds the result to the nearest integer.
+
+    Parameters
+    ----------
+    num: An integer array (or number).
+    den: A positive integer (or an array of them).
+    rounding: 'half_even' (banker's rounding) or 'half_up' (ties away from zero).
+    signed: If False, num is known to be >= 0 and the (slower) handling of negative
+            numbers is skipped.
+
+    Returns
+    -------
+    An int64 array.
+    '''
+    num = np.asarray(num, dtype=np.int64)
+    mag = np.abs(num) if signed else num
+        # Rounding half up is floor((2 * mag + den) / (2 * den)). Half even is the same
+        # but a tie only goes up if floor(mag / den) is odd:
+        # floor((2 * mag + den - 1 + odd) / (2 * den)).
+    twice = mag * 2
+    twice += den
+    if rounding == 'half_even':
+        twice -= 1
+        twice += (mag // den) & 1
+    twice //= 2 * den
+    return np.where(num < 0, -twice, twice) if signed else twice
+
+
+def to_cents(amounts):
+    '''
+    Converts dollar amounts (numbers or arrays) to int64 cents.
+    '''
+    return np.rint(np.asarray(amounts, dtype=float) * 100).astype(np.int64)
+
+
+def to_ppm(fractions):
+    '''
+    Converts rates given as fractions (0.0595) to int64 parts per million.
+    '''
+    return np.rint(np.asarray(fractions, dtype=float) * rate_scale).astype(np.int64)
+
+
+def make_cents_schedule(sched):
+    '''
+    Converts a schedule (see vector_calc.make_schedule) to integer cents and rates.
+
+    Parameters
+    ----------
+    sched: A schedule.
+
+    Returns
+    -------
+    csched: A read-only dictionary with the same keys as the schedule (and a few
+            derived ones) where amounts are in cents and rates in parts per million.
+    '''
+    if not sched['hard_coded']:
+        raise CustomException(f"The cents chain does not have all the rules of the plan of \
+{sched['province']} ({', '.join(sched['plan'])}).")
+    csched = {'province': sched['province']}
+    csched['cpp_rate'] = to_ppm(sched['cpp_rate'] / 100)
+    csched['cpp_be'] = to_cents(sched['cpp_be'])
+    csched['cpp_max'] = to_cents(sched['cpp_max'])
+    csched['cpp2'] = None
+    if sched['cpp2'] is not None:
+        csched['cpp2'] = (to_cents(sched['cpp2'][0]), to_cents(sched['cpp2'][1]),
+                          to_ppm(sched['cpp2'][2] / 100))
+    csched['ei_rate'] = to_ppm(sched['ei_rate'] / 100)
+    csched['ei_max'] = to_cents(sched['ei_max'])
+
+    for level in ['fed', 'prov']:
+        csched[level + '_thresh'] = to_cents(sched[level + '_thresh'])
+        csched[level + '_cumul'] = to_cents(sched[level + '_cumul'])
+        csched[level + '_rate'] = to_ppm(sched[level + '_rate'] / 100)
+        csched[level + '_credit_rate'] = to_ppm(sched[level + '_credit_rate'])
+        csched[level + '_cbc'] = np.int64(np.rint(sched[level + '_cbc'] * cbc_scale))
+
+            # The bpa reduction is (clip(gross_inc, low, high) - low) * num / den
+        full, low, high, slope = sched[level + '_bpa']
+        if slope == 0 or high == low:
+            csched[level + '_bpa'] = (to_cents(full), 0, 0, 0, 1)
+        else:
+            csched[level + '_bpa'] = (to_cents(full), to_cents(low), to_cents(high),
+                                      to_cents(slope * (high - low)), to_cents(high - low))
+
+    csched['fed_abatement'] = to_ppm(sched['fed_abatement'])
+    csched['employ_credit'] = to_cents(sched['employ_credit'])
+    csched['phase_out'] = None if sched['phase_out'] is None else to_cents(sched['phase_out'])
+    csched['surtax_thresh'] = to_cents(sched['surtax_thresh'])
+    csched['surtax_rate'] = to_ppm(sched['surtax_rate'])
+
+    csched['health_thresh'] = None
+    if sched['health_thresh'] is not None:
+        csched['health_thresh'] = to_cents(sched['health_thresh'])
+        csched['health_rate'] = to_ppm(np.nan_to_num(sched['health_rate']) / 100)
+            # No limit (NaN) becomes the largest int64
+        csched['health_limit'] = np.where(np.isnan(sched['health_limit']),
+                                          np.iinfo(np.int64).max,
+                                          to_cents(np.nan_to_num(sched['health_limit'])))
+
+    csched['qpip'] = None
+    if sched['qpip'] is not None:
+        csched['qpip'] = (to_cents(sched['qpip'][0]), to_ppm(sched['qpip'][1] / 100))
+
+    return vector_calc.freeze(csched)
+
+
+def load_cents_schedule(prov, year):
+    '''
+    Returns the cents schedule of a province for a year (it is built on the first call).
+    '''
+    key = (prov.upper(), year)
+    if key not in cents_schedules:
+        with cents_schedules_lock:
+            if key not in cents_schedules:
+                cents_schedules[key] = make_cents_schedule(vector_calc.load_schedule(prov, year))
+    return cents_schedules[key]
+
+
+def get_net_cents(gross_cents, csched, rounding='half_even'):
+    '''
+    The net income chain (see vector_calc.get_net_vec) in integer cents.
+
+    Parameters
+    ----------
+    gross_cents: An int64 array of gross incomes in cents.
+    csched: A cents schedule (see make_cents_schedule).
+    rounding: The rounding rule of every step (see div_round).
+
+    Returns
+    -------
+    result: A dictionary of int64 arrays (cents): CPP, EI, fed_tax, prov_tax and
+            net_income.
+    '''
+    def rate(amounts, rates, signed=False):
+        return div_round(amounts * rates, rate_scale, rounding, signed)
+
+    def bpa(level):
+        full, low, high, num, den = csched[level + '_bpa']
+        if num == 0:
+            return np.full(len(gross_cents), full)
+        return full - div_round((np.clip(gross_cents, low, high) - low) * num, den, rounding,
+                                False)
+
+    def bracket_tax(taxable, level):
+        thresh = csched[level + '_thresh']
+        inds = np.searchsorted(thresh[1:], taxable, side='left')
+        return csched[level + '_cumul'][inds] + \
+            rate(taxable - thresh[inds], csched[level + '_rate'][inds])
+
+    gross_cents = np.asarray(gross_cents, dtype=np.int64)
+
+        ### CPP (CPP2 included) and EI
+    cpp = np.minimum(rate(np.maximum(gross_cents - csched['cpp_be'], 0), csched['cpp_rate']),
+                     csched['cpp_max'])
+    if csched['cpp2'] is not None:
+        cpp_thresh1, cpp_thresh2, cpp2_rate = csched['cpp2']
+        cpp = cpp + rate(np.clip(gross_cents, cpp_thresh1, cpp_thresh2) - cpp_thresh1, cpp2_rate)
+    ei = np.minimum(rate(gross_cents, csched['ei_rate']), csched['ei_max'])
+
+    taxes = {}
+    for level in ['fed', 'prov']:
+        exempt = bpa(level)
+        cbc_cpp = div_round(cpp * csched[level + '_cbc'], cbc_scale, rounding, False)
+        taxable = np.where(gross_cents > cpp, gross_cents - (cpp - cbc_cpp), 0)
+        tax = bracket_tax(taxable, level)
+        credit = rate(ei + cbc_cpp + exempt, csched[level + '_credit_rate'])
+
+        if level == 'fed':
+            credit = credit + csched['employ_credit']
+            tax = np.where((tax > credit) & (taxable > exempt), tax - credit, 0)
+            taxes[level] = tax - rate(tax, csched['fed_abatement'])
+            continue
+
+        no_tax = taxable <= exempt
+        if csched['phase_out'] is not None:
+            no_tax |= taxable < csched['phase_out']
+
+        if len(csched['surtax_rate']) > 0:
+            surtax = np.zeros(len(tax), dtype=np.int64)
+            for thresh, surtax_rate in zip(csched['surtax_thresh'], csched['surtax_rate']):
+                surtax += rate(tax - thresh, surtax_rate, signed=True)
+            tax = tax + np.where(tax > csched['surtax_thresh'][0], surtax, 0)
+
+        if csched['health_thresh'] is not None:
+            inds = np.searchsorted(csched['health_thresh'], taxable, side='left')
+            prev = np.maximum(inds - 1, 0)
+            health_prem = csched['health_limit'][prev] + \
+                rate(taxable - csched['health_thresh'][prev], csched['health_rate'][inds])
+            health_prem = np.minimum(health_prem, csched['health_limit'][inds])
+            tax = tax + np.where(inds > 0, health_prem, 0)
+
+        if csched['qpip'] is not None:
+            qpip_max, qpip_rate = csched['qpip']
+            tax = tax + rate(np.minimum(gross_cents, qpip_max), qpip_rate)
+
+        tax = np.where(tax > credit, tax - credit, 0)
+        taxes[level] = np.where(no_tax, 0, tax)
+
+    net_income = gross_cents - taxes['fed'] - taxes['prov'] - cpp - ei
+
+    return {'CPP': cpp, 'EI': ei, 'fed_tax': taxes['fed'], 'prov_tax': taxes['prov'],
+            'net_income': net_income}
+
+
+def after_tax_cents(gross_incs, prov='ON', year=2023, rounding='half_even', cents=False):
+    '''
+    Calculates the after_tax incomes for an array of gross incomes in integer cents.
+
+    Parameters
+    ----------
+    gross_incs: An array of before_tax incomes in dollars (integer or float; floats are
+                first rounded to the cent).
+    prov: Province.
+    year: Tax year.
+    rounding: 'half_even' (banker's rounding) or 'half_up' (ties away from zero), used
+              at every step and for the final rounding to dollars.
+    cents: If True, net incomes are returned in cents instead of dollars.
+
+    Returns
+    -------
+    net_incs: An int64 array of after_tax incomes (0 for gross incomes <= 0).
+    '''
+    if rounding not in roundings:
+        raise CustomException(f"rounding must be one of {roundings}.")
+    gross_incs, prov, year = clinic(np.asarray(gross_incs), prov, year)
+
+    if np.issubdtype(gross_incs.dtype, np.integer):
+        gross_cents = gross_incs.astype(np.int64) * 100
+    else:
+        gross_cents = to_cents(gross_incs)
+
+    csched = load_cents_schedule(prov, year)
+    if kernels.numba is not None:
+        return kernels.net_cents_numba(gross_cents, csched, rounding, dollars=not cents)
+
+    net_cents = get_net_cents(gross_cents, csched, rounding)['net_income']
+    net_cents = np.where(gross_cents <= 0, 0, net_cents)
+
+    return net_cents if cents else div_round(net_cents, 100, rounding)
+
+
+def before_tax_cents(net_incs, prov='ON', year=2023, rounding='half_even', cents=False):
+    '''
+    Calculates the before_tax incomes for an array of net incomes (like
+    tax_calculator.before_tax_vec) as integers, rounded with a defined rule in one pass
+    over the array (not one income at a time like before_tax). The gross incomes of the
+    polynomials are not sums of cents, so they are rounded once, directly to the unit
+    of the result: with half_even the dollars are the ones of before_tax.
+
+    Parameters
+    ----------
+    net_incs: An array of after_tax incomes in dollars.
+    prov: Province.
+    year: Tax year.
+    rounding: 'half_even' (banker's rounding) or 'half_up' (ties away from zero).
+    cents: If True, gross incomes are returned in cents instead of dollars.
+
+    Returns
+    -------
+    gross_incs: An int64 array of before_tax incomes (0 for net incomes <= 0).
+    '''
+        # tax_calculator uses vector_calc (that this module uses), so it is imported here
+    from tax_calculator import before_tax_vec
+    if rounding not in roundings:
+        raise CustomException(f"rounding must be one of {roundings}.")
+
+    gross_incs = before_tax_vec(np.asarray(net_incs), prov, year, rounded=False)
+    if cents:
+        gross_incs = gross_incs * 100
+        # Gross incomes are >= 0, so half up is floor(x + 0.5)
+    gross_incs = np.rint(gross_incs) if rounding == 'half_even' else np.floor(gross_incs + 0.5)
+    return gross_incs.astype(np.int64)
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To read the command line arguments
+import argparse
+# To talk to the daemon over a local (Unix) socket
+import socket
+import socketserver
+# To send the requests and results as text
+import json
+import io
+# To work with files and the standard streams
+import os
+import sys
+import tempfile
+import contextlib
+
+##########################################################
+# Command line tool to convert incomes from files or stdin, like:
+#     python cli.py after_tax --prov ON --year 2023 < gross.csv > net.csv
+#     python cli.py before_tax_combo combos.csv
+# The first calls of a process are slow (importing pandas and matplotlib, reading the
+# tax rate files and compiling the schedules), so the tool can also be started once as
+# a daemon (python cli.py --daemon) that keeps all of that loaded and serves the later
+# calls over a Unix socket. A call uses the daemon when it is running and does the work
+# itself otherwise. The calculator modules are only imported where the work is done, so
+# a call served by the daemon only imports the standard library. The daemon reads the
+# tables of a year again when its files have changed (checked at every call), or all of
+# them on python cli.py --reload. All modes write the results as rounded integers.
+
+
+def default_socket():
+    '''
+    Returns the default socket of the daemon: in the runtime folder of the user
+    ($XDG_RUNTIME_DIR) or, if there is none, in a folder of the user in the temporary
+    folder (never directly in a folder every user can write to, like /tmp).
+    '''
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if not runtime_dir:
+        runtime_dir = os.path.join(tempfile.gettempdir(), f'income_calculator-{os.getuid()}')
+    return os.path.join(runtime_dir, 'income_calculator.sock')
+
+
+# The socket the daemon listens on (can be changed with --socket)
+socket_file = default_socket()
+
+# The data paths of the calculator are relative to the src folder
+src_dir = os.path.dirname(os.path.abspath(__file__))
+
+modes = ['after_tax', 'before_tax', 'after_tax_combo', 'before_tax_combo']
+
+# The fingerprint of the files the tables of every year were read from by the daemon
+# (see refresh_changed)
+loaded_fingerprints = {}
+
+
+def read_incomes(text):
+    '''
+    Reads a column of incomes (one per line, or the first column of a csv file, with or
+    without a header).
+
+    Parameters
+    ----------
+    text: The content of the file.
+
+    Returns
+    -------
+    df: A dataframe of the input (with a header).
+    incs: An array of the incomes.
+    '''
+    import pandas as pd
+
+    df = pd.read_csv(io.StringIO(text), header=None)
+    if len(df) > 0 and pd.isna(pd.to_numeric(df.iloc[0, 0], errors='coerce')):
+        df = pd.read_csv(io.StringIO(text))
+    else:
+        df.columns = ['income'] + [f'column_{i}' for i in range(1, len(df.columns))]
+    incs = pd.to_numeric(df.iloc[:, 0], errors='coerce').to_numpy(dtype=float)
+    return df, incs
+
+
+def convert(request):
+    '''
+    Does the conversion asked by a request (of the command line or of the daemon).
+
+    Parameters
+    ----------
+    request: A dictionary: mode (one of modes), prov and year (not used by the combo
+             modes) and data (the content of the input file).
+
+    Returns
+    -------
+    A dictionary: output (the resulting csv) and summary (number of rows per error code,
+    only for the combo modes).
+    '''
+    import pandas as pd
+    import numpy as np
+    from util import CustomException
+    from tax_calculator import after_tax_combo_bulk, before_tax_combo_bulk, before_tax_vec
+    from vector_calc import after_tax_vec
+
+    mode = request['mode']
+    if mode not in modes:
+        raise CustomException(f"mode must be one of {modes}.")
+
+        # The calculator prints its messages, they must not end up in the output
+    with contextlib.redirect_stdout(sys.stderr):
+        if mode.endswith('_combo'):
+            df = pd.read_csv(io.StringIO(request['data']))
+            func = after_tax_combo_bulk if mode == 'after_tax_combo' else before_tax_combo_bulk
+            df, summary = func(df)
+                # The rows with errors have no result
+            column = mode[:-len('_combo')]
+            df[column] = df[column].round().astype('Int64')
+        else:
+            df, incs = read_incomes(request['data'])
+            if mode == 'after_tax':
+                results = after_tax_vec(incs, request['prov'], request['year'])
+            else:
+                results = before_tax_vec(incs, request['prov'], request['year'])
+            df[mode] = np.round(results).astype('int64')
+            summary = None
+
+    return {'output': df.to_csv(index=False), 'summary': summary}
+
+
+def refresh_changed(years):
+    '''
+    Reads the tables (and polynomials) of the years whose files have changed since the
+    daemon read them, so a call is never served from old rates.
+
+    Parameters
+    ----------
+    years: The years to check.
+
+    Returns
+    -------
+    The years that were read again.
+    '''
+    from util import read_tables, year_polys
+    from result_cache import data_fingerprint
+
+    refreshed = []
+    for year in years:
+            # The polynomials are part of the fingerprint of before_tax
+        fingerprint = data_fingerprint('before_tax', year)
+        if loaded_fingerprints.get(year) != fingerprint:
+            read_tables(year, refresh=True)
+            year_polys.pop(year, None)
+            loaded_fingerprints[year] = fingerprint
+            refreshed.append(year)
+    return refreshed
+
+
+def reload():
+    '''
+    Reads the tables (and polynomials) of all years again and loads their schedules
+    (python cli.py --reload, like after the files of a year are replaced).
+    '''
+    loaded_fingerprints.clear()
+    warm_up()
+
+
+def warm_up():
+    '''
+    Reads the tables and loads the schedules (and segment tables, if that backend is
+    used) of all provinces and years, so the first calls to the daemon are as fast as
+    the next ones.
+    '''
+    from util import provinces, available_years
+    import vector_calc
+    import segments
+
+        # All the tables are read first, as reading the tables of a year empties the
+        # schedules of all years
+    years = []
+    for year in available_years():
+        try:
+            refresh_changed([year])
+            years.append(year)
+        except Exception as e:
+            print(f"The tables of {year} could not be read: {e}", file=sys.stderr)
+    for year in years:
+        for prov in provinces:
+            try:
+                vector_calc.load_schedule(prov, year)
+                if vector_calc.backend == 'segments':
+                    segments.load_segments(prov, year)
+            except Exception as e:
+                print(f"The tables of {prov} for {year} could not be loaded: {e}",
+                      file=sys.stderr)
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    '''
+    Serves one call: reads the request (a json object) until the client closes its
+    side and writes back the result (a json object).
+    '''
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.read().decode())
+            if request.get('mode') in ['stop', 'ping', 'reload']:
+                if request['mode'] == 'reload':
+                    reload()
+                response = {'output': '', 'summary': None}
+                self.server.stopping = request['mode'] == 'stop'
+            else:
+                    # The combo modes may ask for any year
+                from util import available_years
+                years = available_years() if request.get('mode', '').endswith('_combo') \
+                        else [request.get('year')]
+                refresh_changed([year for year in years if year in available_years()])
+                response = convert(request)
+        except Exception as e:
+            response = {'error': f"{type(e).__name__}: {e}"}
+        self.wfile.write(json.dumps(response).encode())
+
+
+def private_dir(path):
+    '''
+    Makes the folder of the socket (only accessible by the user) if it does not exist,
+    and checks that no other user can put a socket in it.
+
+    Returns
+    -------
+    None if the folder is safe, otherwise the reason it is not.
+    '''
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.stat(path)
+    if info.st_uid != os.getuid():
+        return f"{path} belongs to another user."
+    if info.st_mode & 0o022:
+        return f"{path} can be written to by other users, use a private folder."
+    return None
+
+
+def serve(socket_path=None, replace=False):
+    '''
+    Runs the daemon until it is stopped (python cli.py --stop or Ctrl+C). Calls are
+    served one by one.
+
+    Parameters
+    ----------
+    socket_path: The socket to listen on (socket_file by default).
+    replace: If True, a daemon already listening on the socket is stopped, otherwise
+             this one does not start.
+
+    Returns
+    -------
+    The exit status (0, or 1 if the daemon could not start).
+    '''
+    socket_path = os.path.abspath(socket_file if socket_path is None else socket_path)
+    problem = private_dir(os.path.dirname(socket_path))
+    if problem is not None:
+        print(f"The daemon can not listen on {socket_path}: {problem}", file=sys.stderr)
+        return 1
+
+    if os.path.exists(socket_path):
+        if not replace and call_daemon({'mode': 'ping'}, socket_path) is not None:
+            print(f"A daemon is already listening on {socket_path} (use --replace to \
+replace it).", file=sys.stderr)
+            return 1
+        if replace and call_daemon({'mode': 'stop'}, socket_path) is not None:
+            print(f"Stopped the daemon that was listening on {socket_path}.",
+                  file=sys.stderr)
+            # A socket file left by a daemon that did not stop cleanly
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+    os.chdir(src_dir)
+    warm_up()
+
+    with socketserver.UnixStreamServer(socket_path, DaemonHandler) as server:
+        os.chmod(socket_path, 0o600)
+        inode = os.stat(socket_path).st_ino
+        server.stopping = False
+        print(f"Listening on {socket_path}", file=sys.stderr)
+        try:
+            while not server.stopping:
+                server.handle_request()
+        except KeyboardInterrupt:
+            pass
+        # Only remove the socket if it is still this one (not the one of a daemon that
+        # replaced this one)
+    if os.path.exists(socket_path) and os.stat(socket_path).st_ino == inode:
+        os.remove(socket_path)
+    return 0
+
+
+def call_daemon(request, socket_path=None):
+    '''
+    Sends a request to the daemon.
+
+    Parameters
+    ----------
+    request: See convert.
+    socket_path: The socket of the daemon (socket_file by default).
+
+    Returns
+    -------
+    The response of the daemon (see convert), or None if no daemon is listening.
+    '''
+    socket_path = socket_file if socket_path is None else socket_path
+    if not os.path.exists(socket_path):
+        return None
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            return None
+        sock.sendall(json.dumps(request).encode())
+        sock.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = sock.recv(1 << 20)
+            if not chunk:
+                break
+            chunks.append(chunk)
+
+    return json.loads(b''.join(chunks).decode())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert gross incomes to net incomes "
+                                     "and vice-versa for the provinces of Canada.")
+    parser.add_argument('mode', nargs='?', choices=modes,
+                        help="after_tax (gross to net) and before_tax (net to gross) read "
+                        "one income per line (or the first column of a csv file), the "
+                        "combo modes read a csv file of income, province and year.")
+    parser.add_argument('input', nargs='?', default='-',
+                        help="Input file (stdin by default).")
+    parser.add_argument('-o', '--output', default='-', help="Output file (stdout by default).")
+    parser.add_argument('--prov', default='ON', help="Province (default ON).")
+    parser.add_argument('--year', type=int, default=2023, help="Tax year (default 2023).")
+    parser.add_argument('--daemon', action='store_true',
+                        help="Start the daemon that serves the later calls.")
+    parser.add_argument('--replace', action='store_true',
+                        help="With --daemon, stop the daemon that is already running.")
+    parser.add_argument('--stop', action='store_true', help="Stop the running daemon.")
+    parser.add_argument('--reload', action='store_true',
+                        help="Make the running daemon read the tax rate files again.")
+    parser.add_argument('--local', action='store_true',
+                        help="Do the work in this process even if the daemon is running.")
+    parser.add_argument('--socket', default=socket_file, help="Socket of the daemon.")
+    args = parser.parse_intermixed_args(argv)
+
+    if args.daemon:
+        return serve(args.socket, args.replace)
+    if args.stop or args.reload:
+        if call_daemon({'mode': 'stop' if args.stop else 'reload'}, args.socket) is None:
+            print("No daemon is running.", file=sys.stderr)
+            return 1
+        return 0
+    if args.mode is None:
+        parser.error("mode is required (unless --daemon, --stop or --reload is used).")
+
+    if args.input == '-':
+        data = sys.stdin.read()
+    else:
+        with open(args.input) as f:
+            data = f.read()
+    request = {'mode': args.mode, 'prov': args.prov, 'year': args.year, 'data': data}
+
+    output = args.output if args.output == '-' else os.path.abspath(args.output)
+    response = None if args.local else call_daemon(request, args.socket)
+    if response is None:
+        os.chdir(src_dir)
+        try:
+            response = convert(request)
+        except Exception as e:
+            response = {'error': f"{type(e).__name__}: {e}"}
+
+    if 'error' in response:
+        print(response['error'], file=sys.stderr)
+        return 1
+    if response['summary']:
+        errors = {err: count for err, count in response['summary'].items() if err != 'ok'}
+        if len(errors) > 0:
+            print(f"Rows with errors: {errors}", file=sys.stderr)
+
+    if output == '-':
+        sys.stdout.write(response['output'])
+    else:
+        with open(output, 'w') as f:
+            f.write(response['output'])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
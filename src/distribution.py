@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with arrays
+import numpy as np
+# To build the tables once when several threads ask for them
+import threading
+
+# Import required utility functions and constants from util module
+from util import *
+import segments
+import vector_calc
+
+##########################################################
+# After_tax distributions of income histograms. A histogram of gross incomes (bin edges
+# and the number of people in every bin) is transformed without expanding it to
+# individual incomes: the incomes of a bin are taken as evenly spread over it, and the
+# net income (and every component of it) is linear between its kinks (see segments),
+# so the totals of a bin are exact integrals of the segment tables, and the part of a
+# bin that lies on one segment is mapped to an even spread of net incomes. The cost
+# only depends on the number of bins and segments, not on the number of people.
+
+# The columns the totals are given for (see vector_calc.get_net_vec)
+components = ['CPP', 'EI', 'fed_tax', 'prov_tax', 'net_income']
+
+# Component tables built in this process, keyed by (province, year), with the band and
+# stacked tables (see load_bands and load_stack). The lock is reentrant, as stacked tables
+# are built from component tables.
+component_tables = {}
+component_tables_lock = threading.RLock()
+derived_caches.append(component_tables)
+
+
+def check_histogram(edges, counts):
+    '''
+    Checks a histogram of gross incomes and returns it as float arrays.
+    '''
+    edges = np.asarray(edges, dtype=float)
+    counts = np.asarray(counts, dtype=float)
+    if edges.ndim != 1 or len(edges) < 2 or np.isnan(edges).any() or \
+       (np.diff(edges) <= 0).any() or edges[0] < 0:
+        raise CustomException("The bin edges must be an increasing array of at least two \
+non negative incomes.")
+    if counts.shape != (len(edges) - 1,) or np.isnan(counts).any() or (counts < 0).any():
+        raise CustomException("There must be one non negative count per bin (one less \
+than the edges).")
+    return edges, counts
+
+
+def build_components(prov, year):
+    '''
+    Puts the segment tables of all the components of a province together on the same
+    breaks (all the breaks of all of them), so that the totals of all the components
+    are calculated with one lookup.
+
+    Returns
+    -------
+    table: A read-only dictionary: breaks, and slope, intercept and cumul (the integral
+           from 0 to every break) with one row per component (see components), and
+           coeffs (the coefficients of the integral on every segment).
+    '''
+    tables = [segments.load_segments(prov, year, column) for column in components]
+    breaks = np.unique(np.concatenate([table['breaks'] for table in tables]))
+    slope, intercept = [], []
+    for table in tables:
+        inds = np.maximum(np.searchsorted(table['breaks'], breaks, side='right') - 1, 0)
+        slope.append(table['slope'][inds])
+        intercept.append(table['intercept'][inds])
+    slope, intercept = np.array(slope), np.array(intercept)
+
+    whole = slope[:, :-1] * (breaks[1:] ** 2 - breaks[:-1] ** 2) / 2 + \
+        intercept[:, :-1] * np.diff(breaks)
+    cumul = np.concatenate((np.zeros((len(tables), 1)), np.cumsum(whole, axis=1)), axis=1)
+
+        # On a segment, the integral from 0 is a + b * x + c * x ** 2. The coefficients
+        # of all the components of a segment are stored in one row.
+    a = cumul - slope * breaks ** 2 / 2 - intercept * breaks
+    coeffs = np.concatenate((a.T, intercept.T, slope.T / 2), axis=1)
+    return vector_calc.freeze({'breaks': breaks, 'slope': slope, 'intercept': intercept,
+                               'cumul': cumul, 'coeffs': np.ascontiguousarray(coeffs)})
+
+
+def load_components(prov, year):
+    '''
+    Returns the component table of a province for a year (it is built on the first
+    call, see build_components).
+    '''
+    key = (prov.upper(), year)
+    if key not in component_tables:
+        with component_tables_lock:
+            if key not in component_tables:
+                component_tables[key] = build_components(prov, year)
+    return component_tables[key]
+
+
+def build_stack(provs, year, column=None):
+    '''
+    Puts the tables of several provinces one after the other, so that a histogram is
+    transformed for all of them at once.
+
+    Parameters
+    ----------
+    provs: A tuple of provinces.
+    year: Tax year.
+    column: A column (see segments.load_segments), or None for the component tables
+            (see build_components).
+
+    Returns
+    -------
+    table: A read-only dictionary: lows and highs (the gross incomes where every segment
+           starts and ends, inf for the last one of a province), prov (the index in provs
+           of the province of every segment), slope and intercept (with one row per
+           component for the component tables) and starts (the first segment of every
+           province).
+    '''
+    if column is None:
+        tables = [load_components(prov, year) for prov in provs]
+    else:
+        tables = [segments.load_segments(prov, year, column) for prov in provs]
+    sizes = [len(table['breaks']) for table in tables]
+    return vector_calc.freeze({
+        'lows': np.concatenate([table['breaks'] for table in tables]),
+        'highs': np.concatenate([np.append(table['breaks'][1:], np.inf) for table in tables]),
+        'prov': np.repeat(np.arange(len(tables)), sizes),
+        'slope': np.concatenate([table['slope'] for table in tables], axis=-1),
+        'intercept': np.concatenate([table['intercept'] for table in tables], axis=-1),
+        'starts': np.cumsum([0] + sizes[:-1])})
+
+
+def load_stack(provs, year, column=None):
+    '''
+    Returns the stacked tables of provinces for a year (they are built on the first
+    call, see build_stack).
+    '''
+    key = (tuple(provs), year, column)
+    if key not in component_tables:
+        with component_tables_lock:
+            if key not in component_tables:
+                component_tables[key] = build_stack(provs, year, column)
+    return component_tables[key]
+
+
+def histogram_moments(edges, counts, x):
+    '''
+    Calculates the number of people of a histogram below incomes x and the total of
+    their incomes (the people of a bin are evenly spread over it).
+
+    Returns
+    -------
+    below: The counts.
+    moment: The totals of the incomes.
+    '''
+    density = counts / np.diff(edges)
+    cum_counts = np.concatenate(([0.], np.cumsum(counts)))
+    cum_moments = np.concatenate(([0.], np.cumsum(counts * (edges[:-1] + edges[1:]) / 2)))
+    x = np.clip(x, edges[0], edges[-1])
+    bins = np.minimum(np.searchsorted(edges, x, side='right') - 1, len(counts) - 1)
+    below = cum_counts[bins] + density[bins] * (x - edges[bins])
+    moment = cum_moments[bins] + density[bins] * (x ** 2 - edges[bins] ** 2) / 2
+    return below, moment
+
+
+def bin_totals(edges, counts, table):
+    '''
+    Calculates the exact totals of the components over the people of a histogram, per
+    bin.
+
+    Parameters
+    ----------
+    edges, counts: A histogram of gross incomes (see histogram_transform).
+    table: A component table (see build_components).
+
+    Returns
+    -------
+    An array of totals with one row per component and one column per bin.
+    '''
+    n = len(components)
+    inds = np.maximum(np.searchsorted(table['breaks'], edges, side='right') - 1, 0)
+    coeffs = table['coeffs'][inds]
+    x = edges[:, None]
+    integrals = coeffs[:, :n] + x * (coeffs[:, n:2 * n] + x * coeffs[:, 2 * n:])
+    return ((counts / np.diff(edges))[:, None] * np.diff(integrals, axis=0)).T
+
+
+def stack_totals(edges, counts, stack):
+    '''
+    Calculates the exact totals of the components over the people of a histogram for
+    stacked provinces. Every component is linear on a segment, so its total there only
+    depends on the number of people of the segment and the total of their incomes.
+
+    Returns
+    -------
+    An array of totals with one row per component and one column per province.
+    '''
+    below_low, moment_low = histogram_moments(edges, counts, stack['lows'])
+    below_high, moment_high = histogram_moments(edges, counts, stack['highs'])
+    parts = stack['slope'] * (moment_high - moment_low) + \
+        stack['intercept'] * (below_high - below_low)
+    return np.add.reduceat(parts, stack['starts'], axis=1)
+
+
+def stack_histograms(edges, counts, stack, new_edges):
+    '''
+    Calculates the histograms of a column (like the net income) of the people of a
+    histogram of gross incomes for stacked provinces.
+
+    Parameters
+    ----------
+    edges, counts: A histogram of gross incomes (see histogram_transform).
+    stack: The stacked segment tables of the column (see build_stack).
+    new_edges: The bin edges of the resulting histograms (increasing).
+
+    Returns
+    -------
+    An array of counts with one row per province and one column per new bin. People
+    whose value is out of the new edges are not counted.
+    '''
+    new_edges = np.asarray(new_edges, dtype=float)
+    n_provs, n_edges = len(stack['starts']), len(new_edges)
+    slope, intercept = stack['slope'], stack['intercept']
+    cum_counts = np.concatenate(([0.], np.cumsum(counts)))
+
+        ### The part of every segment that is in the histogram, its values there and the
+        ### number of people below its ends (the histogram is linear on a bin)
+    lows = np.clip(stack['lows'], edges[0], edges[-1])
+    highs = np.clip(stack['highs'], edges[0], edges[-1])
+    below_low = np.interp(lows, edges, cum_counts)
+    below_high = np.interp(highs, edges, cum_counts)
+    values_low, values_high = slope * lows + intercept, slope * highs + intercept
+    bottoms = np.minimum(values_low, values_high)
+    tops = np.maximum(values_low, values_high)
+    flat = tops - bottoms <= 1e-9
+
+        ### The new edges from first to last (excluded) of a segment are between its
+        ### bottom and top values. For such a new edge v, the people of the segment below
+        ### v are the ones on one side of the gross income x where the segment is v:
+        ###     below(x) - below_low (increasing segment), below_high - below(x) (else)
+        ### The constant parts (and, from last on, all its people; for a flat segment,
+        ### from the first new edge above its value) are added to the new edges at once,
+        ### as the steps of a cumulative sum. The counts are the differences of the
+        ### numbers below the new edges, so the steps are counts as they are.
+    first = np.searchsorted(new_edges, bottoms, side='right')
+    last = np.where(flat, first, np.searchsorted(new_edges, tops, side='left'))
+    increasing = slope > 0
+    constant = np.where(increasing, -below_low, below_high)
+    rows = stack['prov'] * (n_edges + 1)
+    steps = np.bincount(np.concatenate((rows + first, rows + last)),
+                        weights=np.concatenate((constant, below_high - below_low - constant)),
+                        minlength=n_provs * (n_edges + 1)).reshape(n_provs, n_edges + 1)
+
+    sizes = last - first
+    starts = np.cumsum(sizes) - sizes
+    inds = np.arange(starts[-1] + sizes[-1]) + np.repeat(first - starts, sizes)
+    with np.errstate(divide='ignore'):
+        inverse = np.where(flat, 0., 1 / slope)
+    x = (new_edges[inds] - np.repeat(intercept, sizes)) * np.repeat(inverse, sizes)
+    below_x = np.interp(x, edges, cum_counts) * np.repeat(np.where(increasing, 1., -1.), sizes)
+    below = np.bincount(inds + np.repeat(stack['prov'] * n_edges, sizes), weights=below_x,
+                        minlength=n_provs * n_edges).reshape(n_provs, n_edges)
+
+    return steps[:, 1:-1] + np.diff(below, axis=1)
+
+
+def histogram_transform_all(edges, counts, year=2023, provs=provinces, hist_edges=None,
+                            per_bin=False):
+    '''
+    Transforms a histogram of gross incomes for several provinces at once (see
+    histogram_transform). The tables of the provinces are stacked, so every step is
+    done once for all of them.
+
+    Parameters
+    ----------
+    edges, counts, hist_edges, per_bin: See histogram_transform.
+    year: Tax year.
+    provs: The provinces (all by default).
+
+    Returns
+    -------
+    A dictionary of results (see histogram_transform) keyed by province.
+    '''
+    edges, counts = check_histogram(edges, counts)
+    if len(provs) == 0:
+        raise CustomException("At least one province must be given.")
+    _, _, year = clinic(edges, provs[0], year)
+    provs = [prov.upper() for prov in provs]
+    unknown = [prov for prov in provs if prov not in provinces]
+    if len(unknown) > 0:
+        raise CustomException(f"{unknown} are not abbreviations of Canada's provinces or \
+territories (like 'AB', 'BC', 'NL', 'ON', ...)")
+    if hist_edges is None:
+        hist_edges = {'net_income': edges}
+
+    totals = stack_totals(edges, counts, load_stack(provs, year))
+    histograms = {column: stack_histograms(edges, counts, load_stack(provs, year, column),
+                                           new_edges)
+                  for column, new_edges in hist_edges.items()}
+
+    count = counts.sum()
+    gross_incomes = counts * (edges[:-1] + edges[1:]) / 2
+    gross_total = gross_incomes.sum()
+    results = {}
+    for p, prov in enumerate(provs):
+        prov_totals = dict(zip(components, totals[:, p]))
+        prov_totals['gross_income'] = gross_total
+        results[prov] = {'count': count,
+                         'totals': prov_totals,
+                         'means': {column: total / count if count > 0 else np.nan
+                                   for column, total in prov_totals.items()},
+                         'histograms': {column: histograms[column][p]
+                                        for column in histograms}}
+        if per_bin:
+            per_bin_totals = dict(zip(components, bin_totals(edges, counts,
+                                                             load_components(prov, year))))
+            per_bin_totals['gross_income'] = gross_incomes
+            results[prov]['bin_totals'] = per_bin_totals
+    return results
+
+
+def histogram_transform(edges, counts, prov='ON', year=2023, hist_edges=None,
+                        per_bin=False):
+    '''
+    Transforms a histogram of gross incomes into the totals of the net income and its
+    components, and into histograms of the net income (or of the components).
+
+    Parameters
+    ----------
+    edges: The bin edges of the gross incomes (increasing, >= 0).
+    counts: The number of people (or any weight) in every bin, taken as evenly spread
+            over the bin.
+    prov: Province.
+    year: Tax year.
+    hist_edges: A dictionary of the histograms to make: the bin edges keyed by column
+                (like 'net_income' or 'fed_tax'). By default, the net income histogram
+                on the gross bin edges.
+    per_bin: If True, the totals of every gross bin are also given (they take longer
+             than everything else, as there is one per bin and component).
+
+    Returns
+    -------
+    result: A dictionary:
+            count: The total count.
+            totals: The totals of the components (see components) and gross_income.
+            means: The totals divided by the count.
+            histograms: The counts of the histograms (keyed like hist_edges).
+            bin_totals: The totals of every gross bin (arrays keyed like totals), only
+                        if per_bin is True.
+    '''
+    results = histogram_transform_all(edges, counts, year, [prov], hist_edges, per_bin)
+    return results[prov.upper()]
+
+
+def build_bands(prov, year):
+    '''
+    Prepares the segment table of the net income of a province for band queries (see
+    band_net): the lowest and highest net income at every break (a jump has two net
+    incomes there, before and after it) and, for every power of 2, the lowest and
+    highest of them over all the runs of that many breaks (a sparse table), so the
+    extremes over any run of breaks are found with two lookups.
+
+    Returns
+    -------
+    table: A read-only dictionary: breaks, slope and intercept (see
+           segments.build_segments), and lowest and highest (one row per power of 2).
+    '''
+    table = segments.load_segments(prov, year)
+    breaks, slope, intercept = table['breaks'], table['slope'], table['intercept']
+    after = slope * breaks + intercept
+    before = np.concatenate((after[:1], slope[:-1] * breaks[1:] + intercept[:-1]))
+
+    lowest, highest = [np.minimum(before, after)], [np.maximum(before, after)]
+    width = 1
+    while 2 * width <= len(breaks):
+        lowest.append(np.concatenate((np.minimum(lowest[-1][:-width], lowest[-1][width:]),
+                                      np.full(width, np.inf))))
+        highest.append(np.concatenate((np.maximum(highest[-1][:-width], highest[-1][width:]),
+                                       np.full(width, -np.inf))))
+        width *= 2
+
+    return vector_calc.freeze({'breaks': breaks, 'slope': slope, 'intercept': intercept,
+                               'lowest': np.array(lowest), 'highest': np.array(highest)})
+
+
+def load_bands(prov, year):
+    '''
+    Returns the band table of a province for a year (it is built on the first call,
+    see build_bands).
+    '''
+    key = (prov.upper(), year, 'bands')
+    if key not in component_tables:
+        with component_tables_lock:
+            if key not in component_tables:
+                component_tables[key] = build_bands(prov, year)
+    return component_tables[key]
+
+
+def band_net(lows, highs, prov='ON', year=2023):
+    '''
+    Calculates the exact range and mean of the net incomes of gross income bands (like
+    the salary ranges of job postings) for a province and year. Inside a band, the net
+    income only has its extremes at the ends of the band or at the breaks of its segment
+    table, so no income has to be sampled.
+
+    Parameters
+    ----------
+    lows: An array of the lowest gross incomes of the bands (>= 0).
+    highs: An array of the highest gross incomes of the bands (>= lows).
+    prov: Province.
+    year: Tax year.
+
+    Returns
+    -------
+    result: A dictionary of arrays (not rounded):
+            min_net, max_net: The lowest and highest net incomes of every band (at a
+                              jump inside a band, the net income just before it counts).
+            mean_net: The average net income over every band (the incomes of a band
+                      taken as evenly spread; the net income of low for an empty band).
+    '''
+    lows, prov, year = clinic(np.asarray(lows, dtype=float), prov, year)
+    highs = np.asarray(highs, dtype=float)
+    if highs.shape != lows.shape or np.isnan(highs).any() or (lows < 0).any() or \
+       (highs < lows).any():
+        raise CustomException("The bands must be two arrays of the same length of \
+non negative gross incomes, with every high not below its low.")
+
+    table = load_bands(prov, year)
+    breaks, slope, intercept = table['breaks'], table['slope'], table['intercept']
+
+        ### The ends of the bands
+    start = np.searchsorted(breaks, lows, side='right')
+    end = np.searchsorted(breaks, highs, side='right')
+    net_low = slope[start - 1] * lows + intercept[start - 1]
+    net_high = slope[end - 1] * highs + intercept[end - 1]
+    min_net, max_net = np.minimum(net_low, net_high), np.maximum(net_low, net_high)
+
+        ### The breaks inside the bands (breaks[start:end]): the run is covered by two
+        ### (overlapping) runs of a power of 2 breaks
+    inside = np.flatnonzero(end > start)
+    if len(inside) > 0:
+        first, last = start[inside], end[inside]
+        level = np.frexp(last - first)[1] - 1
+        second = last - (1 << level)
+        min_net[inside] = np.minimum(min_net[inside],
+                                     np.minimum(table['lowest'][level, first],
+                                                table['lowest'][level, second]))
+        max_net[inside] = np.maximum(max_net[inside],
+                                     np.maximum(table['highest'][level, first],
+                                                table['highest'][level, second]))
+
+        ### The mean is the integral over the band divided by its width
+    width = highs - lows
+    integral = segments.segments_integral(highs, table) - segments.segments_integral(lows, table)
+    mean_net = np.where(width > 0, integral / np.where(width > 0, width, 1), net_low)
+
+    return {'min_net': min_net, 'max_net': max_net, 'mean_net': mean_net}
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with dataframes
+import pandas as pd
+# To work with arrays
+import numpy as np
+# To work with files and time the engines
+import os
+import time
+# To run the reference chain on all cores
+import concurrent.futures
+
+# Import required utility functions and constants from util module
+from util import *
+from tax_calculator import get_net, before_tax, before_tax_vec
+import vector_calc
+import segments
+import kernels
+import cents
+
+##########################################################
+# Golden corpus and differential harness. The corpus of a year holds, for every
+# province, a dense grid of gross incomes (every 5 dollars up to 400,000 and every 500
+# dollars up to 5,000,000) and the edge cases of its schedule (the incomes at and
+# around every kink of the net income: tax thresholds, CPP and EI maximums, bpa
+# phase-outs, surtax and health premium crossings, QPIP maximum, ...) with their net
+# incomes, and a grid of net incomes (with the edges of before_tax) with their gross
+# incomes. It is saved in a compressed numpy file per year (golden-<year>.npz).
+# All the expected values come from the reference chain: the net incomes from get_net
+# (one income at a time, so the millions of points are calculated in parallel
+# processes), the gross incomes from before_tax (gross_for_low_net, gross_for_high_net
+# and the polynomials). No engine is scored against its own results. compare_engines
+# then runs every engine over the corpus and reports its mismatches and throughput.
+
+golden_path = '../data/golden/'
+
+# The engines that calculate after_tax incomes (rounded), called as
+# engine(gross_incs, prov, year)
+
+
+def numpy_engine(gross_incs, prov, year):
+    net_incs = vector_calc.get_net_vec(gross_incs, vector_calc.load_schedule(prov, year))
+    return np.where(gross_incs <= 0, 0, np.round(net_incs['net_income']))
+
+
+def segments_engine(gross_incs, prov, year):
+    net_incs = segments.segments_net(gross_incs, segments.load_segments(prov, year))
+    return np.where(gross_incs <= 0, 0, np.round(net_incs))
+
+
+def numba_engine(gross_incs, prov, year):
+        # Like after_tax_vec, a plan with rules the kernel does not have runs on numpy
+    sched = vector_calc.load_schedule(prov, year)
+    if not sched['hard_coded']:
+        return numpy_engine(gross_incs, prov, year)
+    return kernels.net_numba(gross_incs, sched)
+
+
+def cents_engine(gross_incs, prov, year):
+    return cents.after_tax_cents(gross_incs, prov, year).astype(float)
+
+
+after_tax_engines = {'numpy': numpy_engine, 'segments': segments_engine,
+                     'cents': cents_engine}
+if kernels.numba is not None:
+    after_tax_engines['numba'] = numba_engine
+
+# The engines that calculate before_tax incomes (rounded), called the same way
+
+
+def polynomial_engine(net_incs, prov, year):
+    gross_incs = before_tax(net_incs, prov, year)
+    if gross_incs is None:
+        raise CustomException(f"before_tax failed for {prov} in {year} (are the \
+polynomials of the year saved? see get_poly).")
+    return np.array(gross_incs, dtype=float)
+
+
+def vectorized_engine(net_incs, prov, year):
+    return before_tax_vec(net_incs, prov, year)
+
+
+before_tax_engines = {'polynomial': polynomial_engine, 'vectorized': vectorized_engine}
+
+
+def edge_incomes(prov, year, offsets=(-1, -0.01, 0, 0.01, 1)):
+    '''
+    Lists the gross incomes at and around every kink of the net income of a province
+    (see segments.known_breaks and segments.build_segments, which also finds the kinks
+    that are not given in the tables, like the surtax crossings).
+
+    Parameters
+    ----------
+    prov: Province.
+    year: Tax year.
+    offsets: The distances (in dollars) from the kinks.
+
+    Returns
+    -------
+    A sorted array of gross incomes (> 0).
+    '''
+    sched = vector_calc.load_schedule(prov, year)
+    kinks = np.concatenate((segments.known_breaks(sched, 5000000),
+                            segments.load_segments(prov, year)['breaks'][1:]))
+    edges = np.unique(np.round(kinks[:, None] + np.array(offsets), 2))
+    return edges[edges > 0]
+
+
+def reference_net(gross_incs, prov, year):
+    '''
+    Calculates the net incomes of an array of gross incomes with the reference chain
+    (get_net, one income at a time).
+    '''
+    tables = read_tables(year)
+    Federal_df, prov_df = tables['Federal'], tables[prov]
+    return np.array([get_net(gross_inc, Federal_df, prov, prov_df) if gross_inc > 0 else 0
+                     for gross_inc in gross_incs], dtype=float)
+
+
+def make_golden(year, provs=provinces, step=5, workers=None, chunk_size=20000):
+    '''
+    Generates and saves the golden corpus of a year. All the expected values are
+    calculated by the reference chain (see reference_net and polynomial_engine), which
+    takes about an hour of one core per year for the default grid, so the net incomes
+    are calculated by a pool of processes.
+
+    Parameters
+    ----------
+    year: Tax year.
+    provs: The provinces (all by default).
+    step: Step (in dollars) of the dense grid of gross incomes up to 400,000 (net
+          incomes are on a grid 5 times coarser).
+    workers: Number of processes (by default, the number of cores).
+    chunk_size: Number of gross incomes per task of the pool.
+
+    Returns
+    -------
+    corpus: A dictionary of arrays (see load_golden).
+    '''
+    dense = np.concatenate((np.arange(0, 400000, step), np.arange(400000, 5000001, 500)))
+    parts = {'gross': [], 'net': [], 'gross_prov': [], 'gross_edge': [],
+             'net_incs': [], 'gross_incs': [], 'net_prov': [], 'net_edge': []}
+
+        ### Gross to net: the dense grid and the edges of every province, calculated by
+        ### get_net in chunks
+    for prov in provs:
+        edges = edge_incomes(prov, year)
+        parts['gross'].append(np.concatenate((dense.astype(float), edges)))
+        parts['gross_prov'].append(np.full(len(dense) + len(edges), provinces.index(prov)))
+        parts['gross_edge'].append(np.arange(len(dense) + len(edges)) >= len(dense))
+
+    tasks = [(gross_incs[start:start + chunk_size], prov)
+             for gross_incs, prov in zip(parts['gross'], provs)
+             for start in range(0, len(gross_incs), chunk_size)]
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        chunks = list(executor.map(reference_net, [task[0] for task in tasks],
+                                   [task[1] for task in tasks], [year] * len(tasks)))
+    net_incs = np.concatenate(chunks)
+    parts['net'] = np.split(net_incs, np.cumsum([len(gross) for gross in parts['gross']])[:-1])
+
+    for p, prov in enumerate(provs):
+            ### Net to gross: a grid, the edges of before_tax (the bpa, the income
+            ### where the polynomials switch, the start of the high incomes) and the
+            ### net incomes of the gross edges
+        sched = vector_calc.load_schedule(prov, year)
+        net_edges = np.array([sched['fed_bpa'][0], sched['prov_bpa'][0], 200000, 500000])
+        net_edges = np.concatenate(((net_edges[:, None] + np.array([-1, 0, 1])).ravel(),
+                                    np.unique(parts['net'][p][len(dense):])))
+        net_grid = np.arange(0, 600000, step * 5, dtype=float)
+        net_points = np.concatenate((net_grid, net_edges[net_edges > 0]))
+        parts['net_incs'].append(net_points)
+        parts['gross_incs'].append(polynomial_engine(net_points, prov, year))
+        parts['net_prov'].append(np.full(len(net_points), provinces.index(prov)))
+        parts['net_edge'].append(np.arange(len(net_points)) >= len(net_grid))
+
+    corpus = {'gross': np.concatenate(parts['gross']),
+              'net': np.concatenate(parts['net']).astype(np.int64),
+              'gross_prov': np.concatenate(parts['gross_prov']).astype(np.uint8),
+              'gross_edge': np.concatenate(parts['gross_edge']).astype(np.uint8),
+              'net_incs': np.concatenate(parts['net_incs']),
+              'gross_incs': np.concatenate(parts['gross_incs']).astype(np.int64),
+              'net_prov': np.concatenate(parts['net_prov']).astype(np.uint8),
+              'net_edge': np.concatenate(parts['net_edge']).astype(np.uint8)}
+
+    os.makedirs(golden_path, exist_ok=True)
+    file = golden_path + 'golden-' + str(year) + '.npz'
+    np.savez_compressed(file + '.tmp.npz', **corpus)
+    os.replace(file + '.tmp.npz', file)
+    print(f"The golden corpus for year {year} ({len(corpus['gross'])} gross and \
+{len(corpus['net_incs'])} net points) is successfully saved in {file}.")
+
+    return corpus
+
+
+def load_golden(year):
+    '''
+    Reads the golden corpus of a year.
+
+    Returns
+    -------
+    corpus: A dictionary of arrays: gross and net (the gross incomes and their net
+            incomes), gross_prov (index of the province in provinces) and gross_edge
+            (1 for the edge cases, 0 for the dense grid), then net_incs and gross_incs (the net incomes and their
+            gross incomes), net_prov and net_edge.
+    '''
+    with np.load(golden_path + 'golden-' + str(year) + '.npz') as f:
+        return {key: f[key] for key in f.files}
+
+
+def compare_engines(year, engines=None, tol=0, examples=5):
+    '''
+    Runs engines over the golden corpus of a year and compares their results with it.
+
+    Parameters
+    ----------
+    year: Tax year.
+    engines: A list of engine names (of after_tax_engines and before_tax_engines). All
+             of them by default.
+    tol: The difference (in dollars) that is not counted as a mismatch.
+    examples: Number of mismatches listed per engine.
+
+    Returns
+    -------
+    report: A dataframe with one row per engine: direction (after_tax or before_tax),
+            rows, mismatches (and edge_mismatches, on edge cases), max_diff, the
+            provinces with mismatches, the first mismatches (province, income,
+            expected, result), seconds and rows_per_sec.
+    '''
+    corpus = load_golden(year)
+    all_engines = [('after_tax', name, func) for name, func in after_tax_engines.items()] + \
+                  [('before_tax', name, func) for name, func in before_tax_engines.items()]
+    if engines is not None:
+        all_engines = [engine for engine in all_engines if engine[1] in engines]
+
+    rows = []
+    for direction, name, func in all_engines:
+        if direction == 'after_tax':
+            incs, expected = corpus['gross'], corpus['net']
+            provs, edge = corpus['gross_prov'], corpus['gross_edge']
+        else:
+            incs, expected = corpus['net_incs'], corpus['gross_incs']
+            provs, edge = corpus['net_prov'], corpus['net_edge']
+
+        results = np.empty(len(incs))
+        seconds = 0.
+            # A first call, not timed, builds the tables (and compiles numba kernels)
+        if len(incs) > 0:
+            func(incs[:1], provinces[provs[0]], year)
+        for p in np.unique(provs):
+            inds = np.flatnonzero(provs == p)
+            start = time.perf_counter()
+            results[inds] = func(incs[inds], provinces[p], year)
+            seconds += time.perf_counter() - start
+
+        diff = np.abs(results - expected)
+        bad = np.flatnonzero(diff > tol)
+        rows.append({'direction': direction,
+                     'engine': name,
+                     'rows': len(incs),
+                     'mismatches': len(bad),
+                     'edge_mismatches': int(edge[bad].sum()),
+                     'max_diff': float(diff.max()) if len(diff) > 0 else 0.,
+                     'provinces': sorted({provinces[p] for p in provs[bad]}),
+                     'examples': [(provinces[provs[i]], float(incs[i]), float(expected[i]),
+                                   float(results[i])) for i in bad[:examples]],
+                     'seconds': seconds,
+                     'rows_per_sec': len(incs) / seconds if seconds > 0 else np.nan})
+
+    return pd.DataFrame(rows)
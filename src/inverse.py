@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with dataframes
+import pandas as pd
+# To work with arrays
+import numpy as np
+# To build the tables once when several threads ask for them
+import threading
+# To save the tables to files
+import os
+
+# Import required utility functions and constants from util module
+from util import *
+import vector_calc
+import segments
+
+##########################################################
+# Inverse interpolation tables for before_tax. The net income is an increasing (but for
+# a few small jumps, like the one of the Ontario surtax) piecewise linear function of
+# the gross income, so the gross income of a net income can be found by a linear
+# interpolation between sampled (net, gross) pairs. The grid of gross incomes starts
+# at the kinks of the net income (see segments) and a uniform grid, and is refined
+# where the interpolation is not precise enough, until the error is below a given
+# bound (in dollars). A table answers a whole array of net incomes with one
+# searchsorted and one interpolation.
+
+# Inverse tables built in this process, keyed by (province, year, error_key(max_error))
+inverse_tables = {}
+inverse_tables_lock = threading.Lock()
+derived_caches.append(inverse_tables)
+
+
+def error_key(max_error):
+    '''
+    The key of an error bound in inverse_tables: the bound formatted with 6 significant
+    digits, so bounds that only differ by float noise (like 0.1 + 0.2 and 0.3, or a
+    bound read back from a csv file) find the same table.
+    '''
+    return f"{float(max_error):.6g}"
+
+
+def build_inverse(sched, max_error=0.5, max_income=5000000, min_step=0.01):
+    '''
+    Builds the inverse table of a schedule.
+
+    Parameters
+    ----------
+    sched: A schedule (see vector_calc.make_schedule).
+    max_error: The error (in dollars) the table must achieve. The error of a net income
+               is how far its interpolated gross income is from the exact one or how far
+               the net income of the interpolated gross is from it, whichever is less
+               (the net incomes of a jump have more than one gross income).
+    max_income: The largest gross income of the table (the last interval is extended
+                linearly above it).
+    min_step: The smallest interval (in dollars) the grid is refined to. The error is
+              not measured on the jumps of the net income, which are narrower.
+
+    Returns
+    -------
+    table: A read-only dictionary: net and gross (the pairs of the table, net incomes
+           are increasing) and max_error (the largest error measured on the kinks and
+           five inner points of every interval, on both the gross and the net side).
+    '''
+    def net(gross_incs):
+        return vector_calc.get_net_vec(gross_incs, sched)['net_income']
+
+    fracs = np.array([0.1, 0.3, 0.5, 0.7, 0.9])
+
+    def pairs(grid):
+            # The running maximum keeps the net incomes increasing over the jumps, and
+            # pairs with the same net income (its flat parts) add nothing to the
+            # interpolation. Also returns the position of the pairs in the grid.
+        nets = np.maximum.accumulate(net(grid))
+        keep = np.flatnonzero(np.concatenate(([True], np.diff(nets) > 0)))
+        return grid[keep], nets[keep], keep
+
+    def gross_errors(points, grid, nets):
+        point_nets = net(points)
+        estimates = np.interp(point_nets, nets, grid)
+        return np.minimum(np.abs(estimates - points), np.abs(net(estimates) - point_nets))
+
+        # The error of a linear interpolation is the largest at a kink, so the kinks
+        # (see segments.build_segments) are checked too
+    kinks = segments.build_segments(sched, max_income)['breaks'][1:]
+    kinks = np.concatenate((kinks - min_step / 2, kinks, kinks + min_step / 2))
+
+    def errors(grid, nets):
+            # The error of every interval on its inner points and kinks, taken on the
+            # gross side and on the net side (where the net income jumps down, the
+            # gross incomes of the net incomes above the jump are after it)
+        inner = grid[:-1, None] + np.diff(grid)[:, None] * fracs
+        error = gross_errors(inner.ravel(), grid, nets).reshape(inner.shape).max(axis=1)
+        inside = np.searchsorted(grid, kinks, side='right') - 1
+        known = (inside >= 0) & (inside < len(grid) - 1)
+        np.maximum.at(error, inside[known], gross_errors(kinks[known], grid, nets))
+
+        inner_nets = nets[:-1, None] + np.diff(nets)[:, None] * fracs
+        estimates = np.interp(inner_nets, nets, grid)
+        net_side = np.abs(net(estimates.ravel()).reshape(inner.shape) - inner_nets).max(axis=1)
+            # Except at the jumps themselves: the net incomes of a jump up have no gross
+            # income, and the gross income of the net incomes at the top of a jump down
+            # (a band narrower than min_step) jumps too
+        net_side[np.diff(grid) <= min_step] = 0
+        error = np.maximum(error, net_side)
+        error[np.diff(nets) <= min_step] = 0
+        return error
+
+    breaks = segments.known_breaks(sched, max_income)
+    grid = np.unique(np.concatenate((np.linspace(0, max_income, 1001), breaks - min_step,
+                                     breaks, breaks + min_step)))
+    grid = grid[(grid >= 0) & (grid <= max_income)]
+
+    while True:
+        gross, nets, keep = pairs(grid)
+        error = errors(gross, nets)
+            # An interval is split between its end and the grid point before it. That is
+            # its middle, but after a jump (where the points before the net income is
+            # back to its level before the jump are not pairs) it is the point where
+            # the net income gets back.
+        ends = gross[1:]
+        before_ends = grid[keep[1:] - 1]
+        refine = (error > max_error) & (ends - before_ends > min_step)
+        if not refine.any():
+            break
+        grid = np.union1d(grid, (before_ends[refine] + ends[refine]) / 2)
+
+    return vector_calc.freeze({'net': nets, 'gross': gross,
+                               'max_error': float(error.max())})
+
+
+def load_inverse(prov, year, max_error=0.5):
+    '''
+    Returns the inverse table of a province for a year (it is built on the first call).
+    '''
+    key = (prov.upper(), year, error_key(max_error))
+    if key not in inverse_tables:
+        with inverse_tables_lock:
+            if key not in inverse_tables:
+                inverse_tables[key] = build_inverse(vector_calc.load_schedule(prov, year),
+                                                    max_error)
+    return inverse_tables[key]
+
+
+def inverse_gross(net_incs, table):
+    '''
+    Calculates the (not rounded) gross incomes of an array of net incomes from an
+    inverse table. Net incomes above the table are extended with the slope of its last
+    interval.
+    '''
+    nets, grid = table['net'], table['gross']
+    gross_incs = np.interp(net_incs, nets, grid)
+    above = net_incs > nets[-1]
+    slope = (grid[-1] - grid[-2]) / (nets[-1] - nets[-2])
+    return np.where(above, grid[-1] + (net_incs - nets[-1]) * slope, gross_incs)
+
+
+def before_tax_interp(net_incs, prov='ON', year=2023, max_error=0.5):
+    '''
+    Calculates the gross incomes for an array of net incomes with the inverse table of
+    the province and year (see build_inverse).
+
+    Parameters
+    ----------
+    net_incs: An array of net incomes.
+    prov: Province.
+    year: Tax year.
+    max_error: The error bound (in dollars) of the table.
+
+    Returns
+    -------
+    gross_incs: An array of before_tax incomes (rounded to dollars, 0 for net incomes
+                <= 0).
+    '''
+    net_incs, prov, year = clinic(net_incs, prov, year)
+    gross_incs = np.round(inverse_gross(net_incs.astype(float),
+                                        load_inverse(prov, year, max_error)))
+    return np.where(net_incs <= 0, 0, gross_incs)
+
+
+def save_inverse(year, provs=provinces, max_error=0.5):
+    '''
+    Saves the inverse tables of the provinces for a year in one csv file
+    (inverse-<year>.csv, next to polynomials-<year>.csv).
+
+    Parameters
+    ----------
+    year: Tax year.
+    provs: The provinces to save (all by default).
+    max_error: The error bound (in dollars) of the tables.
+
+    Returns
+    -------
+    A dictionary of the achieved error bounds keyed by province.
+    '''
+    tables, bounds = [], {}
+    for prov in provs:
+        inverse = load_inverse(prov, year, max_error)
+        table = pd.DataFrame({'net': inverse['net'], 'gross': inverse['gross']})
+        table.insert(0, 'province', prov)
+        table['max_error'] = inverse['max_error']
+        table['target_error'] = max_error
+        tables.append(table)
+        bounds[prov] = inverse['max_error']
+
+    file = '../data/tax_rates_' + str(year) + '/inverse-' + str(year) + '.csv'
+    pd.concat(tables).to_csv(file + '.tmp', index=False)
+    os.replace(file + '.tmp', file)
+    print(f"The inverse tables for year {year} are successfully saved in {file}.")
+    return bounds
+
+
+def read_inverse(year, max_error=None):
+    '''
+    Reads the inverse tables saved by save_inverse and makes them the tables used by
+    this process for that year (and error bound).
+
+    Parameters
+    ----------
+    year: Tax year.
+    max_error: The error bound the tables were saved with. The file has it (the
+               target_error column), so it is only used for the files saved without it
+               (0.5 if None).
+
+    Returns
+    -------
+    A dictionary of inverse tables keyed by province.
+    '''
+    file = '../data/tax_rates_' + str(year) + '/inverse-' + str(year) + '.csv'
+    inverse_df = pd.read_csv(file)
+    if 'target_error' in inverse_df:
+        max_error = inverse_df['target_error'].iloc[0]
+    elif max_error is None:
+        max_error = 0.5
+    tables = {}
+    for prov, table in inverse_df.groupby('province'):
+        tables[prov] = vector_calc.freeze({'net': table['net'].to_numpy(),
+                                           'gross': table['gross'].to_numpy(),
+                                           'max_error': float(table['max_error'].iloc[0])})
+        with inverse_tables_lock:
+            inverse_tables[(prov, year, error_key(max_error))] = tables[prov]
+    return tables
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with arrays
+import numpy as np
+# To compile the net income chain into one loop (optional, if numba is not installed
+# the numpy functions of vector_calc are used)
+try:
+    import numba
+    from numba import njit, prange
+except ImportError:
+    numba = None
+
+from util import CustomException
+
+##########################################################
+# Compiled (numba) backend of the net income chain. The whole CPP -> EI -> federal ->
+# provincial -> net calculation of one income is done in a single loop iteration on
+# plain numbers, so no temporary array is created per step, and the loop over incomes
+# runs on all cores (prange).
+# A schedule (see vector_calc.make_schedule) is packed into a parameter vector plus the
+# small bracket arrays. These are the positions of the parameters in the vector:
+p_cpp_rate, p_cpp_be, p_cpp_max, p_cpp2_thresh1, p_cpp2_thresh2, p_cpp2_rate, \
+    p_ei_rate, p_ei_max, p_fed_bpa, p_prov_bpa, p_fed_credit_rate, p_prov_credit_rate, \
+    p_fed_cbc, p_prov_cbc, p_fed_abatement, p_employ_credit, p_phase_out, \
+    p_qpip_max, p_qpip_rate = 0, 1, 2, 3, 4, 5, 6, 7, 8, 12, 16, 17, 18, 19, 20, 21, 22, 23, 24
+n_params = 25
+
+# The integer cents version of the chain (see the cents module) has its own parameter
+# vector (int64, amounts in cents and rates in parts per million):
+c_cpp_rate, c_cpp_be, c_cpp_max, c_cpp2_thresh1, c_cpp2_thresh2, c_cpp2_rate, \
+    c_ei_rate, c_ei_max, c_fed_bpa, c_prov_bpa, c_fed_credit_rate, c_prov_credit_rate, \
+    c_fed_cbc, c_prov_cbc, c_fed_abatement, c_employ_credit, c_phase_out, \
+    c_qpip_max, c_qpip_rate = 0, 1, 2, 3, 4, 5, 6, 7, 8, 13, 18, 19, 20, 21, 22, 23, 24, 25, 26
+n_cents_params = 27
+
+
+def pack_schedule(sched):
+    '''
+    Packs a compiled schedule into the arrays the compiled kernel works on.
+
+    Parameters
+    ----------
+    sched: A schedule (see vector_calc.make_schedule).
+
+    Returns
+    -------
+    A tuple of float arrays: parameters, federal thresholds, cumulative taxes and rates,
+    provincial thresholds, cumulative taxes and rates, surtax thresholds and rates,
+    health premium thresholds, rates and limits.
+    '''
+    if not sched['hard_coded']:
+        raise CustomException(f"The compiled kernel does not have all the rules of the plan \
+of {sched['province']} ({', '.join(sched['plan'])}), use the numpy backend.")
+    params = np.zeros(n_params)
+    params[p_cpp_rate] = sched['cpp_rate']
+    params[p_cpp_be] = sched['cpp_be']
+    params[p_cpp_max] = sched['cpp_max']
+    if sched['cpp2'] is not None:
+        params[p_cpp2_thresh1:p_cpp2_rate + 1] = sched['cpp2']
+    params[p_ei_rate] = sched['ei_rate']
+    params[p_ei_max] = sched['ei_max']
+    params[p_fed_bpa:p_fed_bpa + 4] = sched['fed_bpa']
+    params[p_prov_bpa:p_prov_bpa + 4] = sched['prov_bpa']
+    params[p_fed_credit_rate] = sched['fed_credit_rate']
+    params[p_prov_credit_rate] = sched['prov_credit_rate']
+    params[p_fed_cbc] = sched['fed_cbc']
+    params[p_prov_cbc] = sched['prov_cbc']
+    params[p_fed_abatement] = sched['fed_abatement']
+    params[p_employ_credit] = sched['employ_credit']
+        # NaN never compares as smaller, so no income is phased out
+    params[p_phase_out] = np.nan if sched['phase_out'] is None else sched['phase_out']
+    if sched['qpip'] is not None:
+        params[p_qpip_max], params[p_qpip_rate] = sched['qpip']
+
+    if sched['health_thresh'] is not None:
+        health = (sched['health_thresh'], sched['health_rate'], sched['health_limit'])
+    else:
+        health = (np.zeros(0), np.zeros(1), np.full(1, np.nan))
+
+    arrays = (params,
+              sched['fed_thresh'], sched['fed_cumul'], sched['fed_rate'],
+              sched['prov_thresh'], sched['prov_cumul'], sched['prov_rate'],
+              sched['surtax_thresh'], sched['surtax_rate']) + health
+    return tuple(np.ascontiguousarray(a, dtype=np.float64) for a in arrays)
+
+
+def pack_cents_schedule(csched):
+    '''
+    Packs a cents schedule into the int64 arrays the compiled cents kernel works on.
+
+    Parameters
+    ----------
+    csched: A cents schedule (see cents.make_cents_schedule).
+
+    Returns
+    -------
+    A tuple of int64 arrays: parameters, federal thresholds, cumulative taxes and rates,
+    provincial thresholds, cumulative taxes and rates, surtax thresholds and rates,
+    health premium thresholds, rates and limits.
+    '''
+    params = np.zeros(n_cents_params, dtype=np.int64)
+    params[c_cpp_rate] = csched['cpp_rate']
+    params[c_cpp_be] = csched['cpp_be']
+    params[c_cpp_max] = csched['cpp_max']
+    if csched['cpp2'] is not None:
+        params[c_cpp2_thresh1:c_cpp2_rate + 1] = csched['cpp2']
+    params[c_ei_rate] = csched['ei_rate']
+    params[c_ei_max] = csched['ei_max']
+    params[c_fed_bpa:c_fed_bpa + 5] = csched['fed_bpa']
+    params[c_prov_bpa:c_prov_bpa + 5] = csched['prov_bpa']
+    params[c_fed_credit_rate] = csched['fed_credit_rate']
+    params[c_prov_credit_rate] = csched['prov_credit_rate']
+    params[c_fed_cbc] = csched['fed_cbc']
+    params[c_prov_cbc] = csched['prov_cbc']
+    params[c_fed_abatement] = csched['fed_abatement']
+    params[c_employ_credit] = csched['employ_credit']
+        # No taxable income is smaller than the smallest int64, so none is phased out
+    params[c_phase_out] = np.iinfo(np.int64).min if csched['phase_out'] is None \
+        else csched['phase_out']
+    if csched['qpip'] is not None:
+        params[c_qpip_max], params[c_qpip_rate] = csched['qpip']
+
+    if csched['health_thresh'] is not None:
+        health = (csched['health_thresh'], csched['health_rate'], csched['health_limit'])
+    else:
+        health = (np.zeros(0), np.zeros(1), np.zeros(1))
+
+    arrays = (params,
+              csched['fed_thresh'], csched['fed_cumul'], csched['fed_rate'],
+              csched['prov_thresh'], csched['prov_cumul'], csched['prov_rate'],
+              csched['surtax_thresh'], csched['surtax_rate']) + health
+    return tuple(np.ascontiguousarray(a, dtype=np.int64) for a in arrays)
+
+
+if numba is not None:
+
+    @njit(nogil=True, cache=True)
+    def bracket_tax(taxable_inc, thresh, cumul, rate):
+        # Number of thresholds (leading 0 excluded) the income is strictly greater than
+        k = 0
+        while k < len(thresh) - 1 and thresh[k + 1] < taxable_inc:
+            k += 1
+        return cumul[k] + rate[k] * (taxable_inc - thresh[k]) / 100
+
+    @njit(nogil=True, cache=True)
+    def tuned_bpa(gross_inc, params, pos):
+        full, low, high, slope = params[pos], params[pos + 1], params[pos + 2], params[pos + 3]
+        return full - slope * (min(max(gross_inc, low), high) - low)
+
+    @njit(parallel=True, nogil=True, cache=True)
+    def net_kernel(gross_incs, params, fed_thresh, fed_cumul, fed_rate, prov_thresh,
+                   prov_cumul, prov_rate, surtax_thresh, surtax_rate, health_thresh,
+                   health_rate, health_limit):
+        net_incs = np.empty(len(gross_incs))
+        for i in prange(len(gross_incs)):
+            gross_inc = gross_incs[i]
+            if gross_inc <= 0:
+                net_incs[i] = 0
+                continue
+
+                ### CPP (CPP2 included) and EI
+            cpp = min(max(gross_inc - params[p_cpp_be], 0) * params[p_cpp_rate] / 100,
+                      params[p_cpp_max])
+            cpp += (min(max(gross_inc, params[p_cpp2_thresh1]), params[p_cpp2_thresh2]) -
+                    params[p_cpp2_thresh1]) * params[p_cpp2_rate] / 100
+            ei = min(gross_inc * params[p_ei_rate] / 100, params[p_ei_max])
+
+                ### Federal tax
+            fed_exempt = tuned_bpa(gross_inc, params, p_fed_bpa)
+            cbc = params[p_fed_cbc]
+            credit = (ei + cbc * cpp + fed_exempt) * params[p_fed_credit_rate] + \
+                params[p_employ_credit]
+            taxable_inc = gross_inc - (1 - cbc) * cpp if gross_inc > cpp else 0.
+            fed_tax = bracket_tax(taxable_inc, fed_thresh, fed_cumul, fed_rate)
+            if fed_tax > credit and taxable_inc > fed_exempt:
+                fed_tax = (fed_tax - credit) * (1 - params[p_fed_abatement])
+            else:
+                fed_tax = 0.
+
+                ### Provincial tax
+            prov_exempt = tuned_bpa(gross_inc, params, p_prov_bpa)
+            cbc = params[p_prov_cbc]
+            taxable_inc = gross_inc - (1 - cbc) * cpp if gross_inc > cpp else 0.
+            prov_tax = 0.
+            if taxable_inc > prov_exempt and not taxable_inc < params[p_phase_out]:
+                prov_tax = bracket_tax(taxable_inc, prov_thresh, prov_cumul, prov_rate)
+
+                if len(surtax_rate) > 0 and prov_tax > surtax_thresh[0]:
+                    surtax = 0.
+                    for j in range(len(surtax_rate)):
+                        surtax += (prov_tax - surtax_thresh[j]) * surtax_rate[j]
+                    prov_tax += surtax
+
+                k = 0
+                while k < len(health_thresh) and health_thresh[k] < taxable_inc:
+                    k += 1
+                if k > 0:
+                    health_prem = health_limit[k - 1] + (taxable_inc - health_thresh[k - 1]) \
+                        * health_rate[k] / 100
+                    if health_prem > health_limit[k]:
+                        health_prem = health_limit[k]
+                    prov_tax += health_prem
+
+                prov_tax += min(gross_inc, params[p_qpip_max]) * params[p_qpip_rate] / 100
+
+                credit = (ei + cbc * cpp + prov_exempt) * params[p_prov_credit_rate]
+                prov_tax = prov_tax - credit if prov_tax > credit else 0.
+
+            net_incs[i] = np.rint(gross_inc - fed_tax - prov_tax - cpp - ei)
+
+        return net_incs
+
+
+    @njit(nogil=True, cache=True)
+    def div_round(num, den, half_even, signed):
+        # The same operations as cents.div_round, on one number
+        mag = abs(num) if signed else num
+        twice = mag * 2 + den
+        if half_even:
+            twice += (mag // den) % 2 - 1
+        twice //= 2 * den
+        return -twice if signed and num < 0 else twice
+
+    @njit(nogil=True, cache=True)
+    def rate_cents(amount, rate, half_even, signed=False):
+        return div_round(amount * rate, 1000000, half_even, signed)
+
+    @njit(nogil=True, cache=True)
+    def bpa_cents(gross_cents, params, pos, half_even):
+        full, low, high, num, den = params[pos], params[pos + 1], params[pos + 2], \
+            params[pos + 3], params[pos + 4]
+        if num == 0:
+            return full
+        return full - div_round((min(max(gross_cents, low), high) - low) * num, den,
+                                half_even, False)
+
+    @njit(nogil=True, cache=True)
+    def bracket_tax_cents(taxable, thresh, cumul, rate, half_even):
+        k = 0
+        while k < len(thresh) - 1 and thresh[k + 1] < taxable:
+            k += 1
+        return cumul[k] + rate_cents(taxable - thresh[k], rate[k], half_even)
+
+    @njit(parallel=True, nogil=True, cache=True)
+    def net_cents_kernel(gross_cents, half_even, dollars, params, fed_thresh, fed_cumul,
+                         fed_rate, prov_thresh, prov_cumul, prov_rate, surtax_thresh,
+                         surtax_rate, health_thresh, health_rate, health_limit):
+        net = np.empty(len(gross_cents), dtype=np.int64)
+        for i in prange(len(gross_cents)):
+            gross = gross_cents[i]
+            if gross <= 0:
+                net[i] = 0
+                continue
+
+                ### CPP (CPP2 included) and EI
+            cpp = min(rate_cents(max(gross - params[c_cpp_be], 0), params[c_cpp_rate],
+                                 half_even), params[c_cpp_max])
+            cpp += rate_cents(min(max(gross, params[c_cpp2_thresh1]), params[c_cpp2_thresh2]) -
+                              params[c_cpp2_thresh1], params[c_cpp2_rate], half_even)
+            ei = min(rate_cents(gross, params[c_ei_rate], half_even), params[c_ei_max])
+
+                ### Federal tax
+            exempt = bpa_cents(gross, params, c_fed_bpa, half_even)
+            cbc_cpp = div_round(cpp * params[c_fed_cbc], 1000000000, half_even, False)
+            taxable = gross - (cpp - cbc_cpp) if gross > cpp else 0
+            tax = bracket_tax_cents(taxable, fed_thresh, fed_cumul, fed_rate, half_even)
+            credit = rate_cents(ei + cbc_cpp + exempt, params[c_fed_credit_rate], half_even) + \
+                params[c_employ_credit]
+            tax = tax - credit if tax > credit and taxable > exempt else 0
+            fed_tax = tax - rate_cents(tax, params[c_fed_abatement], half_even)
+
+                ### Provincial tax
+            exempt = bpa_cents(gross, params, c_prov_bpa, half_even)
+            cbc_cpp = div_round(cpp * params[c_prov_cbc], 1000000000, half_even, False)
+            taxable = gross - (cpp - cbc_cpp) if gross > cpp else 0
+            prov_tax = 0
+            if taxable > exempt and not taxable < params[c_phase_out]:
+                tax = bracket_tax_cents(taxable, prov_thresh, prov_cumul, prov_rate, half_even)
+                credit = rate_cents(ei + cbc_cpp + exempt, params[c_prov_credit_rate], half_even)
+
+                if len(surtax_rate) > 0 and tax > surtax_thresh[0]:
+                    surtax = 0
+                    for j in range(len(surtax_rate)):
+                        surtax += rate_cents(tax - surtax_thresh[j], surtax_rate[j], half_even,
+                                             True)
+                    tax += surtax
+
+                k = 0
+                while k < len(health_thresh) and health_thresh[k] < taxable:
+                    k += 1
+                if k > 0:
+                    tax += min(health_limit[k - 1] +
+                               rate_cents(taxable - health_thresh[k - 1], health_rate[k],
+                                          half_even), health_limit[k])
+
+                tax += rate_cents(min(gross, params[c_qpip_max]), params[c_qpip_rate], half_even)
+                prov_tax = tax - credit if tax > credit else 0
+
+            net[i] = gross - fed_tax - prov_tax - cpp - ei
+            if dollars:
+                net[i] = div_round(net[i], 100, half_even, True)
+
+        return net
+
+
+def net_cents_numba(gross_cents, csched, rounding='half_even', dollars=False):
+    '''
+    Calculates the net incomes of an array of gross incomes (in cents) with the compiled
+    cents kernel. The operations (and so the results) are the ones of
+    cents.get_net_cents, done in one loop. Gross incomes <= 0 get a net income of 0.
+
+    Parameters
+    ----------
+    gross_cents: An int64 array of gross incomes in cents.
+    csched: A cents schedule (see cents.make_cents_schedule).
+    rounding: 'half_even' or 'half_up' (see cents.div_round).
+    dollars: If True, net incomes are rounded to dollars (with the same rule).
+
+    Returns
+    -------
+    An int64 array of net incomes (in cents, or dollars).
+    '''
+    gross_cents = np.ascontiguousarray(gross_cents, dtype=np.int64)
+    return net_cents_kernel(gross_cents, rounding == 'half_even', dollars,
+                            *pack_cents_schedule(csched))
+
+
+def net_numba(gross_incs, sched):
+    '''
+    Calculates the rounded net incomes of an array of gross incomes with the compiled
+    kernel. Gross incomes <= 0 get a net income of 0 (like after_tax).
+
+    Parameters
+    ----------
+    gross_incs: An array of gross incomes.
+    sched: A schedule (see vector_calc.make_schedule).
+
+    Returns
+    -------
+    An array of net incomes.
+    '''
+    gross_incs = np.ascontiguousarray(gross_incs, dtype=np.float64)
+    return net_kernel(gross_incs, *pack_schedule(sched))
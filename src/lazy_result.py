@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with arrays
+import numpy as np
+
+# Import required utility functions and constants from util module
+from util import *
+from vector_calc import (load_schedule, tune_bpa_vec, bracket_tax_vec, get_cpp_vec,
+                         get_ei_vec, get_taxable_vec)
+import prov_rules
+
+##########################################################
+# Lazy results of the vectorized chain. get_net_vec calculates every component of the
+# net income, but many callers only read one or two of them (only fed_tax, or only CPP
+# and EI). lazy_after_tax returns a handle instead, and a column is only calculated
+# when it is read, with the part of the chain it depends on. Every intermediate (like
+# the taxable incomes) is calculated once and kept, so reading more columns never
+# calculates anything twice. The operations are the ones of get_fed_tax_vec and
+# get_prov_tax_vec, so the columns are identical to the ones of get_net_vec.
+
+# The nodes of the chain: name -> (function, names of the nodes it depends on). A
+# function is called as func(gross_incs, sched, *dependencies).
+nodes = {
+    'cpp_parts': (lambda g, s: get_cpp_vec(g, s), []),
+    'CPP': (lambda g, s, parts: parts[0], ['cpp_parts']),
+    'CPP2': (lambda g, s, parts: parts[1], ['cpp_parts']),
+    'EI': (lambda g, s: get_ei_vec(g, s), []),
+
+        ### Federal tax
+    'fed_exempt': (lambda g, s: tune_bpa_vec(g, s['fed_bpa']), []),
+    'fed_taxable': (lambda g, s, cpp: get_taxable_vec(g, cpp, s['fed_cbc']), ['CPP']),
+    'fed_tax': (lambda g, s, cpp, ei, exempt, taxable: fed_tax_node(s, cpp, ei, exempt, taxable),
+                ['CPP', 'EI', 'fed_exempt', 'fed_taxable']),
+
+        ### Provincial tax. The nodes of the rules of the province (like 'due_surtax',
+        ### before the exempt incomes are set to 0, and 'surtax') are added by
+        ### rule_nodes.
+    'prov_exempt': (lambda g, s: tune_bpa_vec(g, s['prov_bpa']), []),
+    'prov_taxable': (lambda g, s, cpp: get_taxable_vec(g, cpp, s['prov_cbc']), ['CPP']),
+    'prov_exempt_mask': (lambda g, s, exempt, taxable: exempt_mask_node(s, exempt, taxable),
+                         ['prov_exempt', 'prov_taxable']),
+    'prov_basic': (lambda g, s, taxable: bracket_tax_vec(taxable, s['prov_thresh'],
+                                                         s['prov_cumul'], s['prov_rate']),
+                   ['prov_taxable']),
+    'prov_tax': (lambda g, s, *deps: prov_tax_node(s, *deps),
+                 ['prov_basic', 'prov_parts', 'CPP', 'EI', 'prov_exempt', 'prov_exempt_mask']),
+
+        ### Totals
+    'total_deduction': (lambda g, s, fed_tax, prov_tax, cpp, ei: fed_tax + prov_tax + cpp + ei,
+                        ['fed_tax', 'prov_tax', 'CPP', 'EI']),
+    'net_income': (lambda g, s, total: g - total, ['total_deduction']),
+}
+
+# The other names of the columns of a result (see result_columns)
+aliases = {'cpp': 'CPP', 'cpp2': 'CPP2', 'ei': 'EI', 'net': 'net_income'}
+
+
+def result_columns():
+    '''
+    Lists the columns of a result: the ones of get_net_vec, with the outputs of the
+    rules registered so far (see prov_rules).
+    '''
+    return ['CPP', 'CPP2', 'EI', 'fed_tax', 'prov_tax'] + prov_rules.outputs() + \
+        ['total_deduction', 'net_income']
+
+
+def rule_nodes(sched):
+    '''
+    Makes the nodes of the rules of the plan of a schedule (see prov_rules) that add to
+    the provincial tax: 'due_<output>' (the amount of a rule, that depends on the
+    amounts of the rules before it) and <output> (0 for the incomes that pay no
+    provincial tax). The outputs of the rules the province does not have are 0.
+    '''
+    graph, before = {}, []
+    for rule, func in prov_rules.hooked(sched, 'prov_tax'):
+        def due(g, s, taxable, basic, *prev, func=func):
+            return func(s, g, taxable, add_parts(basic, prev))
+        graph['due_' + rule['output']] = (due, ['prov_taxable', 'prov_basic'] + before)
+        graph[rule['output']] = (lambda g, s, due, mask: np.where(mask, 0, due),
+                                 ['due_' + rule['output'], 'prov_exempt_mask'])
+        before = before + ['due_' + rule['output']]
+    graph['prov_parts'] = (lambda g, s, *parts: parts, before)
+    for output in prov_rules.outputs():
+        if output not in graph:
+            graph[output] = (lambda g, s: np.zeros(len(g)), [])
+    return graph
+
+
+def add_parts(prov_tax, parts):
+    '''
+    Adds the amounts of rules to the provincial tax, one by one (like get_prov_tax_vec).
+    '''
+    for part in parts:
+        prov_tax = prov_tax + part
+    return prov_tax
+
+
+def fed_tax_node(sched, cpp, ei, fed_exempt, taxable_incs):
+    '''
+    The federal tax (see get_fed_tax_vec) from its memoized parts.
+    '''
+    credit = (ei + sched['fed_cbc'] * cpp + fed_exempt) * sched['fed_credit_rate'] + \
+             sched['employ_credit']
+    fed_tax = bracket_tax_vec(taxable_incs, sched['fed_thresh'], sched['fed_cumul'],
+                              sched['fed_rate'])
+    fed_tax = np.where((fed_tax > credit) & (taxable_incs > fed_exempt), fed_tax - credit, 0)
+    for _, func in prov_rules.hooked(sched, 'fed_tax'):
+        fed_tax = func(sched, fed_tax)
+    return fed_tax
+
+
+def exempt_mask_node(sched, prov_exempt, taxable_incs):
+    '''
+    The incomes that pay no provincial tax (see get_prov_tax_vec).
+    '''
+    exempt = taxable_incs <= prov_exempt
+    for _, func in prov_rules.hooked(sched, 'exempt'):
+        exempt |= func(sched, taxable_incs)
+    return exempt
+
+
+def prov_tax_node(sched, prov_basic, parts, cpp, ei, prov_exempt, exempt):
+    '''
+    The provincial tax (see get_prov_tax_vec) from its memoized parts.
+    '''
+    prov_tax = add_parts(prov_basic, parts)
+    credit = (ei + sched['prov_cbc'] * cpp + prov_exempt) * sched['prov_credit_rate']
+    prov_tax = np.where(prov_tax > credit, prov_tax - credit, 0)
+    return np.where(exempt, 0, prov_tax)
+
+
+class LazyResult:
+    '''
+    The result of lazy_after_tax. It is read like the dictionary of get_net_vec
+    (result['fed_tax']); a column is calculated on its first read.
+    '''
+    def __init__(self, gross_incs, sched):
+        self.gross_incs = gross_incs
+        self.sched = sched
+        self.nodes = {**nodes, **rule_nodes(sched)}
+        self.memo = {}
+
+    def __getitem__(self, name):
+        name = aliases.get(name, name)
+        if name not in self.memo:
+            if name not in self.nodes:
+                raise KeyError(f"{name} is not a column (the columns are \
+{result_columns()}).")
+            func, deps = self.nodes[name]
+            self.memo[name] = func(self.gross_incs, self.sched, *[self[dep] for dep in deps])
+        return self.memo[name]
+
+    def __contains__(self, name):
+        return aliases.get(name, name) in result_columns()
+
+    def keys(self):
+        return result_columns()
+
+    def computed(self):
+        '''
+        Lists the nodes (columns and intermediates) calculated so far.
+        '''
+        return list(self.memo.keys())
+
+    def to_dict(self, names=None):
+        '''
+        Returns the columns (all of them by default) as a dictionary of arrays.
+        '''
+        names = result_columns() if names is None else names
+        return {name: self[name] for name in names}
+
+
+def lazy_after_tax(gross_incs, prov='ON', year=2023):
+    '''
+    Prepares the calculation of the net incomes (and their components) of an array of
+    gross incomes, without calculating anything yet.
+
+    Parameters
+    ----------
+    gross_incs: An array of before_tax incomes.
+    prov: Province.
+    year: Tax year.
+
+    Returns
+    -------
+    result: A LazyResult with the columns of get_net_vec (CPP, CPP2, EI, fed_tax,
+            prov_tax, surtax, health_prem, qpip, total_deduction and net_income, also
+            read as cpp, cpp2, ei and net), not rounded.
+    '''
+    gross_incs, prov, year = clinic(gross_incs, prov, year)
+    return LazyResult(gross_incs.astype(float), load_schedule(prov, year))
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with dataframes
+import pandas as pd
+# To trace the memory allocated by Python (and numpy) objects
+import tracemalloc
+# To mark the stages of a calculation
+import contextlib
+# To measure the time and save the report
+import time
+import json
+import sys
+# To read the peak memory (RSS) of the process (not available on Windows)
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Import required utility functions and constants from util module
+from util import *
+
+##########################################################
+# Opt-in memory profiling of the bulk functions. The functions of tax_calculator mark
+# their stages (copying the dataframe, checking the rows, building the masks of a
+# group, calculating a group, ...) with `with stage(...)`, which does nothing unless a
+# call is made through profile_memory. Then, for every stage, the memory allocated (and
+# still held at the end of the stage), the peak of allocations during the stage, the
+# RSS of the process and, optionally, the lines that allocated the most are recorded.
+# Stages can be nested; a nested stage is named after its parents (like
+# 'calculation/read tables'). The whole call is the stage 'total'. Profiling is meant for one call at a time, in one thread.
+
+# The stages recorded by the running profile_memory call (None when not profiling)
+records = None
+# The stages that are open, innermost last
+open_stages = []
+# Number of allocation sites listed per stage (0 to skip the snapshots)
+top_sites = 5
+
+
+def rss():
+    '''
+    Returns the current resident memory (RSS) of the process in bytes (None if it can
+    not be read on this platform).
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, AttributeError):
+        return None
+
+
+def max_rss():
+    '''
+    Returns the peak resident memory (RSS) of the process so far in bytes (None if it can
+    not be read on this platform).
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def fold_peak():
+    '''
+    Passes the peak traced since the last reset to all the open stages, so a nested
+    stage can reset the peak without losing the peak of its parents.
+    '''
+    _, peak = tracemalloc.get_traced_memory()
+    for opened in open_stages:
+        opened['peak'] = max(opened['peak'], peak)
+
+
+@contextlib.contextmanager
+def stage(name, prov=None, year=None):
+    '''
+    Marks a stage of a calculation (it does nothing if memory is not being profiled).
+
+    Parameters
+    ----------
+    name: Name of the stage.
+    prov: Province of the group the stage works on (if any).
+    year: Tax year of the group the stage works on (if any). Nested stages get the
+          group of their parent.
+    '''
+    if records is None:
+        yield
+        return
+
+    fold_peak()
+    tracemalloc.reset_peak()
+    current, _ = tracemalloc.get_traced_memory()
+        # A nested stage works on the group of its parent
+    if len(open_stages) > 0 and prov is None:
+        prov, year = open_stages[-1]['province'], open_stages[-1]['year']
+        # The names of the parents (but the whole call) make the name of the stage
+    path = open_stages[-1]['path'] + [name] if len(open_stages) > 1 else [name]
+    opened = {'province': prov, 'year': year, 'path': path,
+              'start': current, 'peak': current, 'time': time.time(),
+              'snapshot': tracemalloc.take_snapshot() if top_sites > 0 else None}
+    open_stages.append(opened)
+    try:
+        yield
+    finally:
+        fold_peak()
+        open_stages.pop()
+        current, _ = tracemalloc.get_traced_memory()
+        top = []
+        if opened['snapshot'] is not None:
+            diff = tracemalloc.take_snapshot().compare_to(opened['snapshot'], 'lineno')
+            top = [f"{d.traceback[0].filename}:{d.traceback[0].lineno} {d.size_diff}"
+                   for d in diff[:top_sites] if d.size_diff > 0]
+        records.append({'stage': '/'.join(path),
+                        'province': prov,
+                        'year': None if year is None else int(year),
+                        'allocated': current - opened['start'],
+                        'peak': opened['peak'] - opened['start'],
+                        'rss': rss(),
+                        'max_rss': max_rss(),
+                        'seconds': time.time() - opened['time'],
+                        'top': top})
+
+
+def profile_memory(func, *args, top=5, **kwargs):
+    '''
+    Calls a function (like after_tax_combo or after_tax_combo_bulk) with memory
+    profiling on.
+
+    Parameters
+    ----------
+    func: The function to call.
+    args, kwargs: Its arguments.
+    top: Number of allocation sites listed per stage (0 skips the tracemalloc
+         snapshots, which makes profiling much faster).
+
+    Returns
+    -------
+    result: What the function returns.
+    report: A list of dictionaries, one per stage in the order they ended (the whole
+            call is the last one, named 'total'): stage, province and year (of the
+            group, if any), allocated (bytes still held at the end of the stage), peak
+            (most bytes held at once during the stage, above the start), rss and
+            max_rss (current and peak resident memory of the process at the end of the
+            stage, in bytes), seconds and top (the lines that allocated the most).
+    '''
+    global records, top_sites
+    if records is not None:
+        raise CustomException("Memory is already being profiled.")
+
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    records, top_sites = [], top
+    try:
+        with stage('total'):
+            result = func(*args, **kwargs)
+        report = records
+    finally:
+        records = None
+        open_stages.clear()
+        if started:
+            tracemalloc.stop()
+
+    return result, report
+
+
+def report_table(report, by_group=True):
+    '''
+    Sums up a report per stage (and per province and year).
+
+    Parameters
+    ----------
+    report: See profile_memory.
+    by_group: If False, the groups of a stage are summed up together.
+
+    Returns
+    -------
+    A dataframe: stage (province and year), calls, allocated (total), peak (the largest
+    one), max_rss (the largest one) and seconds (total), sorted by peak.
+    '''
+    df = pd.DataFrame(report).drop(columns='top')
+    keys = ['stage', 'province', 'year'] if by_group else ['stage']
+    table = df.groupby(keys, dropna=False).agg(calls=('allocated', 'size'),
+                                               allocated=('allocated', 'sum'),
+                                               peak=('peak', 'max'),
+                                               max_rss=('max_rss', 'max'),
+                                               seconds=('seconds', 'sum'))
+    return table.reset_index().sort_values('peak', ascending=False, ignore_index=True)
+
+
+def save_report(report, file):
+    '''
+    Saves a report (see profile_memory) as a json file.
+    '''
+    with open(file, 'w') as f:
+        json.dump(report, f, indent=1)
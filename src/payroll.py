@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with arrays
+import numpy as np
+
+# Import required utility functions and constants from util module
+from util import *
+# The vectorized calculations and compiled tax schedules
+from vector_calc import load_schedule, get_net_vec
+
+##########################################################
+# Payroll (per pay period) withholding. Instead of running the annual calculations for
+# every employee at every pay period, a small year-to-date (YTD) state is kept for all
+# employees and every period only adds its own part to it:
+# - CPP, CPP2, EI and QPIP stop once the YTD contributions reach their annual maximums.
+# - The income tax is estimated on the annualized YTD gross income and the part of it
+#   that belongs to the periods paid so far minus what is already withheld is deducted.
+
+ytd_keys = ['gross', 'CPP', 'CPP2', 'EI', 'qpip', 'income_tax', 'annual_tax']
+
+
+def new_ytd_state(n_employees):
+    '''
+    Creates an empty year-to-date state for a number of employees.
+
+    Parameters
+    ----------
+    n_employees: Number of employees (rows of the pay period arrays).
+
+    Returns
+    -------
+    state: A dictionary of arrays (one element per employee): the number of periods
+           paid, YTD gross income, YTD CPP, CPP2, EI, QPIP and income tax deductions,
+           and the last annualized income tax estimate.
+    '''
+    state = {key: np.zeros(n_employees) for key in ytd_keys}
+    state['periods'] = np.zeros(n_employees, dtype=int)
+    return state
+
+
+def payroll_period(gross_pays, provs, year, state, periods_per_year=26):
+    '''
+    Calculates the deductions of one pay period for all employees and adds them to the
+    year-to-date state.
+
+    Parameters
+    ----------
+    gross_pays: An array of gross pays of this period (one element per employee).
+    provs: Province of every employee (an array of abbreviations or a single one for all).
+    year: Tax year.
+    state: The YTD state (see new_ytd_state). It is updated in place.
+    periods_per_year: Number of pay periods in a year (26 for biweekly, 12 for monthly, ...).
+
+    Returns
+    -------
+    deductions: A dictionary of arrays: CPP, CPP2, EI, qpip, income_tax and net_pay of
+                this period.
+    '''
+    gross_pays = np.asarray(gross_pays, dtype=float)
+    n = len(gross_pays)
+    if len(state['periods']) != n:
+        raise CustomException("The number of gross pays must be equal to the number of \
+employees in the year-to-date state.")
+
+    if type(provs) == str:
+        provs = np.full(n, provs.upper())
+    else:
+        provs = np.char.upper(np.asarray(provs, dtype=str))
+
+    deductions = {key: np.zeros(n) for key in ['CPP', 'CPP2', 'EI', 'qpip', 'income_tax']}
+    periods = state['periods'] + 1
+
+    for prov in np.unique(provs):
+        inds = np.flatnonzero(provs == prov)
+        gross, prov, year = clinic(gross_pays[inds], prov, year)
+        sched = load_schedule(prov, year)
+
+        ytd_before = state['gross'][inds]
+        ytd_after = ytd_before + gross
+
+            ### CPP: the basic exemption is spread over the pay periods
+        cpp = (gross - sched['cpp_be'] / periods_per_year) * sched['cpp_rate'] / 100
+        cpp = np.clip(cpp, 0, sched['cpp_max'] - state['CPP'][inds])
+
+            ### CPP2 applies to the part of the YTD earnings between the two thresholds
+        cpp2 = np.zeros(len(inds))
+        if sched['cpp2'] is not None:
+            cpp_thresh1, cpp_thresh2, cpp2_rate = sched['cpp2']
+            cpp2 = (np.clip(ytd_after, cpp_thresh1, cpp_thresh2) -
+                    np.clip(ytd_before, cpp_thresh1, cpp_thresh2)) * cpp2_rate / 100
+
+        ei = np.minimum(gross * sched['ei_rate'] / 100, sched['ei_max'] - state['EI'][inds])
+        ei = np.maximum(ei, 0)
+
+            ### QPIP (as of 2024 only for QC)
+        qpip = np.zeros(len(inds))
+        if sched['qpip'] is not None:
+            qpip_max, qpip_rate = sched['qpip']
+            qpip = np.minimum(gross * qpip_rate / 100,
+                              qpip_max * qpip_rate / 100 - state['qpip'][inds])
+            qpip = np.maximum(qpip, 0)
+
+            ### Income tax: the annual tax of the annualized YTD income, prorated to the
+            ### periods paid so far, minus the tax withheld in the previous periods.
+        annual_gross = ytd_after * periods_per_year / periods[inds]
+        result = get_net_vec(annual_gross, sched)
+        annual_tax = result['fed_tax'] + result['prov_tax'] - result['qpip']
+        income_tax = annual_tax * periods[inds] / periods_per_year - state['income_tax'][inds]
+        income_tax = np.maximum(income_tax, 0)
+
+        deductions['CPP'][inds] = cpp
+        deductions['CPP2'][inds] = cpp2
+        deductions['EI'][inds] = ei
+        deductions['qpip'][inds] = qpip
+        deductions['income_tax'][inds] = income_tax
+        state['annual_tax'][inds] = annual_tax
+
+        ### Update the YTD state
+    state['periods'] = periods
+    state['gross'] += gross_pays
+    for key in ['CPP', 'CPP2', 'EI', 'qpip', 'income_tax']:
+        state[key] += deductions[key]
+
+    deductions['net_pay'] = gross_pays - deductions['CPP'] - deductions['CPP2'] - \
+                            deductions['EI'] - deductions['qpip'] - deductions['income_tax']
+
+    return deductions
+
+
+def payroll_run(pay_periods, provs, year, periods_per_year=26, state=None):
+    '''
+    Streams the pay periods of a year through payroll_period.
+
+    Parameters
+    ----------
+    pay_periods: An iterable of gross pay arrays, one array (of all employees) per period.
+    provs, year, periods_per_year: See payroll_period.
+    state: A YTD state to continue from. If None, a new state is created from the size
+           of the first period.
+
+    Returns
+    -------
+    A generator that yields the deductions (see payroll_period) of every period. To read
+    the YTD state after (or between) periods, pass a state created by new_ytd_state.
+    '''
+    for gross_pays in pay_periods:
+        if state is None:
+            state = new_ytd_state(len(gross_pays))
+        yield payroll_period(gross_pays, provs, year, state, periods_per_year)
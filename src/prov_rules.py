@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with arrays
+import numpy as np
+
+# Import required utility functions and constants from util module
+from util import *
+# The array versions of the rules (imported as a module because vector_calc compiles
+# its schedules with this module)
+import vector_calc
+
+##########################################################
+# Registry of the province specific rules of the vectorized chain (the NB low income
+# phase out, the surtax of ON and PE, the health premium of ON and QC, the QPIP and
+# the federal abatement of QC). A rule declares the columns of the provincial table it
+# needs, how it is compiled into the schedule of a province (the entries it sets, and
+# the ones it leaves when it does not apply) and its array functions, each called at a
+# point (hook) of the chain:
+#     'exempt':   func(sched, taxable_incs) -> the incomes that pay no provincial tax
+#     'prov_tax': func(sched, gross_incs, taxable_incs, prov_tax) -> an amount added to
+#                 the provincial tax (prov_tax is the tax of the brackets plus the
+#                 amounts of the rules before it); it is also returned as the rule's
+#                 output column
+#     'fed_tax':  func(sched, fed_tax) -> the federal tax
+# make_schedule compiles the plan of a province (the rules that apply to it, in the
+# order of the registry) once, so the chain only runs the rules of the plan: a
+# province without a surtax or a health premium does not pay for them. A new credit
+# or levy is added with register_rule, without touching the chain. The compiled
+# kernels (see kernels) and the cents chain (see cents) implement the rules of the
+# tax rate tables themselves, so they only calculate the plans of those rules (see
+# hard_coded).
+
+# The registered rules in the order they are applied, keyed by name
+rules = {}
+
+
+def register_rule(name, columns, compile, off, hooks, output=None):
+    '''
+    Registers a province specific rule (it replaces a rule of the same name).
+
+    Parameters
+    ----------
+    name: Name of the rule.
+    columns: The columns of the provincial table the rule needs. It applies to a
+             province if its table has values in all of them.
+    compile: A function compile(Federal_df, prov_df) that returns the schedule entries
+             of the rule (a dictionary) for a province it applies to.
+    off: The schedule entries of the rule for the provinces it does not apply to.
+    hooks: A dictionary of the array functions of the rule, keyed by hook ('exempt',
+           'prov_tax' or 'fed_tax', see above).
+    output: The column of get_net_vec of a 'prov_tax' rule (like 'surtax').
+    '''
+    unknown = [hook for hook in hooks if hook not in ['exempt', 'prov_tax', 'fed_tax']]
+    if len(unknown) > 0:
+        raise CustomException(f"Unknown hooks {unknown} for the rule {name}.")
+    if 'prov_tax' in hooks and output is None:
+        raise CustomException(f"The rule {name} adds to the provincial tax, it needs an \
+output column.")
+    rules[name] = {'columns': columns, 'compile': compile, 'off': off, 'hooks': hooks,
+                   'output': output}
+        # The schedules (and everything built from them) were compiled with the rules
+        # as they were
+    clear_derived()
+
+
+def applies(rule, prov_df):
+    '''
+    Checks if a rule applies to a province: its table has values in all the columns of
+    the rule.
+    '''
+    return all(column in prov_df and levels(prov_df)[column] > 0 for column in rule['columns'])
+
+
+def compile_plan(Federal_df, prov_df):
+    '''
+    Compiles the rules of a province.
+
+    Parameters
+    ----------
+    Federal_df: The federal tax information dataframe.
+    prov_df: The provincial tax information dataframe.
+
+    Returns
+    -------
+    entries: The schedule entries of all the rules (the compiled ones of the rules that
+             apply, the off ones of the others).
+    plan: A tuple of the names of the rules that apply, in the order of the registry.
+    '''
+    entries, plan = {}, []
+    for name, rule in rules.items():
+        if applies(rule, prov_df):
+            entries.update(rule['compile'](Federal_df, prov_df))
+            plan.append(name)
+        else:
+            entries.update(rule['off'])
+    return entries, tuple(plan)
+
+
+def hooked(sched, hook):
+    '''
+    Lists the rules of the plan of a schedule that have a hook, as (rule, function).
+    '''
+    return [(rules[name], rules[name]['hooks'][hook]) for name in sched['plan']
+            if hook in rules[name]['hooks']]
+
+
+def hard_coded(plan):
+    '''
+    Checks if the compiled kernels and the cents chain, which implement the rules of the
+    tax rate tables themselves, can calculate a plan: those rules are registered as this
+    module defines them and the plan has no other rule.
+    '''
+    return all(rules.get(name) is rule for name, rule in table_rules.items()) and \
+        all(name in table_rules for name in plan)
+
+
+def outputs():
+    '''
+    Lists the output columns of the registered 'prov_tax' rules.
+    '''
+    return [rule['output'] for rule in rules.values() if rule['output'] is not None]
+
+
+#########
+# The rules of the tax rate tables
+
+
+def phase_out_exempt(sched, taxable_incs):
+        # As of 2024, only NB: incomes below the threshold pay no provincial tax
+    return taxable_incs < sched['phase_out']
+
+
+register_rule('phase_out', ['phase_out'],
+              compile=lambda Federal_df, prov_df: {'phase_out': prov_df['phase_out'][0]},
+              off={'phase_out': None},
+              hooks={'exempt': phase_out_exempt})
+
+
+def surtax_amount(sched, gross_incs, taxable_incs, prov_tax):
+        # As of 2024, ON (2 levels) and PE, on the tax of the brackets
+    surtax = np.zeros(len(prov_tax))
+    for thresh, rate in zip(sched['surtax_thresh'], sched['surtax_rate']):
+        surtax += (prov_tax - thresh) * rate
+    return np.where(prov_tax > sched['surtax_thresh'][0], surtax, 0)
+
+
+def compile_surtax(Federal_df, prov_df):
+    surtax_levels = levels(prov_df)['surtax_rate']
+    return {'surtax_thresh': prov_df['surtax_thresh'].values[:surtax_levels].astype(float),
+            'surtax_rate': prov_df['surtax_rate'].values[:surtax_levels].astype(float) / 100}
+
+
+register_rule('surtax', ['surtax_rate', 'surtax_thresh'], compile=compile_surtax,
+              off={'surtax_thresh': np.array([]), 'surtax_rate': np.array([])},
+              hooks={'prov_tax': surtax_amount}, output='surtax')
+
+
+def compile_health_prem(Federal_df, prov_df):
+        # Rates and limits are padded by a NaN so that the row after the last threshold
+        # can always be indexed (NaN limit means no cap).
+    return {'health_thresh': prov_df['health_prem_thresh'].dropna().values.astype(float),
+            'health_rate': np.append(prov_df['health_prem_rate'].values.astype(float), np.nan),
+            'health_limit': np.append(prov_df['health_prem_limit'].values.astype(float), np.nan)}
+
+
+register_rule('health_prem', ['health_prem_thresh', 'health_prem_rate', 'health_prem_limit'],
+              compile=compile_health_prem, off={'health_thresh': None},
+              hooks={'prov_tax': lambda sched, gross_incs, taxable_incs, prov_tax:
+                     vector_calc.get_health_prem_vec(taxable_incs, sched)},
+              output='health_prem')
+
+
+register_rule('qpip', ['QPIP'],
+              compile=lambda Federal_df, prov_df: {'qpip': (prov_df['QPIP'][0],
+                                                            prov_df['QPIP'][1])},
+              off={'qpip': None},
+              hooks={'prov_tax': lambda sched, gross_incs, taxable_incs, prov_tax:
+                     vector_calc.get_qpip_vec(gross_incs, sched)},
+              output='qpip')
+
+
+def compile_fed_abatement(Federal_df, prov_df):
+        # As of 2024, only QC: the federal tax is abated and the provincial credit uses
+        # the CPP rates of QC
+    return {'fed_abatement': prov_df['fed_abatement'][0] / 100,
+            'prov_cbc': Federal_df['CPP_rate'][3] / Federal_df['CPP_rate'][2]}
+
+
+register_rule('fed_abatement', ['fed_abatement'], compile=compile_fed_abatement,
+              off={'fed_abatement': 0.},
+              hooks={'fed_tax': lambda sched, fed_tax: fed_tax * (1 - sched['fed_abatement'])})
+
+# The rules of the tax rate tables, as defined above (see hard_coded)
+table_rules = dict(rules)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with dataframes
+import pandas as pd
+# To work with arrays
+import numpy as np
+# To keep the results in a local database file
+import sqlite3
+# To work with files and fingerprints
+import os
+import hashlib
+# To measure the time the calculations take
+import time
+
+# Import required utility functions and constants from util module
+from util import *
+from tax_calculator import before_after_inc_bulk, before_tax_vec
+import vector_calc
+import cents
+
+##########################################################
+# Persistent cache of the combo results. Every calculated (year, province, income) is
+# saved in a SQLite file, so the next batch over (mostly) the same population only
+# calculates the rows that are not in the cache yet. Results of a year are kept with
+# the fingerprint of the files they were calculated from (the tax rate csv files and,
+# for before_tax, the polynomials) and are dropped as soon as one of those changes.
+# Results are also keyed by the engine that calculated them (the backend of
+# after_tax_vec, or the integer cents mode and its rounding), so the results of an
+# engine are never served for another one. The tables (and polynomials) of a year whose
+# files have changed are also read again before anything is calculated from them.
+
+cache_file = '../data/cache/results.sqlite'
+
+# The function that calculates each kind of result (see engine)
+cache_funcs = {'after_tax': vector_calc.after_tax_vec, 'before_tax': before_tax_vec}
+cents_funcs = {'after_tax': cents.after_tax_cents, 'before_tax': cents.before_tax_cents}
+# The fingerprint of the files the tables of this process were read from, keyed by
+# (kind, year) (see invalidate)
+seen_fingerprints = {}
+
+
+def open_cache(file=None):
+    '''
+    Opens (and creates, if needed) the cache database.
+
+    Parameters
+    ----------
+    file: The SQLite file (cache_file by default).
+
+    Returns
+    -------
+    con: A sqlite3 connection.
+    '''
+    file = cache_file if file is None else file
+    if os.path.dirname(file) != '':
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+
+    con = sqlite3.connect(file)
+        # Caches made before the results were keyed by engine are emptied
+    columns = [row[1] for row in con.execute("PRAGMA table_info(results)")]
+    if len(columns) > 0 and 'engine' not in columns:
+        con.execute("DROP TABLE results")
+    con.execute("""CREATE TABLE IF NOT EXISTS results (kind TEXT, engine TEXT,
+                   year INTEGER, province TEXT, income REAL, value REAL,
+                   PRIMARY KEY (kind, engine, year, province, income))""")
+    con.execute("""CREATE TABLE IF NOT EXISTS fingerprints (kind TEXT, year INTEGER,
+                   fingerprint TEXT, PRIMARY KEY (kind, year))""")
+    con.execute("""CREATE TABLE IF NOT EXISTS timings (kind TEXT PRIMARY KEY,
+                   seconds_per_row REAL)""")
+    return con
+
+
+def data_fingerprint(kind, year):
+    '''
+    Calculates one fingerprint of all the files the results of a kind and year depend
+    on.
+
+    Parameters
+    ----------
+    kind: 'after_tax' or 'before_tax'.
+    year: Tax year.
+
+    Returns
+    -------
+    A hash (string).
+    '''
+    hashes = list(rates_fingerprints(year).values())
+    if kind == 'before_tax':
+        file = '../data/tax_rates_' + str(year) + '/polynomials-' + str(year) + '.csv'
+        hashes.append(file_hash(file) if os.path.isfile(file) else '')
+    return hashlib.sha256(''.join(hashes).encode()).hexdigest()
+
+
+def engine(kind, rounding=None):
+    '''
+    Returns the engine of a kind of results: its name (a part of the cache key) and the
+    function that calculates it.
+
+    Parameters
+    ----------
+    kind: 'after_tax' or 'before_tax'.
+    rounding: None for the float path (after_tax_vec with the selected backend, see
+              vector_calc.set_backend, or before_tax_vec), or the rounding of the
+              integer cents mode (see cents.roundings).
+
+    Returns
+    -------
+    name: Like 'numpy', 'numba', 'segments', 'polynomial' or 'cents-half_even'.
+    func: The function, called as func(incs, prov, year).
+    '''
+    if rounding is not None:
+        if rounding not in cents.roundings:
+            raise CustomException(f"rounding must be one of {cents.roundings} or None.")
+        return 'cents-' + rounding, \
+            lambda incs, prov, year: cents_funcs[kind](incs, prov, year, rounding)
+    name = vector_calc.backend if kind == 'after_tax' else 'polynomial'
+    return name, cache_funcs[kind]
+
+
+def invalidate(con, kind, years):
+    '''
+    Drops the cached results of the years whose files have changed since they were
+    calculated, and reads the tables (and, for before_tax, the polynomials) of the years
+    whose files have changed since this process read them, so the misses are not
+    calculated from the old rates.
+
+    Parameters
+    ----------
+    con: The cache connection.
+    kind: 'after_tax' or 'before_tax'.
+    years: The years to check.
+    '''
+    for year in years:
+        fingerprint = data_fingerprint(kind, year)
+        if seen_fingerprints.get((kind, year)) != fingerprint:
+                # Reading the tables again also empties the caches derived from them
+            read_tables(year, refresh=True)
+            if kind == 'before_tax':
+                year_polys.pop(year, None)
+            seen_fingerprints[(kind, year)] = fingerprint
+        saved = con.execute("SELECT fingerprint FROM fingerprints WHERE kind=? AND year=?",
+                            (kind, year)).fetchone()
+        if saved is None or saved[0] != fingerprint:
+            con.execute("DELETE FROM results WHERE kind=? AND year=?", (kind, year))
+            con.execute("INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?)",
+                        (kind, year, fingerprint))
+    con.commit()
+
+
+def cached_combo(df, kind, file=None, rounding=None):
+    '''
+    Calculates the combos of a dataframe like after_tax_combo_bulk (or
+    before_tax_combo_bulk) but only for the rows that are not in the cache.
+
+    Parameters
+    ----------
+    df: A dataframe of combos of income, province and year (the first 3 columns).
+    kind: 'after_tax' or 'before_tax'.
+    file: The SQLite file (cache_file by default).
+    rounding: None, or the rounding of the integer cents mode (see engine).
+
+    Returns
+    -------
+    df_copy: The same dataframe with two added columns: the result (named as kind) and
+             error_code (see tax_calculator.err_codes).
+    stats: A dictionary: number of rows, hits, misses, hit_rate and time_saved (an
+           estimate in seconds, based on the time the misses took per row).
+    '''
+    if kind not in cache_funcs:
+        raise CustomException(f"kind must be one of {list(cache_funcs.keys())}.")
+    name, func = engine(kind, rounding)
+
+    df_copy = df.copy()
+    n = len(df_copy)
+    incs = pd.to_numeric(df_copy.iloc[:, 0], errors='coerce').to_numpy(dtype=float)
+    provs = df_copy.iloc[:, 1].astype(str).str.upper().to_numpy()
+    years = pd.to_numeric(df_copy.iloc[:, 2], errors='coerce').to_numpy(dtype=float)
+
+    con = open_cache(file)
+    valid_years = [int(year) for year in np.unique(years[np.isin(years, available_years())])]
+    invalidate(con, kind, valid_years)
+
+        ### Look all rows up at once through a temporary table
+    results = np.full(n, np.nan)
+    con.execute("CREATE TEMP TABLE lookup (pos INTEGER, year INTEGER, province TEXT, \
+income REAL)")
+    con.executemany("INSERT INTO lookup VALUES (?, ?, ?, ?)",
+                    zip(range(n), np.nan_to_num(years).astype(int).tolist(),
+                        provs.tolist(), incs.tolist()))
+    found = con.execute("""SELECT lookup.pos, results.value FROM lookup JOIN results
+                           ON results.kind = ? AND results.engine = ?
+                           AND results.year = lookup.year
+                           AND results.province = lookup.province
+                           AND results.income = lookup.income""", (kind, name)).fetchall()
+    con.execute("DROP TABLE lookup")
+    if len(found) > 0:
+        found = np.array(found)
+        results[found[:, 0].astype(int)] = found[:, 1]
+
+    errors = np.zeros(n, dtype=np.int8)
+    hits = ~np.isnan(results)
+
+        ### Calculate the misses and save the valid ones
+    misses = np.flatnonzero(~hits)
+    seconds_per_row = None
+    if len(misses) > 0:
+        start = time.time()
+        derived_incs, errors[misses], _ = before_after_inc_bulk(df_copy.iloc[misses],
+                                                                func)
+        seconds_per_row = (time.time() - start) / len(misses)
+        results[misses] = derived_incs
+
+        new = misses[errors[misses] == 0]
+        con.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                        zip([kind] * len(new), [name] * len(new),
+                            years[new].astype(int).tolist(), provs[new].tolist(),
+                            incs[new].tolist(), results[new].tolist()))
+        con.execute("INSERT OR REPLACE INTO timings VALUES (?, ?)", (kind, seconds_per_row))
+        con.commit()
+    else:
+        saved = con.execute("SELECT seconds_per_row FROM timings WHERE kind=?",
+                            (kind,)).fetchone()
+        seconds_per_row = saved[0] if saved is not None else 0
+    con.close()
+
+    df_copy[kind] = results
+    df_copy['error_code'] = errors
+
+    stats = {'rows': n,
+             'hits': int(hits.sum()),
+             'misses': len(misses),
+             'hit_rate': float(hits.sum() / n) if n > 0 else 0.,
+             'time_saved': float(hits.sum() * seconds_per_row)}
+
+    return df_copy, stats
+
+
+def after_tax_combo_cached(df, file=None, rounding=None):
+    '''
+    Cached after_tax_combo (see cached_combo).
+    '''
+    return cached_combo(df, 'after_tax', file, rounding)
+
+
+def before_tax_combo_cached(df, file=None, rounding=None):
+    '''
+    Cached before_tax_combo (see cached_combo).
+    '''
+    return cached_combo(df, 'before_tax', file, rounding)
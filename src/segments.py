@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with dataframes
+import pandas as pd
+# To work with arrays
+import numpy as np
+# To build the tables once when several threads ask for them
+import threading
+
+# Import required utility functions and constants from util module
+from util import *
+# The vectorized net income chain (imported as a module because vector_calc uses this
+# module as one of its backends)
+import vector_calc
+
+##########################################################
+# Between its kinks (tax thresholds, CPP and EI maximums, bpa phase-out bounds, surtax
+# and health premium crossings, ...) the net income is a linear function of the gross
+# income. A segment table stores, for a province and year, the gross incomes where the
+# kinks are (breaks) and the slope and intercept of the net income on each segment, so
+# that net = slope[i] * gross + intercept[i] where breaks[i] <= gross < breaks[i + 1].
+
+# Segment tables built in this process, keyed by (province, year, column). Like
+# schedules, they are read-only and shared by all threads.
+segment_tables = {}
+segment_tables_lock = threading.Lock()
+derived_caches.append(segment_tables)
+
+
+def known_breaks(sched, max_income):
+    '''
+    Lists the gross incomes where the net income is known to have a kink: the ones
+    directly given in the schedule and the tax thresholds (that are on taxable incomes)
+    converted to gross incomes.
+
+    Parameters
+    ----------
+    sched: A schedule (see vector_calc.make_schedule).
+    max_income: The largest gross income of the table.
+
+    Returns
+    -------
+    A sorted array of gross incomes.
+    '''
+    cpp_max_inc = sched['cpp_be'] + sched['cpp_max'] * 100 / sched['cpp_rate']
+    breaks = [sched['cpp_be'], cpp_max_inc, sched['ei_max'] * 100 / sched['ei_rate']]
+    cpp_breaks = [0, sched['cpp_be'], cpp_max_inc, max_income]
+    if sched['cpp2'] is not None:
+        breaks += list(sched['cpp2'][:2])
+        cpp_breaks += list(sched['cpp2'][:2])
+    if sched['qpip'] is not None:
+        breaks.append(sched['qpip'][0])
+
+    for level in ['fed', 'prov']:
+        _, low, high, slope = sched[level + '_bpa']
+        if slope != 0:
+            breaks += [low, high]
+
+            # Taxable income is a piecewise linear (and increasing) function of the
+            # gross income with kinks only where CPP has kinks, so it can be inverted
+            # by interpolation.
+        gross = np.unique(cpp_breaks)
+        cpp, _ = vector_calc.get_cpp_vec(gross, sched)
+        taxable = vector_calc.get_taxable_vec(gross, cpp, sched[level + '_cbc'])
+        taxable_breaks = list(sched[level + '_thresh'][1:])
+        if level == 'prov':
+            if sched['health_thresh'] is not None:
+                taxable_breaks += list(sched['health_thresh'])
+            if sched['phase_out'] is not None:
+                taxable_breaks.append(sched['phase_out'])
+        breaks += list(np.interp(taxable_breaks, taxable, gross))
+
+    breaks = np.unique(np.array(breaks, dtype=float))
+    return breaks[(breaks > 0) & (breaks < max_income)]
+
+
+def build_segments(sched, max_income=5000000, tol=1e-6, column='net_income'):
+    '''
+    Builds the segment table of a schedule (of the net income, or of another column of
+    vector_calc.get_net_vec, like fed_tax or CPP). Starting from the known breaks, every
+    interval is checked to be linear (on three inner points) and is split in two until
+    it is, so the kinks that are not known in advance (like the income where the
+    provincial tax reaches the surtax threshold) are found too.
+
+    Parameters
+    ----------
+    sched: A schedule (see vector_calc.make_schedule).
+    max_income: The last break. Above it the net income is linear (all kinks are
+                far below), so the last segment is used for all higher incomes.
+    tol: The precision (in dollars) at which a kink is located.
+    column: The column of get_net_vec the table is built for.
+
+    Returns
+    -------
+    table: A dictionary of three arrays: breaks (the first one is 0), slope and
+           intercept.
+    '''
+    def net(gross_incs):
+        return vector_calc.get_net_vec(gross_incs, sched)[column]
+
+    eps = tol / 4
+    fracs = np.array([0.211, 0.5, 0.789])
+
+    def line(lows, highs):
+            # The line through two points just inside the intervals, and whether the
+            # inner points of the intervals are on it
+        x0, x1 = lows + eps, highs - eps
+        y0, y1 = net(x0), net(x1)
+        slope = (y1 - y0) / (x1 - x0)
+        intercept = y0 - slope * x0
+        xs = lows[:, None] + (highs - lows)[:, None] * fracs
+        ys = net(xs.ravel()).reshape(xs.shape)
+        linear = np.all(np.abs(ys - (slope[:, None] * xs + intercept[:, None])) < 1e-6, axis=1)
+        return slope, intercept, linear
+
+    knots = np.concatenate(([0.], known_breaks(sched, max_income), [max_income]))
+    lows, highs = knots[:-1], knots[1:]
+
+    segs = []
+    while len(lows) > 0:
+        _, _, linear = line(lows, highs)
+        done = linear | (highs - lows < tol)
+        segs.append(np.stack([lows[done], highs[done]], axis=1))
+
+        mids = (lows[~done] + highs[~done]) / 2
+        lows, highs = np.concatenate((lows[~done], mids)), np.concatenate((mids, highs[~done]))
+
+    segs = np.concatenate(segs)
+    segs = segs[np.argsort(segs[:, 0])]
+
+        ### Splitting leaves many neighbour segments on the same line (and tiny ones
+        ### around the kinks), so join every segment to the previous one as long as
+        ### the joined interval is still linear.
+    merged = [list(segs[0])]
+    for low, high in segs[1:]:
+        _, _, linear = line(np.array([merged[-1][0]]), np.array([high]))
+        if linear[0]:
+            merged[-1][1] = high
+        else:
+            merged.append([low, high])
+
+    merged = np.array(merged)
+    slope, intercept, _ = line(merged[:, 0], merged[:, 1])
+    return vector_calc.freeze({'breaks': merged[:, 0], 'slope': slope, 'intercept': intercept})
+
+
+def load_segments(prov, year, column='net_income'):
+    '''
+    Returns the segment table of a province for a year (it is built on the first call).
+
+    Parameters
+    ----------
+    prov: Province.
+    year: Tax year.
+    column: The column of vector_calc.get_net_vec (the net income by default).
+
+    Returns
+    -------
+    table: See build_segments.
+    '''
+    key = (prov.upper(), year, column)
+    if key not in segment_tables:
+        with segment_tables_lock:
+            if key not in segment_tables:
+                segment_tables[key] = build_segments(vector_calc.load_schedule(prov, year),
+                                                     column=column)
+    return segment_tables[key]
+
+
+def segments_net(gross_incs, table):
+    '''
+    Calculates the (not rounded) net incomes of an array of gross incomes from a
+    segment table: one searchsorted and one multiply-add per income.
+
+    Parameters
+    ----------
+    gross_incs: An array of gross incomes.
+    table: A segment table (see build_segments).
+
+    Returns
+    -------
+    An array of net incomes.
+    '''
+    inds = np.searchsorted(table['breaks'], gross_incs, side='right') - 1
+    inds = np.maximum(inds, 0)
+    return table['slope'][inds] * gross_incs + table['intercept'][inds]
+
+
+def segments_integral(gross_incs, table):
+    '''
+    Calculates the exact integral of the piecewise linear function of a segment table
+    from 0 to every gross income (the function is 0 below 0).
+
+    Parameters
+    ----------
+    gross_incs: An array of gross incomes.
+    table: A segment table (see build_segments).
+
+    Returns
+    -------
+    An array of integrals (in dollars times dollars).
+    '''
+    breaks, slope, intercept = table['breaks'], table['slope'], table['intercept']
+        # The integral of every whole segment, summed up to every break
+    widths = np.diff(breaks)
+    whole = slope[:-1] * (breaks[1:] ** 2 - breaks[:-1] ** 2) / 2 + intercept[:-1] * widths
+    cumul = np.concatenate(([0.], np.cumsum(whole)))
+
+    gross_incs = np.maximum(np.asarray(gross_incs, dtype=float), 0)
+    inds = np.maximum(np.searchsorted(breaks, gross_incs, side='right') - 1, 0)
+    low = breaks[inds]
+    return cumul[inds] + slope[inds] * (gross_incs ** 2 - low ** 2) / 2 + \
+        intercept[inds] * (gross_incs - low)
+
+
+def check_segments(table, prov, year):
+    '''
+    Compares a segment table with the reference chain (get_net, one income at a time)
+    one dollar before and after every break.
+
+    Parameters
+    ----------
+    table: A segment table (see build_segments).
+    prov: Province of the table.
+    year: Tax year of the table.
+
+    Returns
+    -------
+    The largest absolute difference (in dollars) of the rounded net incomes.
+    '''
+        # tax_calculator uses this module (through vector_calc), so it is imported here
+    from tax_calculator import get_net
+    tables = read_tables(year)
+    gross_incs = np.concatenate((table['breaks'] - 1, table['breaks'] + 1))
+    gross_incs = gross_incs[gross_incs > 0]
+    expected = np.array([get_net(gross_inc, tables['Federal'], prov, tables[prov])
+                         for gross_inc in gross_incs])
+    return np.abs(np.round(segments_net(gross_incs, table)) - expected).max()
+
+
+def save_segments(year, provs=provinces):
+    '''
+    Saves the segment tables of the provinces for a year in one csv file
+    (segments-<year>.csv, next to polynomials-<year>.csv).
+
+    Parameters
+    ----------
+    year: Tax year.
+    provs: The provinces to save (all by default).
+    '''
+    tables = []
+    for prov in provs:
+        table = pd.DataFrame(load_segments(prov, year))
+        table.insert(0, 'province', prov)
+        tables.append(table)
+
+    file = '../data/tax_rates_' + str(year) + '/segments-' + str(year) + '.csv'
+    pd.concat(tables).to_csv(file, index=False)
+    print(f"The segment tables for year {year} are successfully saved in {file}.")
+
+
+def read_segments(year):
+    '''
+    Reads the segment tables saved by save_segments and makes them the tables used by
+    this process for that year.
+
+    Parameters
+    ----------
+    year: Tax year.
+
+    Returns
+    -------
+    A dictionary of segment tables keyed by province.
+    '''
+    file = '../data/tax_rates_' + str(year) + '/segments-' + str(year) + '.csv'
+    seg_df = pd.read_csv(file)
+    tables = {}
+    for prov, table in seg_df.groupby('province'):
+        tables[prov] = vector_calc.freeze({column: table[column].to_numpy() for column in
+                                           ['breaks', 'slope', 'intercept']})
+        with segment_tables_lock:
+            segment_tables[(prov, year, 'net_income')] = tables[prov]
+    return tables
+
+
+def raise_deltas(base_incs, increments, prov='ON', year=2023):
+    '''
+    Calculates what raises (or bonuses) add to the net incomes of employees, for several
+    scenarios at once. The segment of every base income is found once; an increment
+    that keeps the income on the same segment is a single multiply-add, and only the
+    incomes that move past a break are looked up again.
+
+    Parameters
+    ----------
+    base_incs: An array of base gross incomes (one per employee).
+    increments: An array of increments (raises or bonuses) in dollars, either one per
+                scenario (the same for all employees) or a matrix with one row per
+                employee and one column per scenario.
+    prov: Province.
+    year: Tax year.
+
+    Returns
+    -------
+    result: A dictionary of arrays:
+            base_net: The after_tax incomes of the base incomes (like after_tax_vec).
+            net: The after_tax incomes after the increments (employees x scenarios).
+            delta: What the increments add to the (rounded) net incomes.
+            marginal_rate: The effective tax rate on the increments: the part of them
+                           that goes to taxes and contributions (NaN if the increment is
+                           0).
+    '''
+    base_incs, prov, year = clinic(np.asarray(base_incs), prov, year)
+    increments = np.asarray(increments, dtype=float)
+    if increments.ndim == 1:
+        increments = np.broadcast_to(increments, (len(base_incs), len(increments)))
+    if increments.ndim != 2 or increments.shape[0] != len(base_incs):
+        raise CustomException("increments must be an array of one increment per scenario \
+or a matrix of one row per base income.")
+
+    table = load_segments(prov, year)
+    breaks, slope, intercept = table['breaks'], table['slope'], table['intercept']
+
+    base_incs = base_incs.astype(float)
+    inds = np.maximum(np.searchsorted(breaks, base_incs, side='right') - 1, 0)
+    base_net = np.where(base_incs <= 0, 0, slope[inds] * base_incs + intercept[inds])
+
+        ### Broadcast the segment of every base income over the scenarios, and look up
+        ### again only the new incomes that are out of it
+    new_incs = base_incs[:, None] + increments
+    new_inds = np.broadcast_to(inds[:, None], new_incs.shape).copy()
+    upper = np.append(breaks[1:], np.inf)[new_inds]
+    moved = (new_incs < breaks[new_inds]) | (new_incs >= upper)
+    new_inds[moved] = np.maximum(np.searchsorted(breaks, new_incs[moved], side='right') - 1, 0)
+    net = np.where(new_incs <= 0, 0, slope[new_inds] * new_incs + intercept[new_inds])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        marginal_rate = np.where(increments != 0,
+                                 1 - (net - base_net[:, None]) / increments, np.nan)
+    base_net, net = np.round(base_net), np.round(net)
+
+    return {'base_net': base_net, 'net': net, 'delta': net - base_net[:, None],
+            'marginal_rate': marginal_rate}
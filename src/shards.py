@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with dataframes
+import pandas as pd
+# To work with arrays
+import numpy as np
+# To work with files, the manifest and the worker processes
+import os
+import json
+import time
+import socket
+import multiprocessing
+# To run the steps from the command line of every node
+import argparse
+
+# Import required utility functions and constants from util module
+from util import *
+from tax_calculator import after_tax_combo_bulk, before_tax_combo_bulk, err_codes
+
+##########################################################
+# Sharded runner for very large combo files. The input is cut into row ranges and every
+# range into its (province, year) groups; each piece (a shard) is written to a shared
+# directory and listed in a manifest. Any number of workers, on this machine or on
+# other nodes that see the same directory, then claim shards one by one and write their
+# results, and a final merge puts all the results back in the order of the input.
+# The directory looks like:
+#     manifest.json      the shards and the settings of the run
+#     input/<id>.csv     the rows of a shard (with their position in the input file)
+#     claims/<id>        the worker that is working on a shard and since when
+#     output/<id>.csv    the result of a shard
+# Every file is written to a temporary name first and then renamed, so a worker that
+# dies never leaves a half written shard behind. A claim that is older than the lease
+# is considered abandoned and the shard is processed again, and processing a shard
+# twice gives the same output, so the run can be retried (or resumed) at any time.
+
+shard_funcs = {'after_tax': after_tax_combo_bulk, 'before_tax': before_tax_combo_bulk}
+
+
+def write_atomic(write, file):
+    '''
+    Calls write(temp_file) and then renames the temporary file to file.
+    '''
+    tmp = f"{file}.{socket.gethostname()}-{os.getpid()}.tmp"
+    write(tmp)
+    os.replace(tmp, file)
+
+
+def make_shards(input_file, shard_dir, kind='after_tax', rows_per_range=1000000):
+    '''
+    Splits a combo file into shards and writes the manifest. If the directory already
+    has the manifest of the same input, nothing is done (so it can be called again by
+    a retried job).
+
+    Parameters
+    ----------
+    input_file: A csv file of combos of income, province and year (the first 3 columns).
+    shard_dir: The shared directory of the run.
+    kind: 'after_tax' or 'before_tax'.
+    rows_per_range: Number of input rows per range (the input is read range by range,
+                    so it never has to fit in memory).
+
+    Returns
+    -------
+    manifest: A dictionary: input (file, size and modification time), kind, rows,
+              ranges (number of rows of every range) and shards (id, range, province,
+              year and rows of every shard).
+    '''
+    if kind not in shard_funcs:
+        raise CustomException(f"kind must be one of {list(shard_funcs.keys())}.")
+
+    stat = os.stat(input_file)
+    source = {'file': os.path.abspath(input_file), 'size': stat.st_size,
+              'mtime': stat.st_mtime}
+    manifest = read_manifest(shard_dir)
+    if manifest is not None:
+        if manifest['input'] == source and manifest['kind'] == kind:
+            return manifest
+        raise CustomException(f"{shard_dir} already has the shards of another input or \
+kind, use a new directory.")
+
+    for folder in ['input', 'claims', 'output']:
+        os.makedirs(os.path.join(shard_dir, folder), exist_ok=True)
+
+    shards, ranges = [], []
+    start = 0
+    for part, chunk in enumerate(pd.read_csv(input_file, chunksize=rows_per_range)):
+        chunk.insert(0, 'row', np.arange(start, start + len(chunk)))
+        start += len(chunk)
+        ranges.append(len(chunk))
+
+            # Invalid provinces and years get their own groups too, the error codes are
+            # set by the workers
+        provs = chunk.iloc[:, 2].astype(str).str.upper()
+        years = chunk.iloc[:, 3].astype(str)
+        groups = chunk.groupby([provs, years], sort=True, dropna=False)
+        for g, ((prov, year), group) in enumerate(groups):
+            shard_id = f"{part:05d}-{g:03d}"
+            write_atomic(lambda tmp: group.to_csv(tmp, index=False),
+                         os.path.join(shard_dir, 'input', shard_id + '.csv'))
+            shards.append({'id': shard_id, 'range': part, 'province': prov, 'year': year,
+                           'rows': len(group)})
+
+    manifest = {'input': source, 'kind': kind, 'rows': start, 'ranges': ranges,
+                'shards': shards}
+
+        # The manifest is written last: workers only start once all shards are there
+    def write(tmp):
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+    write_atomic(write, os.path.join(shard_dir, 'manifest.json'))
+
+    return manifest
+
+
+def read_manifest(shard_dir):
+    '''
+    Reads the manifest of a run (None if there is none yet).
+    '''
+    file = os.path.join(shard_dir, 'manifest.json')
+    if not os.path.isfile(file):
+        return None
+    with open(file) as f:
+        return json.load(f)
+
+
+def claim(shard_dir, shard_id, lease):
+    '''
+    Tries to claim a shard for this worker.
+
+    Parameters
+    ----------
+    shard_dir: The shared directory of the run.
+    shard_id: The shard.
+    lease: Age (in seconds) after which the claim of another worker is abandoned.
+
+    Returns
+    -------
+    True if the shard is claimed by this worker.
+    '''
+    file = os.path.join(shard_dir, 'claims', shard_id)
+    owner = f"{socket.gethostname()} {os.getpid()} {time.time()}"
+    for attempt in range(2):
+        try:
+                # Creating the file fails if it exists, so only one worker gets it
+            fd = os.open(file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                age = time.time() - os.path.getmtime(file)
+            except FileNotFoundError:
+                continue
+            if attempt > 0 or age < lease:
+                return False
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+            continue
+        with os.fdopen(fd, 'w') as f:
+            f.write(owner)
+        return True
+    return False
+
+
+def run_worker(shard_dir, lease=3600, wait=60):
+    '''
+    Processes the shards of a run until none is left. Several workers (on any node that
+    sees the shared directory) can run at the same time.
+
+    Parameters
+    ----------
+    shard_dir: The shared directory of the run.
+    lease: Age (in seconds) after which a claimed shard with no output is processed
+           again (its worker is considered dead). It must be longer than the time a
+           shard takes.
+    wait: Seconds to wait for the manifest to appear.
+
+    Returns
+    -------
+    done: Number of shards processed by this worker.
+    '''
+    manifest = read_manifest(shard_dir)
+    while manifest is None and wait > 0:
+        time.sleep(1)
+        wait -= 1
+        manifest = read_manifest(shard_dir)
+    if manifest is None:
+        raise CustomException(f"There is no manifest in {shard_dir}.")
+
+    func = shard_funcs[manifest['kind']]
+    done = 0
+    for shard in manifest['shards']:
+        out_file = os.path.join(shard_dir, 'output', shard['id'] + '.csv')
+        if os.path.isfile(out_file) or not claim(shard_dir, shard['id'], lease):
+            continue
+            # Another worker may have finished it between the check and the claim
+        if os.path.isfile(out_file):
+            continue
+
+        df = pd.read_csv(os.path.join(shard_dir, 'input', shard['id'] + '.csv'))
+        rows = df.pop('row')
+        df_result, _ = func(df)
+        df_result.insert(0, 'row', rows)
+        write_atomic(lambda tmp: df_result.to_csv(tmp, index=False), out_file)
+        done += 1
+
+    return done
+
+
+def progress(shard_dir):
+    '''
+    Counts the shards of a run by state.
+
+    Returns
+    -------
+    A dictionary: shards, done, claimed (by a worker, not done yet) and waiting.
+    '''
+    manifest = read_manifest(shard_dir)
+    ids = [shard['id'] for shard in manifest['shards']]
+    done = {id for id in ids if os.path.isfile(os.path.join(shard_dir, 'output', id + '.csv'))}
+    claimed = {id for id in ids if os.path.isfile(os.path.join(shard_dir, 'claims', id))}
+    return {'shards': len(ids), 'done': len(done), 'claimed': len(claimed - done),
+            'waiting': len(set(ids) - done - claimed)}
+
+
+def merge_shards(shard_dir, output_file):
+    '''
+    Puts the results of all shards back in the order of the input and writes them to
+    one csv file (range by range, so it never has to fit in memory).
+
+    Parameters
+    ----------
+    shard_dir: The shared directory of the run.
+    output_file: The resulting csv file: the input columns plus the result (named as
+                 the kind) and error_code.
+
+    Returns
+    -------
+    summary: A dictionary of number of rows per error (see err_codes).
+    '''
+    manifest = read_manifest(shard_dir)
+    missing = [shard['id'] for shard in manifest['shards'] if not
+               os.path.isfile(os.path.join(shard_dir, 'output', shard['id'] + '.csv'))]
+    if len(missing) > 0:
+        raise CustomException(f"{len(missing)} shards are not processed yet (like \
+{missing[:5]}), run more workers first.")
+
+    by_range = {}
+    for shard in manifest['shards']:
+        by_range.setdefault(shard['range'], []).append(shard['id'])
+
+    counts = np.zeros(max(err_codes.values()) + 1, dtype=np.int64)
+
+    def write(tmp):
+        for part in range(len(manifest['ranges'])):
+            df = pd.concat([pd.read_csv(os.path.join(shard_dir, 'output', id + '.csv'))
+                            for id in by_range.get(part, [])])
+            df = df.sort_values('row').drop(columns='row')
+            if len(df) != manifest['ranges'][part]:
+                raise CustomException(f"Range {part} has {len(df)} rows instead of \
+{manifest['ranges'][part]}.")
+            counts[:] += np.bincount(df['error_code'], minlength=len(counts))
+            df.to_csv(tmp, index=False, mode='w' if part == 0 else 'a', header=part == 0)
+    write_atomic(write, output_file)
+
+    return {err: int(counts[code]) for err, code in err_codes.items() if counts[code] > 0}
+
+
+def run_local(input_file, shard_dir, output_file, kind='after_tax', workers=None,
+              rows_per_range=1000000):
+    '''
+    Runs all the steps on this machine with several worker processes (the same steps
+    a multi-node run does).
+
+    Parameters
+    ----------
+    input_file, shard_dir, kind, rows_per_range: See make_shards.
+    output_file: See merge_shards.
+    workers: Number of worker processes (by default, the number of cores).
+
+    Returns
+    -------
+    summary: See merge_shards.
+    '''
+    make_shards(input_file, shard_dir, kind, rows_per_range)
+    workers = os.cpu_count() if workers is None else workers
+    processes = [multiprocessing.Process(target=run_worker, args=(shard_dir,))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return merge_shards(shard_dir, output_file)
+
+
+if __name__ == '__main__':
+    # On every node: python shards.py work <shard_dir>
+    parser = argparse.ArgumentParser(description="Sharded runner of the combo functions.")
+    parser.add_argument('step', choices=['split', 'work', 'merge', 'progress'])
+    parser.add_argument('shard_dir')
+    parser.add_argument('--input', help="Combo csv file (split).")
+    parser.add_argument('--output', help="Result csv file (merge).")
+    parser.add_argument('--kind', default='after_tax', choices=list(shard_funcs.keys()))
+    parser.add_argument('--rows', type=int, default=1000000, help="Rows per range (split).")
+    parser.add_argument('--lease', type=float, default=3600, help="Lease in seconds (work).")
+    args = parser.parse_args()
+
+    if args.step == 'split':
+        manifest = make_shards(args.input, args.shard_dir, args.kind, args.rows)
+        print(f"{len(manifest['shards'])} shards of {manifest['rows']} rows.")
+    elif args.step == 'work':
+        print(f"{run_worker(args.shard_dir, args.lease)} shards processed.")
+    elif args.step == 'merge':
+        print(merge_shards(args.shard_dir, args.output))
+    else:
+        print(progress(args.shard_dir))
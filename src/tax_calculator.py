@@ -8,16 +8,24 @@ import numpy as np
 #     To work with files (check if a file exists on the drive, ...)
 import os.path
 import sys
+#     To checkpoint long runs and measure their progress
+import json
+import time
+import hashlib
 ### NOTE: If used, this absolute path needs to be set to the actual path of the package and src
 # sys.path.append('c:/Users/mianji/Documents/GitHub/Income-Proxy-Model/tax_calculator/src/')
 
 cw = os.getcwd()
-sys.path.append(cw) + '\\'
+sys.path.append(cw)
 # print('The working directory is:', cw)
 
 # Import required utility functions and constants from util module
-# from .util import CustomException, clinic, guide, tax_data, save_poly_xlsx, save_poly_csv, provinces, names, tax_years
+# from .util import CustomException, clinic, guide, tax_data, save_poly_xlsx, save_poly_csv, provinces, names, available_years
 from util import *
+# Vectorized version of the get_net chain
+from vector_calc import after_tax_vec
+# Stages of the bulk calls (only recorded when memory is profiled, see mem_profile)
+from mem_profile import stage
 
 ##########################################################
 def tune_bpa(gross_inc, df):
@@ -35,7 +43,7 @@ def tune_bpa(gross_inc, df):
     
     ### Check to see if there are specific thresholds and rates to adjust the bpa
     ### based on the income (as of 2024 only 'NS' uses such method)
-    if df['bpa'].notna().sum() == 4:
+    if levels(df)['bpa'] == 4:
         # If the income is less than the lower tax threshold, full bpa will be granted.
         if gross_inc <= df['bpa'][1]:
             bpa = df['bpa'][0]
@@ -52,7 +60,7 @@ def tune_bpa(gross_inc, df):
         ### (as of 2024 only federal and 'YT')
     else:
         # Get the index of the last threshold based-on the number of tax rate levels.
-        last_thresh_ind = df['Threshold'].notna().sum() - 1
+        last_thresh_ind = levels(df)['Threshold'] - 1
         # The 2nd last and the last tax thresholds
         penultimat_thresh = df['Threshold'][last_thresh_ind - 1]
         last_thresh = df['Threshold'][last_thresh_ind]
@@ -99,9 +107,8 @@ def get_credit(df , Federal_df , ei , exempt , cpp ) :
     cpp_base_contrib = Federal_df['CPP_rate'][1] / Federal_df['CPP_rate'][0]
 
     # For QC
-    if 'fed_abatement' in df:
-        if df['fed_abatement'].notna().sum() > 0:
-            cpp_base_contrib = Federal_df['CPP_rate'][3] / Federal_df['CPP_rate'][2]
+    if levels(df).get('fed_abatement', 0) > 0:
+        cpp_base_contrib = Federal_df['CPP_rate'][3] / Federal_df['CPP_rate'][2]
 
     credit = (ei + cpp_base_contrib * cpp + exempt) * df['Rate'][0]/100
 
@@ -157,7 +164,7 @@ def get_fed_tax(gross_inc , Federal_df , prov_df , cpp , ei ):
     fed_tax  = fed_tax  - credit if fed_tax > credit else 0
 
             # As of 2024, only Quebec has an abatement rate on the federal tax
-    if prov_df['fed_abatement'].notna().sum() > 0:
+    if levels(prov_df)['fed_abatement'] > 0:
         fed_tax  *= 1 - prov_df['fed_abatement'][0] / 100
 
     return fed_tax
@@ -186,7 +193,7 @@ def get_prov_tax(gross_inc, Federal_df, prov_df, cpp, ei):
 
             # If there is a second row in bpa, it means bpa needs to be adjusted to income.
             # As of 2024 only 'NS' and 'YT' have this system (same as the federal tax)
-    if prov_df['bpa'].notna().sum() > 1:
+    if levels(prov_df)['bpa'] > 1:
         prov_exempt = tune_bpa(gross_inc, prov_df)
 
     else:
@@ -197,7 +204,7 @@ def get_prov_tax(gross_inc, Federal_df, prov_df, cpp, ei):
 
     # For QC
 
-    if prov_df['fed_abatement'].notna().sum() > 0:
+    if levels(prov_df)['fed_abatement'] > 0:
         cpp_base_contrib = Federal_df['CPP_rate'][3] / Federal_df['CPP_rate'][2]
 
         ### Net taxable income is gross income minus cpp, so adjust gross_inc
@@ -208,7 +215,7 @@ def get_prov_tax(gross_inc, Federal_df, prov_df, cpp, ei):
 
         # As of 2024, only New Brunswick ('NB') has a reliaf rate for low-incomes
         # For this group, we apply the credit (prov_bpa) immediatley.
-    elif prov_df['phase_out'].notna().sum() > 0:
+    elif levels(prov_df)['phase_out'] > 0:
         if taxable_inc < prov_df['phase_out'][0]:
             prov_tax -= (prov_df.loc[0, 'Rate'] * prov_df['phase_out'][1]) \
                         * (taxable_inc - prov_exempt) / 100
@@ -234,7 +241,7 @@ def get_prov_tax(gross_inc, Federal_df, prov_df, cpp, ei):
         ### Calculate the surtax of the tax (if applicable)
         ### Note: Surtaxes are calculated on basic provincial tax payable that is
         ### the provincial tax before deducting total credits.
-    if prov_df['surtax_rate'].notna().sum() > 0:
+    if levels(prov_df)['surtax_rate'] > 0:
         if prov_tax > prov_df['surtax_thresh'][0]:
             surtax = get_surtax(prov_df, prov_tax)
             prov_tax += surtax
@@ -251,8 +258,10 @@ def get_prov_tax(gross_inc, Federal_df, prov_df, cpp, ei):
             
             
         # Now, calculate the provicial credit to deduct from prov_tax
-    credit = get_credit(prov_df, Federal_df, ei, prov_exempt, cpp)
-    prov_tax -= credit if prov_tax > credit else 0
+        # (the credit is non-refundable: a credit greater than the tax leaves no tax,
+        # like the federal tax)
+    credit, _ = get_credit(prov_df, Federal_df, ei, prov_exempt, cpp)
+    prov_tax = prov_tax - credit if prov_tax > credit else 0
         # Finally, return the provincial taxLand related surtax (if N/A, surtax = 0)
 
     return prov_tax, surtax
@@ -351,10 +360,10 @@ def get_health_prem(prov_df, taxable_inc):
             (taxable_inc - prov_df.loc[inds[-1], 'health_prem_thresh']) * \
             prov_df.loc[inds[-1] + 1, 'health_prem_rate'] / 100
 
-    # But it shouldn't be greater than the limit of the row the taxable income
-    # belongs too
-    if health_prem > prov_df.loc[inds[-1] + 1, 'health_prem_limit']:
-        health_prem = prov_df.loc[inds[-1] + 1, 'health_prem_limit']
+        # But it shouldn't be greater than the limit of the row the taxable income
+        # belongs too
+        if health_prem > prov_df.loc[inds[-1] + 1, 'health_prem_limit']:
+            health_prem = prov_df.loc[inds[-1] + 1, 'health_prem_limit']
 
     return health_prem
 
@@ -398,7 +407,7 @@ def get_surtax(prov_df, prov_tax):
     surtax = 0
     # As of 2024, only Ontario and Prince Edward provinces have surtax.
     # It may include more than one level (Ontario has 2).
-    surtax_levels = prov_df['surtax_rate'].notna().sum()
+    surtax_levels = levels(prov_df)['surtax_rate']
     for i in range(surtax_levels):
         surtax += (prov_tax - prov_df['surtax_thresh'][i]) * prov_df['surtax_rate'][i] / 100
     return surtax
@@ -475,7 +484,7 @@ def gross_for_high_net(net_inc, Federal_df, prov_df):
         # As of 2024, only Quebec has an abatement on the federal tax.
         # f is one minus the abatement rate.
     f = 1
-    if prov_df['fed_abatement'].notna().sum() > 0:
+    if levels(prov_df)['fed_abatement'] > 0:
         f -= prov_df['fed_abatement'][0] / 100
 
         # Maximum CPP and EI are paid by such high earners
@@ -498,7 +507,7 @@ def gross_for_high_net(net_inc, Federal_df, prov_df):
         # As of 2024 only YT and NS have this system (similar to the federal bpa)
         # Note: As the income is very high, instead of gross income we use net * 2 because
         # the highest tax threshold in the tax rate bracket is smaller than that
-    if prov_df['bpa'].notna().sum() > 1:
+    if levels(prov_df)['bpa'] > 1:
         prov_exempt = tune_bpa(net_inc * 2, prov_df)
     else:
         prov_exempt = prov_df['bpa'][0]
@@ -510,7 +519,7 @@ def gross_for_high_net(net_inc, Federal_df, prov_df):
     c = 0 # Initializes this term: c = (thresh_tax1*sur_rate1 + thresh_tax2*sur_rate2)
 
     ### If there is any provincial surtax for this province, take it into account.
-    surtax_levels = prov_df['surtax_rate'].notna().sum()
+    surtax_levels = levels(prov_df)['surtax_rate']
     if surtax_levels > 0:
         for i in range(surtax_levels):
             b += prov_df['surtax_rate'][i] / 100
@@ -540,6 +549,162 @@ def gross_for_high_net(net_inc, Federal_df, prov_df):
 
     return gross_inc
 
+def tune_bpa_arr(gross_incs, df):
+    '''
+    Calculates the exact basic personal amount (bpa) for federal, 'NS' and 'YT' for an
+    array of incomes (the same calculation as tune_bpa).
+
+    Parameters
+    ----------
+    gross_incs: An array of gross incomes.
+    df: Province or federal tax rate table (dataframe).
+
+    Returns
+    -------
+    An array of exact tax exemption values.
+    '''
+    bpa = df['bpa']
+    ### If there are specific thresholds and rates to adjust the bpa based on the income
+    ### (as of 2024 only 'NS' uses such method): full bpa up to the lower threshold, a
+    ### reduction by the given rate up to the upper threshold and the minimum above it
+    if levels(df)['bpa'] == 4:
+        return np.where(gross_incs <= bpa[1], bpa[0],
+                        np.where(gross_incs < bpa[2],
+                                 bpa[0] - (gross_incs - bpa[1]) * bpa[3] / 100,
+                                 bpa[0] - (bpa[2] - bpa[1]) * bpa[3] / 100))
+
+    ### Otherwise, a similar tuning but using the 2nd last and the last tax thresholds
+    ### (as of 2024 only federal and 'YT')
+    last_thresh_ind = levels(df)['Threshold'] - 1
+    penultimat_thresh = df['Threshold'][last_thresh_ind - 1]
+    last_thresh = df['Threshold'][last_thresh_ind]
+    return np.where(gross_incs <= penultimat_thresh, bpa[0],
+                    np.where(gross_incs < last_thresh,
+                             bpa[0] - (gross_incs - penultimat_thresh) /
+                             (last_thresh - penultimat_thresh) * bpa[1],
+                             bpa[0] - bpa[1]))
+
+
+def get_qpip_arr(prov_df, gross_incs):
+    '''
+    Array version of get_qpip.
+    '''
+    return np.where(gross_incs <= prov_df['QPIP'][0], gross_incs * prov_df['QPIP'][1] / 100,
+                    prov_df['QPIP'][0] * prov_df['QPIP'][1] / 100)
+
+
+def gross_for_low_net_arr(net_incs, Federal_df, prov_df):
+    '''
+    Calculates gross incomes for net incomes below minimum taxable incomes (< bpa)
+    (the same calculation as gross_for_low_net).
+
+    Parameters
+    ----------
+    net_incs: An array of net incomes (below the bpa).
+    Federal_df: The federal tax information dataframe.
+    prov_df: The provincial tax information dataframe.
+
+    Returns
+    -------
+    An array of gross incomes.
+    '''
+    cpp_rate = Federal_df['CPP_rate'][0]
+    cpp_be = Federal_df['CPP_be'][0]
+    ei_rate = Federal_df['EI_rate'][0]
+
+        # As the gross inc is unknown (but is very close to net_inc), net_inc is used
+        # instead of gross income to choose the formula: the one with CPP applies when
+        # the net income (or the gross income of the one without) is above cpp_be
+    with_cpp = (net_incs - cpp_be * cpp_rate/100) / (1 - cpp_rate/100 - ei_rate/100)
+    no_cpp = net_incs / (1 - ei_rate/100)
+    gross_incs = np.where((net_incs > cpp_be) | (no_cpp > cpp_be), with_cpp, no_cpp)
+
+        # And only add 'Quebec parental insurance plan premium' (as of 2024 only for QC)
+    if 'QPIP' in prov_df:
+        gross_incs = gross_incs + get_qpip_arr(prov_df, gross_incs)
+
+        # If for any reason (that is very unlikely) the calculated gross became less than
+        # the net, that would be unacceptable, so, set it to the net income.
+    return np.where(gross_incs < net_incs, net_incs, gross_incs)
+
+
+def gross_for_high_net_arr(net_incs, Federal_df, prov_df):
+    '''
+    Calculates gross incomes for net incomes above a very high net income level with
+    the formula of gross_for_high_net. Only the provincial bpa (of YT and NS) depends on
+    the income, the other terms of the formula are calculated once.
+
+    Parameters
+    ----------
+    net_incs: An array of net incomes (very high ones, like above $500000).
+    Federal_df: The federal tax information dataframe.
+    prov_df: The provincial tax information dataframe.
+
+    Returns
+    -------
+    An array of gross incomes.
+    '''
+        # As of 2024, only Quebec has an abatement on the federal tax.
+        # f is one minus the abatement rate.
+    f = 1
+    if levels(prov_df)['fed_abatement'] > 0:
+        f -= prov_df['fed_abatement'][0] / 100
+
+        # Maximum CPP and EI are paid by such high earners
+    MCPP = (Federal_df['CPP_max_pensionable'][0] - Federal_df['CPP_be'][0]) * \
+           Federal_df['CPP_rate'][0] / 100
+    MEI = Federal_df['EI_max_contribution'][0] * Federal_df['EI_rate'][0] / 100
+    cum_fed = Federal_df['cumul_bracket'].max() * f
+
+        # For very high earnings, the bpa is minimum
+    fed_exempt = Federal_df['bpa'][0] - Federal_df['bpa'][1]
+    fed_credit, _ = get_credit(Federal_df, Federal_df, MEI, fed_exempt, MCPP)
+        # Canada Employment Amount is an additional credit for federal tax and everyone
+        # with a reported income can claim it
+    fed_credit += Federal_df['employ_amount'][0] * Federal_df['Rate'][0] / 100
+
+        # If there is a second row in bpa, it means bpa needs to be adjusted to income
+        # (as of 2024 only YT and NS). As the income is very high, net * 2 is used instead
+        # of the gross income (the highest tax threshold is smaller than that)
+    if levels(prov_df)['bpa'] > 1:
+        prov_exempt = tune_bpa_arr(net_incs * 2, prov_df)
+    else:
+        prov_exempt = prov_df['bpa'][0]
+
+    prov_credit, _ = get_credit(prov_df, Federal_df, MEI, prov_exempt, MCPP)
+
+    a = MCPP + MEI - fed_credit - prov_credit + cum_fed * f
+    b = 1 # Initializes this term: b = (1 + sur_rate1 + sur_rate2)
+    c = 0 # Initializes this term: c = (thresh_tax1*sur_rate1 + thresh_tax2*sur_rate2)
+
+    ### If there is any provincial surtax for this province, take it into account.
+    surtax_levels = levels(prov_df)['surtax_rate']
+    if surtax_levels > 0:
+        for i in range(surtax_levels):
+            b += prov_df['surtax_rate'][i] / 100
+            c += prov_df['surtax_thresh'][i] * prov_df['surtax_rate'][i] / 100
+
+    cum_prov = prov_df['cumul_bracket'].max()
+
+    # Highest federal and provinical tax rate brackets' thresholds and rates
+    FHI = Federal_df['Threshold'].max()
+    FHR = Federal_df['Rate'].max() / 100
+    PHI = prov_df['Threshold'].max()
+    PHR = prov_df['Rate'].max() / 100
+
+    gross_incs = (net_incs + a + b * cum_prov - FHI * FHR * f - b * PHI * PHR - c ) / \
+                 (1 - FHR * f - b * PHR)
+
+    ### 'health premium' (as of 2024 only ON and QC) is always the maximum for very high
+    ### incomes, and so is 'Quebec parental insurance plan premium' (only QC)
+    if 'health_prem_rate' in prov_df:
+        gross_incs = gross_incs + prov_df['health_prem_limit'][len(prov_df['health_prem_limit']) - 1]
+
+    if 'QPIP' in prov_df:
+        gross_incs = gross_incs + get_qpip_arr(prov_df, gross_incs)
+
+    return gross_incs
+
 def get_net(gross_inc, Federal_df, prov, prov_df):
     '''
     Calculates the net income for a given gross income. This function is called by two
@@ -570,7 +735,7 @@ def get_net(gross_inc, Federal_df, prov, prov_df):
 
         ### Check to see if there is a 2nd additional CPP contribution required.
         ### (starting 2024 a CPP2 should be deducted)
-    if Federal_df['EI_max_contribution'].notna().sum() == 3:
+    if levels(Federal_df)['EI_max_contribution'] == 3:
         cpp_additional = get_cpp_additional(gross_inc, Federal_df)
         cpp += cpp_additional
 
@@ -616,26 +781,32 @@ def before_after_inc(df, func):
     err_msg = "**** Error ***: The dataframe must have at least three columns in this \
     sequence: income, province, year. No NaN is allowed, province must be according to the \
     internationally approved abbreviations (AB, BC, MB, ...), and the year needs to be one \
-    of 2020 to 2024. Moreover, income must be a positive integer or float number."
+    of the years that have tax rate tables. Moreover, income must be a positive integer or \
+    float number."
     try:
         ### First check if the df has a valid format and includes the necessary data
-        if df.iloc[:, 0].isna().sum() > 0 \
-           or len(df.columns) < 3 \
-           or len([d for d in df.iloc[:, 1].unique() if d.upper() not in provinces]) > 0 \
-           or len([d for d in df.iloc[:, 2].unique() if d not in tax_years]) > 0 \
-           or df.iloc[:, 0].dtype not in ['int64', 'int32', 'float64', 'float32'] \
-           or df.iloc[:, 0][df.iloc[:, 0] < 0].sum() > 0:
+        with stage('checks'):
+            valid = not (df.iloc[:, 0].isna().sum() > 0 \
+               or len(df.columns) < 3 \
+               or len([d for d in df.iloc[:, 1].unique() if d.upper() not in provinces]) > 0 \
+               or len([d for d in df.iloc[:, 2].unique() if not is_tax_year(d)]) > 0 \
+               or df.iloc[:, 0].dtype not in ['int64', 'int32', 'float64', 'float32'] \
+               or df.iloc[:, 0][df.iloc[:, 0] < 0].sum() > 0)
+        if not valid:
             print(err_msg)
             return
 
         derived_incs = np.empty(len(df))
 
-        for year in tax_years:
+            # Only the years of the dataframe are visited (and loaded)
+        for year in sorted(int(d) for d in df.iloc[:, 2].unique()):
             for prov in provinces:
-                inds = df.index[(df.iloc[:, 2] == year) & (df.iloc[:, 1].str.upper() == prov)]
+                with stage('masks', prov, year):
+                    inds = df.index[(df.iloc[:, 2] == year) & (df.iloc[:, 1].str.upper() == prov)]
                 if len(inds) > 0:
-                    incs = func(df.iloc[inds][df.columns[0]].values, prov, year)
-                    derived_incs[inds] = incs
+                    with stage('calculation', prov, year):
+                        incs = func(df.iloc[inds][df.columns[0]].values, prov, year)
+                        derived_incs[inds] = incs
 
         derived_incs = np.array(derived_incs).reshape((len(derived_incs), 1))
     
@@ -647,6 +818,233 @@ def before_after_inc(df, func):
         return derived_incs
 
 
+# Error codes of the bulk functions (one code per row, 0 means no error)
+err_codes = {'ok': 0,
+             'income missing or not a number': 1,
+             'negative income': 2,
+             'unknown province': 3,
+             'unknown year': 4,
+             'calculation failed': 5}
+
+
+def before_after_inc_bulk(df, func):
+    '''
+    Bulk version of before_after_inc. Instead of rejecting the whole dataframe when some
+    rows are not valid, every row is checked (with vectorized checks), all the valid rows
+    are calculated and the invalid ones are flagged by an error code. It never raises.
+
+    Parameters:
+    ----------
+    df: see before_tax_combo or after_tax_combo functions.
+    func: The function to apply on the incomes of every (province, year) group. It is
+          called as func(incs, prov, year) and must return an array.
+
+    Returns:
+    -------
+    derived_incs: A one dimensional array of calculated before or after taxes (NaN for
+                  the rows with an error).
+    errors: A one dimensional array of error codes (see err_codes).
+    summary: A dictionary of number of rows per error (only errors that occurred).
+    '''
+    n = len(df)
+    derived_incs = np.full(n, np.nan)
+    errors = np.zeros(n, dtype=np.int8)
+
+    if len(df.columns) < 3:
+        errors[:] = err_codes['calculation failed']
+    else:
+        ### Vectorized checks, the first failed check of a row sets its code
+        incs = pd.to_numeric(df.iloc[:, 0], errors='coerce').to_numpy(dtype=float)
+        provs = df.iloc[:, 1].astype(str).str.upper().to_numpy()
+        years = pd.to_numeric(df.iloc[:, 2], errors='coerce').to_numpy(dtype=float)
+
+        with stage('checks'):
+            checks = [('income missing or not a number', ~np.isfinite(incs)),
+                      ('negative income', incs < 0),
+                      ('unknown province', ~np.isin(provs, provinces)),
+                      ('unknown year', ~np.isin(years, available_years()))]
+            for err, failed in checks:
+                errors[(errors == 0) & failed] = err_codes[err]
+
+        ### Calculate all the valid rows, group by group
+        with stage('grouping'):
+            valid = np.flatnonzero(errors == 0)
+            groups = pd.Series(valid).groupby([provs[valid], years[valid]]).indices
+        for (prov, year), inds in groups.items():
+            inds = valid[inds]
+            with stage('calculation', prov, year):
+                try:
+                    derived_incs[inds] = func(incs[inds], prov, int(year))
+                except Exception:
+                    errors[inds] = err_codes['calculation failed']
+
+        derived_incs[errors != 0] = np.nan
+
+    summary = {err: int((errors == code).sum()) for err, code in err_codes.items()
+               if (errors == code).sum() > 0}
+
+    return derived_incs, errors, summary
+
+
+def after_tax_combo_bulk(df):
+    '''
+    Bulk version of after_tax_combo (see before_after_inc_bulk).
+
+    Parameters:
+    ----------
+    df: See after_tax_combo.
+
+    Returns:
+    -------
+    df_copy: The same dataframe with two added columns: after_tax (NaN for invalid rows)
+             and error_code.
+    summary: A dictionary of number of rows per error.
+    '''
+    with stage('copy'):
+        df_copy = df.copy()
+    after_incs, errors, summary = before_after_inc_bulk(df_copy, after_tax_vec)
+    df_copy['after_tax'] = after_incs
+    df_copy['error_code'] = errors
+    return df_copy, summary
+
+
+def before_tax_combo_bulk(df):
+    '''
+    Bulk version of before_tax_combo (see before_after_inc_bulk).
+
+    Parameters:
+    ----------
+    df: See before_tax_combo.
+
+    Returns:
+    -------
+    df_copy: The same dataframe with two added columns: before_tax (NaN for invalid
+             rows) and error_code.
+    summary: A dictionary of number of rows per error.
+    '''
+    with stage('copy'):
+        df_copy = df.copy()
+    before_incs, errors, summary = before_after_inc_bulk(df_copy, before_tax_vec)
+    df_copy['before_tax'] = before_incs
+    df_copy['error_code'] = errors
+    return df_copy, summary
+
+
+def combo_chunked(df, kind, checkpoint_dir=None, chunk_size=100000, callback=None):
+    '''
+    Calculates the combos of a dataframe like after_tax_combo_bulk (or
+    before_tax_combo_bulk), chunk by chunk. After every chunk the progress is passed to
+    a callback and, if a checkpoint folder is given, the results of the chunk are saved
+    in it, so a run that is interrupted (or crashes) and is started again with the same
+    dataframe only calculates the chunks that were not done.
+
+    Parameters:
+    ----------
+    df: See after_tax_combo or before_tax_combo.
+    kind: 'after_tax' or 'before_tax'.
+    checkpoint_dir: The folder of the checkpoints (None for no checkpoints). A folder
+                    is for one run: the checkpoints of another dataframe (or kind,
+                    chunk size, tax rate tables or polynomials) in it are removed.
+    chunk_size: Number of rows per chunk.
+    callback: A function called after every chunk with the progress (see
+              progress_info), like print_progress.
+
+    Returns:
+    -------
+    df_copy: The same dataframe with two added columns: the result (named as kind) and
+             error_code.
+    summary: A dictionary of number of rows per error.
+    '''
+    funcs = {'after_tax': after_tax_vec, 'before_tax': before_tax_vec}
+    if kind not in funcs:
+        raise CustomException(f"kind must be one of {list(funcs.keys())}.")
+
+    df_copy = df.copy()
+    n = len(df_copy)
+    results = np.full(n, np.nan)
+    errors = np.zeros(n, dtype=np.int8)
+    starts = range(0, n, chunk_size)
+
+        ### A run is identified by the content of the combos, the kind, the chunk size
+        ### and the fingerprints of the tax rate tables (and polynomials) of its years;
+        ### the checkpoints of any other run are removed.
+    done = set()
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        hashes = pd.util.hash_pandas_object(df_copy.iloc[:, :3], index=False).values
+        years = pd.to_numeric(df_copy.iloc[:, 2], errors='coerce').unique()
+        rates = {}
+        for year in sorted(int(year) for year in years if year in available_years()):
+            validate_year(year)
+            rates[str(year)] = rates_fingerprints(year)
+            poly_file = '../data/tax_rates_' + str(year) + '/polynomials-' + str(year) + '.csv'
+            if kind == 'before_tax' and os.path.isfile(poly_file):
+                rates[str(year)]['polynomials'] = file_hash(poly_file)
+        run = {'kind': kind, 'rows': n, 'chunk_size': chunk_size,
+               'fingerprint': hashlib.sha256(hashes.tobytes()).hexdigest(), 'rates': rates}
+        run_file = os.path.join(checkpoint_dir, 'run.json')
+        saved_run = None
+        if os.path.isfile(run_file):
+            with open(run_file) as f:
+                saved_run = json.load(f)
+        if saved_run != run:
+            for file in os.listdir(checkpoint_dir):
+                if file.startswith('chunk-'):
+                    os.remove(os.path.join(checkpoint_dir, file))
+            with open(run_file, 'w') as f:
+                json.dump(run, f)
+
+        for i, start in enumerate(starts):
+            file = os.path.join(checkpoint_dir, f"chunk-{i:06d}.npz")
+            if os.path.isfile(file):
+                with np.load(file) as chunk:
+                    results[start:start + chunk_size] = chunk['results']
+                    errors[start:start + chunk_size] = chunk['errors']
+                done.add(i)
+
+    rows_done = sum(min(chunk_size, n - starts[i]) for i in done)
+    computed = 0
+    start_time = time.time()
+    for i, start in enumerate(starts):
+        if i in done:
+            continue
+        end = min(start + chunk_size, n)
+        results[start:end], errors[start:end], _ = \
+            before_after_inc_bulk(df_copy.iloc[start:end], funcs[kind])
+
+        if checkpoint_dir is not None:
+                # Written to a temporary file first, so a crash never leaves a broken
+                # checkpoint
+            file = os.path.join(checkpoint_dir, f"chunk-{i:06d}.npz")
+            np.savez(file + '.tmp.npz', results=results[start:end], errors=errors[start:end])
+            os.replace(file + '.tmp.npz', file)
+
+        rows_done += end - start
+        computed += end - start
+        if callback is not None:
+            callback(progress_info(rows_done, n, computed, start_time))
+
+    df_copy[kind] = results
+    df_copy['error_code'] = errors
+    summary = {err: int((errors == code).sum()) for err, code in err_codes.items()
+               if (errors == code).sum() > 0}
+    return df_copy, summary
+
+
+def after_tax_combo_chunked(df, checkpoint_dir=None, chunk_size=100000, callback=None):
+    '''
+    Chunked (and resumable) after_tax_combo_bulk (see combo_chunked).
+    '''
+    return combo_chunked(df, 'after_tax', checkpoint_dir, chunk_size, callback)
+
+
+def before_tax_combo_chunked(df, checkpoint_dir=None, chunk_size=100000, callback=None):
+    '''
+    Chunked (and resumable) before_tax_combo_bulk (see combo_chunked).
+    '''
+    return combo_chunked(df, 'before_tax', checkpoint_dir, chunk_size, callback)
+
+
 def before_tax_combo(df):
     '''
     Calculates the before_tax values for given combos of (net_income, province, year)
@@ -655,8 +1053,8 @@ def before_tax_combo(df):
     Parameters:
     ----------
     df: A dataframe that only has these columns (or, as the first three): net income
-        (number), province (abbreviation) and year (a number between 2020 to 2024). Name of
-        columns are not important.
+        (number), province (abbreviation) and year (one of the years that have tax rate
+        tables, see available_years). Name of columns are not important.
 
     Returns:
     -------
@@ -664,10 +1062,11 @@ def before_tax_combo(df):
     results for all rows.
     '''
     ### Make a copy of the original dataframe
-    df_copy = df.copy()
-    func = before_tax_combo
-    before_tax = before_after_inc(df_copy, func)
-    df_copy['before_tax'] = before_tax
+    with stage('copy'):
+        df_copy = df.copy()
+    func = before_tax
+    before_incs = before_after_inc(df_copy, func)
+    df_copy['before_tax'] = before_incs
     return df_copy
 
 
@@ -679,8 +1078,8 @@ def after_tax_combo(df):
     Parameters:
     ----------
     df: A dataframe that only has these columns (or, as the first three): net income
-        (number), province (abbreviation) and year (a number between 2020 to 2024). Name of
-        columns are not important.
+        (number), province (abbreviation) and year (one of the years that have tax rate
+        tables, see available_years). Name of columns are not important.
     
         Returns:
     -------
@@ -688,10 +1087,11 @@ def after_tax_combo(df):
     results for all rows.
     '''
         ### Make a copy of the original dataframe
-    df_copy = df.copy()
+    with stage('copy'):
+        df_copy = df.copy()
 
     func = after_tax
-    after_incs = before_after_inc(func, df_copy)
+    after_incs = before_after_inc(df_copy, func)
     df_copy['after_tax'] = after_incs
 
     return df_copy
@@ -715,8 +1115,8 @@ def before_tax(net_incs, prov = 'ON', year = 2023, **kwargs):
             ### of arguments.
     
     if len (kwargs.keys ()) > 0:
-        print(f"Warning! You passed (len (kwargs.keys ())} unknown arguments to the function. \
-        They are: (Id for d in kwargs.keys ()1}. For more details on how to prepare your data and \
+        print(f"Warning! You passed {len(kwargs.keys())} unknown arguments to the function. \
+        They are: {[d for d in kwargs.keys()]}. For more details on how to prepare your data and \
         call the function please do as follows.\n")
         print("from tax_calculator import guide \nguide()\n")
 
@@ -741,12 +1141,12 @@ def before_tax(net_incs, prov = 'ON', year = 2023, **kwargs):
 
             ##################################################################
             ### ----------------------- Option 1: read from the csv file ----------------
-        path = '../data/tax_rates_' + str(year) + "/"
-        file = 'polynomials-' + str(year) + '.csv'
-        coeff_df = pd.read_csv(path + file)
+        coeffs = read_polys(year)
+        if coeffs is None:
+            raise CustomException(f"There are no polynomials for {year} (see get_poly).")
             # The federal and provincial tax data are also needed
-        Federal_df = pd.read_csv(path + 'Federal.csv')
-        prov_df = pd.read_csv(path + prov.upper() + '.csv')
+        tables = read_tables(year)
+        Federal_df, prov_df = tables['Federal'], tables[prov.upper()]
             ### ----------------------------------------------------------
 
         gross_incs = []
@@ -757,8 +1157,8 @@ def before_tax(net_incs, prov = 'ON', year = 2023, **kwargs):
             ### corresponds to the value (350,000) set as the breakpoint in the get_poly
             ### function (to fit two separate functions over a wide range of
             ### gross_incomes).
-            w = coeff_df[prov.upper() + '_low'] if net_inc < 200000 else \
-                                                coeff_df[prov.upper() + '_high']
+            w = coeffs[prov.upper() + '_low'] if net_inc < 200000 else \
+                                                coeffs[prov.upper() + '_high']
 
             if net_inc <= 0:
                 gross_inc = 0
@@ -800,10 +1200,59 @@ errors persist report it to the Support team.\n")
         guide()
 
     else:
-        print(f"The gross income for the net income of (net_inc) is: ", round(gross_inc))
         return gross_incs
 
 
+def before_tax_vec(net_incs, prov='ON', year=2023, rounded=True):
+    '''
+    Calculates the gross incomes for an array of net incomes like before_tax (the
+    results are identical), but over the whole array: the net incomes are split once
+    into their regions (zero, below the bpa, the low and high polynomials and above
+    $500000), every region is calculated with array operations (one np.polyval per
+    polynomial) and the results are put back in place. Unlike before_tax, errors are
+    raised (CustomException) instead of printed.
+
+    Parameters
+    ----------
+    net_incs: An array of after_tax incomes.
+    prov: Province.
+    year: Tax year.
+    rounded: If False, the gross incomes are not rounded (see cents.before_tax_cents).
+
+    Returns
+    -------
+    gross_incs: An array of before_tax incomes (rounded to dollars).
+    '''
+    net_incs, prov, year = clinic(net_incs, prov, year)
+
+    coeffs = read_polys(year)
+    if coeffs is None:
+        raise CustomException(f"There are no polynomials for {year} (see get_poly).")
+    tables = read_tables(year)
+    Federal_df, prov_df = tables['Federal'], tables[prov]
+
+    net_incs = net_incs.astype(float)
+    gross_incs = np.zeros(len(net_incs))
+
+        ### The regions, in the order before_tax checks them
+    zero = net_incs <= 0
+    low = ~zero & ((net_incs <= Federal_df['bpa'][0]) | (net_incs <= prov_df['bpa'][0]))
+    high = ~zero & ~low & (net_incs >= 500000)
+    poly = ~zero & ~low & ~high
+    poly_low = poly & (net_incs < 200000)
+    poly_high = poly & ~poly_low
+
+    if low.any():
+        gross_incs[low] = gross_for_low_net_arr(net_incs[low], Federal_df, prov_df)
+    if high.any():
+        gross_incs[high] = gross_for_high_net_arr(net_incs[high], Federal_df, prov_df)
+    for region, column in [(poly_low, prov + '_low'), (poly_high, prov + '_high')]:
+        if region.any():
+            gross_incs[region] = np.polyval(coeffs[column], net_incs[region])
+
+    return np.round(gross_incs) if rounded else gross_incs
+
+
 def after_tax(gross_incs, prov = 'ON', year = 2023, **kwargs):
     '''
     calculates the after_tax income for an array of before_tax (gross) incomes for a
@@ -834,18 +1283,19 @@ call the function please do as follows.\n")
 
         ### Read federal and provincial tax data for the given year from the source
         ### excel file or the tax csv files
-        path = "../../data/tax_rates_" + str(year) + "/"
-        Federal_df = pd.read_csv(path + 'Federal.csv')
-        prov_df = pd.read_csv(path + prov.upper() + '.csv')
+        with stage('read tables'):
+            tables = read_tables(year)
+            Federal_df, prov_df = tables['Federal'], tables[prov]
 
             # Loop over the gross income list and calculate the after-tax incomes
-        net_incs = []
-        for gross_inc in gross_incs:
-            if gross_inc <= 0:
-                net_inc = 0
-            else:
-                net_inc = get_net(gross_inc, Federal_df, prov.upper(), prov_df)
-            net_incs.append(net_inc)
+        with stage('income loop'):
+            net_incs = []
+            for gross_inc in gross_incs:
+                if gross_inc <= 0:
+                    net_inc = 0
+                else:
+                    net_inc = get_net(gross_inc, Federal_df, prov.upper(), prov_df)
+                net_incs.append(net_inc)
 
         ### Handle the most common and predictable user errors and communicate with
         ### users about them.
@@ -868,14 +1318,24 @@ do as follows.\n")
         return net_incs
 
 
-def get_poly(year):
+def get_poly(year, force=False, callback=None):
     '''
     Generates the polynomial equations for all provinces. They will be used to calculate
-    the gross income for a given net income.
+    the gross income for a given net income. Only the provinces whose tax rate table
+    has changed since the last run are refitted (all of them if the federal table has
+    changed), unless force is True.
+    The polynomials of every refitted province are checkpointed (in
+    polynomials-<year>-checkpoint.csv, with the fingerprints of the tables they were
+    fitted on), so if a run is interrupted, the next one only fits the provinces that
+    were not done. The checkpoint is removed once all polynomials are saved.
 
     Parameters
     ----------
     year: Tax year.
+    force: If True, polynomials of all provinces are refitted.
+    callback: A function called after every province with the progress (see
+              progress_info, rows are the gross incomes calculated), like
+              print_progress.
 
     Returns
     -------
@@ -886,6 +1346,22 @@ def get_poly(year):
             ### for net income and province just to have `year` tested.
         _, _, year = clinic(np.array([75000]), 'AB', year)
 
+            ### Find out which tax rate tables have changed since the polynomials
+            ### were saved (by comparing the content hash of the csv files)
+        fingerprints = rates_fingerprints(year)
+        poly_df, saved_fingerprints = load_poly(year)
+
+        if force or poly_df is None or \
+           fingerprints['Federal'] != saved_fingerprints.get('Federal'):
+            refit = provinces
+        else:
+            refit = [prov for prov in provinces
+                     if fingerprints[prov] != saved_fingerprints.get(prov)]
+
+        if len(refit) == 0:
+            print(f"The tax equations for year {year} are up to date.")
+            return
+
                 ### load the tax brackets information and make the dataframes
         tables, names = tax_data(year)
 
@@ -909,9 +1385,30 @@ def get_poly(year):
             # for all provinces and territories of Canada like 'AB' for Alberta
         coeff_dict = {}
 
+            ### Take the provinces of an interrupted run that were fitted on the same
+            ### tables from the checkpoint
+        path = '../data/tax_rates_' + str(year) + '/'
+        checkpoint_file = path + 'polynomials-' + str(year) + '-checkpoint.csv'
+        if os.path.isfile(checkpoint_file):
+            checkpoint_df = pd.read_csv(checkpoint_file)
+            for prov in refit:
+                if prov + '_low' in checkpoint_df and \
+                   checkpoint_df[prov + '_hash'][0] == fingerprints[prov] and \
+                   checkpoint_df[prov + '_hash'][1] == fingerprints['Federal']:
+                    for level in gross_incs:
+                        coeff_dict[prov + level] = checkpoint_df[prov + level].to_numpy()
+
+        rows_per_prov = sum(len(g_incs) for g_incs in gross_incs.values())
+        rows_total = rows_per_prov * len(refit)
+        rows_done = rows_per_prov * len({column[:2] for column in coeff_dict})
+        computed = 0
+        start_time = time.time()
+
             # Calculates net incomes for all the gross incomes in gross_inc for
             # all territories
-        for prov in names[1:]:
+        for prov in refit:
+            if prov + '_low' in coeff_dict:
+                continue
             for level, g_incs in gross_incs.items():
                 net_incs = []
                 for income in g_incs:
@@ -921,19 +1418,40 @@ def get_poly(year):
                 w = np.polyfit(net_incs, g_incs, 5, rcond=None, full=False, w=None, cov=False)
                 coeff_dict[prov + level] = w
 
+                # Checkpoint all the provinces fitted so far (with the fingerprints
+                # of the province and federal tables, padded to the length of the
+                # coefficients)
+            checkpoint_df = pd.DataFrame(coeff_dict)
+            for done_prov in {column[:2] for column in coeff_dict}:
+                checkpoint_df[done_prov + '_hash'] = [fingerprints[done_prov],
+                                                      fingerprints['Federal']] + \
+                                                     [''] * (len(checkpoint_df) - 2)
+            checkpoint_df.to_csv(checkpoint_file + '.tmp', index=False)
+            os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+            rows_done += rows_per_prov
+            computed += rows_per_prov
+            if callback is not None:
+                callback(progress_info(rows_done, rows_total, computed, start_time))
+
     except FileNotFoundError as e:
         print("The required data source(s) doesn't exist or is in a different location, \
 the original raised error is as follows.\n")
         print(e, "\n")
 
     else:
-        # Convert polynomials dictionary to a dataframe
-        poly_df = pd.DataFrame(coeff_dict)
+        # Merge the refitted polynomials into the saved ones (if any)
+        if poly_df is None:
+            poly_df = pd.DataFrame(coeff_dict)
+        for column, w in coeff_dict.items():
+            poly_df[column] = w
 
         # Save the polynomials for all provinces in an excel sheet (same file
-        # for all years.)
+        # for all years) and a separate csv file, along with the fingerprints,
+        # in one batch.
         # ### Note: the excel file must not be open!
-        save_poly_xlsx(poly_df, year)
+        save_poly(poly_df, fingerprints, year)
+        if os.path.isfile(checkpoint_file):
+            os.remove(checkpoint_file)
 
-        # Save the polynomials for all provinces in a separate csv file
-        save_poly_csv(poly_df, year)
+        return coeff_dict
@@ -13,6 +13,16 @@ import matplotlib.pyplot as plt
 import os.path
 # To work with time like getting the current year
 import datetime
+# To fingerprint the tax rate files
+import hashlib
+# To validate the tables of a year once when several threads ask for them, and read
+# their csv files concurrently
+import threading
+import concurrent.futures
+# To measure the progress of long runs (and when the data folder was last listed)
+import time
+# For the tax_years alias of the available years
+import collections.abc
 
 ###########
 # Set up constants
@@ -21,7 +31,37 @@ current_year = datetime.date.today().year
 provinces = ['AB', 'BC', 'MB', 'NB', 'NL', 'NT', 'NS', 'NU', 'ON', 'PE', \
              'QC', 'SK', 'YT']
 names = ['Federal'] + provinces
-tax_years = list(range(2020, 2025))
+
+# The columns every tax rate table of a year must have (the optional ones, like the
+# health premium and QPIP columns, are not checked)
+fed_columns = ['Threshold', 'Rate', 'cumul_bracket', 'bpa', 'CPP_rate', 'CPP_be',
+               'CPP_max_pensionable', 'EI_rate', 'EI_max_contribution', 'employ_amount']
+prov_columns = ['province', 'Threshold', 'Rate', 'cumul_bracket', 'bpa', 'fed_abatement',
+                'phase_out', 'surtax_rate', 'surtax_thresh']
+
+# Registry of the tax years: the years found in the data folder (see available_years)
+# and the ones whose tables have been validated (see validate_year). Nothing is read
+# before a year is used. The registry is never changed in place: a new one is made and
+# swapped in, so readers (without the lock) never see it half updated.
+year_registry = {}
+validated_years = set()
+registry_lock = threading.Lock()
+# When the data folder was last listed (0 if never). A year that is not in the registry
+# makes it be listed again, but at most once every rescan_interval seconds.
+last_scan = 0.
+rescan_interval = 60
+# The tax rate tables read in this process, keyed by year (see read_tables)
+year_tables = {}
+# The polynomials read in this process, keyed by year (see read_polys)
+year_polys = {}
+# The number of values of every column of the tables of read_tables (see levels), keyed
+# by id(table) and kept with the table (so an id reused by another dataframe is never
+# mistaken for it)
+table_levels = {}
+# The caches of what is derived from the tax rate tables (like the compiled schedules
+# of vector_calc). Every module with such a cache adds it here, and they are emptied
+# when the tables are read again (see read_tables and clear_derived).
+derived_caches = []
 
 ###########
 
@@ -55,17 +95,254 @@ def clinic(incs, prov, year):
        or len(incs) < 1:
         raise CustomException("The first argument (income) must be a one dimensional \
 array of positive numbers with at least one element. NaN is not allowed.")
-    elif type(year) != int or year not in tax_years:
+    elif type(year) != int or not is_tax_year(year):
         raise CustomException(f"The first argument (income) must be a positive integer \
-or float and the 3rd argument (year) must be an integer between {tax_years[0]} and \
-{tax_years[-1]}.")
+or float and the 3rd argument (year) must be one of the years that have tax rate tables \
+({available_years()}).")
     elif prov.upper() not in provinces:
         raise CustomException("The 2nd passed argument must be a valid abbreviation of \
 one of Canada's provinces or territories (like 'AB', 'BC', 'NL', 'ON', ...)")
     else:
+        validate_year(year)
         return incs, prov.upper(), year
 
 
+def discover_years():
+    '''
+    Finds the tax years that have tax rate tables: a tax_rates_<year> folder with the
+    csv files or a tax_rates_<year>.xlsx file in excel_data (the source of the csv
+    files, see tax_data_to_csv). Only the folders are listed, no file is read.
+
+    Returns
+    -------
+    registry: A dictionary of years and where their tables are ('csv' or 'excel').
+    '''
+    registry = {}
+    if os.path.isdir('../data/excel_data'):
+        for entry in os.listdir('../data/excel_data'):
+            year = entry[len('tax_rates_'):-len('.xlsx')]
+            if entry.startswith('tax_rates_') and entry.endswith('.xlsx') and year.isdigit():
+                registry[int(year)] = 'excel'
+    if os.path.isdir('../data'):
+        for entry in os.listdir('../data'):
+            year = entry[len('tax_rates_'):]
+            if entry.startswith('tax_rates_') and year.isdigit() and \
+               os.path.isfile('../data/' + entry + '/Federal.csv'):
+                registry[int(year)] = 'csv'
+    return dict(sorted(registry.items()))
+
+
+def available_years(refresh=False):
+    '''
+    Returns the tax years that have tax rate tables (see discover_years). The data
+    folder is only listed on the first call (or if refresh is True).
+
+    Returns
+    -------
+    A sorted list of years.
+    '''
+    global year_registry, last_scan
+    if refresh or last_scan == 0:
+        registry = discover_years()
+        with registry_lock:
+            year_registry = registry
+            last_scan = time.time()
+    return list(year_registry.keys())
+
+
+def is_tax_year(year):
+    '''
+    Checks if a year has tax rate tables. A year that is not known yet makes the data
+    folder be listed again (at most once every rescan_interval seconds), so the tables
+    of a new year can be added while a process is running.
+    '''
+    if year in available_years():
+        return True
+    if time.time() - last_scan < rescan_interval:
+        return False
+    return year in available_years(refresh=True)
+
+
+class TaxYears(collections.abc.Sequence):
+    '''
+    The available years (see available_years) as a read-only list. It replaces the
+    former hard-coded tax_years list, so the code that uses it (like
+    'year in tax_years' or tax_years[-1]) keeps working and sees the years of the data
+    folder.
+    '''
+    def __getitem__(self, index):
+        return available_years()[index]
+
+    def __len__(self):
+        return len(available_years())
+
+    def __repr__(self):
+        return repr(available_years())
+
+
+tax_years = TaxYears()
+
+
+def missing_columns(name, columns):
+    '''
+    Lists the required columns (fed_columns or prov_columns) a table does not have.
+
+    Parameters
+    ----------
+    name: 'Federal' or a province.
+    columns: The columns of the table.
+    '''
+    required = fed_columns if name == 'Federal' else prov_columns
+    return [column for column in required if column not in columns]
+
+
+def count_levels(df):
+    '''
+    Counts the values (not NaN) of every column of a table.
+    '''
+    return {column: int(count) for column, count in df.notna().sum().items()}
+
+
+def levels(df):
+    '''
+    Returns the number of values (not NaN) of every column of a tax rate table, like the
+    number of tax brackets or of surtax levels. The ones of the tables of read_tables
+    (that are read-only) are counted once, when the tables are read, so the
+    calculations do not count them for every income. Any other table (like an edited
+    copy or a slice of one) is counted on every call.
+
+    Returns
+    -------
+    A dictionary of counts keyed by column.
+    '''
+    saved = table_levels.get(id(df))
+    if saved is not None and saved[0] is df:
+        return saved[1]
+    return count_levels(df)
+
+
+def clear_derived():
+    '''
+    Empties the caches of what is derived from the tax rate tables (see derived_caches),
+    like after the tables are read again.
+    '''
+    for cache in derived_caches:
+        cache.clear()
+
+
+def freeze_table(df):
+    '''
+    Makes a read-only copy of a tax rate table, so that a table shared by all the
+    callers (and threads) can not be changed in place: writing to it (like
+    df.loc[0, 'Rate'] = 10) raises a ValueError. An edited table is made from a copy
+    (df.copy()).
+
+    Parameters
+    ----------
+    df: A tax rate table (dataframe).
+
+    Returns
+    -------
+    A dataframe with the same columns, made from read-only numpy arrays (the text
+    columns are kept as they are).
+    '''
+    columns = {}
+    for column, values in df.items():
+        if isinstance(values.dtype, np.dtype) and values.dtype != object:
+            values = values.to_numpy(copy=True)
+            values.flags.writeable = False
+        columns[column] = values
+    return pd.DataFrame(columns, index=df.index, copy=False)
+
+
+def read_tables(year, refresh=False):
+    '''
+    Reads (once per process, or again if refresh is True) the federal and all provincial
+    tax rate tables of a year and validates their columns. The csv files are read
+    concurrently; a year that only has the excel file is read in one pass over the
+    workbook (all its sheets at once). Reading the tables again empties the caches
+    derived from them (see clear_derived), like the compiled schedules.
+
+    Parameters
+    ----------
+    year: Tax year.
+    refresh: If True, the files are read again (like after they are edited).
+
+    Returns
+    -------
+    tables: A dictionary of tax rate tables (dataframes) keyed by name (see names). They
+            are shared by all the callers, so they are read-only (see freeze_table).
+    '''
+    if year in year_tables and not refresh:
+        return year_tables[year]
+
+    with registry_lock:
+        if year in year_tables and not refresh:
+            return year_tables[year]
+
+        path = '../data/tax_rates_' + str(year) + '/'
+        excel_file = '../data/excel_data/tax_rates_' + str(year) + '.xlsx'
+        if not os.path.isfile(path + 'Federal.csv') and os.path.isfile(excel_file):
+            sheets = pd.read_excel(excel_file, sheet_name=None)
+            tables = {name: sheets[name] for name in names if name in sheets}
+        else:
+            def read(name):
+                if not os.path.isfile(path + name + '.csv'):
+                    return None
+                return pd.read_csv(path + name + '.csv')
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+                tables = {name: df for name, df in zip(names, executor.map(read, names))
+                          if df is not None}
+
+        problems = []
+        for name in names:
+            if name not in tables:
+                problems.append(f"{name} is missing")
+                continue
+            missing = missing_columns(name, tables[name].columns)
+            if len(missing) > 0:
+                problems.append(f"{name} has no {missing} column(s)")
+            tables[name] = freeze_table(tables[name])
+
+        if len(problems) > 0:
+            raise CustomException(f"The tax rate tables of {year} are not valid: \
+{'; '.join(problems)}.")
+
+        for df in year_tables.get(year, {}).values():
+            table_levels.pop(id(df), None)
+        for df in tables.values():
+            table_levels[id(df)] = (df, count_levels(df))
+        year_tables[year] = tables
+        if refresh:
+            clear_derived()
+        return tables
+
+
+def validate_year(year):
+    '''
+    Checks (once per process) that the federal and all provincial tax rate tables of a
+    year are there and have the required columns (see read_tables, the tables are kept
+    for the calculations). If the year only has the excel file, its csv files are made
+    first (see tax_data_to_csv).
+
+    Parameters
+    ----------
+    year: Tax year.
+    '''
+    if year in validated_years:
+        return
+
+    global year_registry
+    if year_registry.get(year) == 'excel':
+        with registry_lock:
+            if year_registry.get(year) == 'excel':
+                tax_data_to_csv(year)
+                year_registry = {**year_registry, year: 'csv'}
+
+    read_tables(year)
+    validated_years.add(year)
+
+
 def guide():
     '''
     This function provides a how-to-use guide about main functions after_tax, before_tax,
@@ -179,7 +456,7 @@ respectively.
 Mandatory arguments for after_tax and before_tax functions:
 income: A none negative number.
 province: Abbreviation of a Canadian province or territory.
-year: A year between 2020 and 2024.
+year: A year that has tax rate tables in the data folder (see available_years).
 
 Mandatory arguments for after_tax_combo and before_tax_combo functions:
 df: A dataframe of combos of income, province and year (must be the first 3 columns).
@@ -205,20 +482,10 @@ def tax_data(year=2023):
            and abbreviations of Canadian provinces and territories.
     '''
 
-        # Set up the file and provinces (sheet for excel) names to read from
-    file = '../data/excel_data/tax_rates_' + str(year) + '.xlsx'
-    tables = {}
-
-        # Read federal and provincial tax data for the given year from the source
-        # excel file or the tax csv files
-    path = "../data/tax_rates_" + str(year) + "/"
-    for name in names:
-            # To directly read from the source excel files
-        globals()[f'{name}_df'] = pd.read_excel(file, sheet_name=name)
-
-            # To read from csv tax files
-        globals()[f'{name}_df'] = pd.read_csv(path + name + '.csv')
-        tables[name] = globals()[f'{name}_df']
+        # Read federal and provincial tax data for the given year from the tax csv files
+        # (or the source excel file, see read_tables). They are read again, as they may
+        # have been edited since this process read them.
+    tables = read_tables(year, refresh=True)
 
     return tables, names
 
@@ -242,9 +509,10 @@ def tax_data_to_csv(year):
         # Read federal and provincial tax data for the given year from the source
         # excel file and save them in csv format
     path = "../data/tax_rates_" + str(year) + "/"
+    os.makedirs(path, exist_ok=True)
+    sheets = pd.read_excel(file, sheet_name=None)
     for name in names:
-        tax_rate_df = pd.read_excel(file, sheet_name=name)
-        tax_rate_df.to_csv(path + name + '.csv', index=False)
+        sheets[name].to_csv(path + name + '.csv', index=False)
 
     return
 
@@ -292,10 +560,171 @@ def save_poly_csv(poly_df, year):
     path = '../data/tax_rates_' + str(year) + '/'
 
         # Give a name to the file of polynomial coefficients
-    path = '../../data/tax_rates_' + str(year) + "/"
     file = "polynomials-" + str(year) + ".csv"
 
         # Save the data (if the file already exist it will be overwritten)
     poly_df.to_csv(path + file, index=False)
+    year_polys.pop(year, None)
     print(f"The tax equations for year {year} are successfully saved in {file}.")
 
+
+
+def file_hash(file):
+    '''
+    Returns the content hash (sha256) of a file. It is used to find out if a tax rate
+    table has changed since the polynomials were fitted.
+    '''
+    with open(file, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def rates_fingerprints(year):
+    '''
+    Calculates the content hash of the federal and all provincial tax rate csv files
+    of a year.
+
+    Parameters
+    ----------
+    year: The tax year
+
+    Returns
+    -------
+    fingerprints: A dictionary of hashes keyed by names ('Federal', 'AB', 'BC', ...).
+    '''
+    path = '../data/tax_rates_' + str(year) + '/'
+    return {name: file_hash(path + name + '.csv') for name in names}
+
+
+def read_polys(year, refresh=False):
+    '''
+    Reads (once per process, or again if refresh is True) the polynomials of a year
+    (polynomials-<year>.csv, see get_poly). Saving them (see save_poly) reads them again
+    on the next call.
+
+    Parameters
+    ----------
+    year: Tax year.
+    refresh: If True, the file is read again (like after it is edited).
+
+    Returns
+    -------
+    coeffs: A dictionary of read-only coefficient arrays keyed by column (like 'ON_low'),
+            or None if the polynomials of the year are not saved.
+    '''
+    if year in year_polys and not refresh:
+        return year_polys[year]
+
+    file = '../data/tax_rates_' + str(year) + '/polynomials-' + str(year) + '.csv'
+    if not os.path.isfile(file):
+        return None
+    coeffs = {}
+    for column, values in pd.read_csv(file).items():
+        coeffs[column] = values.to_numpy(dtype=float)
+        coeffs[column].flags.writeable = False
+    year_polys[year] = coeffs
+    return coeffs
+
+
+def load_poly(year):
+    '''
+    Reads the saved polynomials of a year and the fingerprints of the tax rate tables
+    they were fitted on.
+
+    Parameters
+    ----------
+    year: The tax year
+
+    Returns
+    -------
+    poly_df: The dataframe of the polynomial coefficients (None if not saved yet).
+    fingerprints: A dictionary of hashes (see rates_fingerprints). Empty if the
+                  polynomials have been saved without fingerprints.
+    '''
+    path = '../data/tax_rates_' + str(year) + '/'
+    poly_file = path + 'polynomials-' + str(year) + '.csv'
+    hash_file = path + 'polynomials-' + str(year) + '-fingerprints.csv'
+
+    poly_df = pd.read_csv(poly_file) if os.path.isfile(poly_file) else None
+    fingerprints = {}
+    if poly_df is not None and os.path.isfile(hash_file):
+        hash_df = pd.read_csv(hash_file)
+        fingerprints = dict(zip(hash_df['name'], hash_df['hash']))
+
+    return poly_df, fingerprints
+
+
+def save_poly(poly_df, fingerprints, year, xlsx=True):
+    '''
+    Saves the polynomials of a year (csv and, optionally, the year's sheet of the excel
+    file) together with the fingerprints of the tax rate tables they were fitted on.
+    All files are first fully written to temporary files and then moved in place one
+    after the other, the fingerprints last, so an interrupted save never leaves
+    fingerprints that claim polynomials are up to date when they are not.
+
+    Parameters
+    ----------
+    poly_df : See save_poly_xlsx.
+    fingerprints: A dictionary of hashes (see rates_fingerprints).
+    year : The tax year
+    xlsx: If True, the sheet of the year in polynomials.xlsx is updated too.
+    '''
+    path = '../data/tax_rates_' + str(year) + '/'
+    moves = []
+
+    if xlsx:
+        file = '../data/excel_data/polynomials.xlsx'
+            # Keep the sheets of the other years as they are
+        sheets = pd.read_excel(file, sheet_name=None) if os.path.isfile(file) else {}
+        sheets[str(year)] = poly_df
+        tmp = '../data/excel_data/polynomials-tmp.xlsx'
+        with pd.ExcelWriter(tmp, mode='w', engine="openpyxl") as writer:
+            for sheet, df in sheets.items():
+                df.to_excel(writer, sheet_name=sheet, index=False)
+        moves.append((tmp, file))
+
+    file = path + 'polynomials-' + str(year) + '.csv'
+    poly_df.to_csv(file + '.tmp', index=False)
+    moves.append((file + '.tmp', file))
+
+    file = path + 'polynomials-' + str(year) + '-fingerprints.csv'
+    hash_df = pd.DataFrame({'name': list(fingerprints.keys()),
+                            'hash': list(fingerprints.values())})
+    hash_df.to_csv(file + '.tmp', index=False)
+    moves.append((file + '.tmp', file))
+
+    for tmp, file in moves:
+        os.replace(tmp, file)
+    year_polys.pop(year, None)
+
+    print(f"The tax equations for year {year} are successfully saved.")
+
+
+def progress_info(done, total, computed, start):
+    '''
+    Summarizes the progress of a long run (for the progress callbacks).
+
+    Parameters
+    ----------
+    done: Number of rows done so far (including the ones restored from a checkpoint).
+    total: Number of rows of the run.
+    computed: Number of rows computed by this run (the speed is based on them).
+    start: The time (time.time()) the run started.
+
+    Returns
+    -------
+    A dictionary: rows_done, rows_total, rows_per_sec, eta (estimated seconds left)
+    and elapsed (seconds).
+    '''
+    elapsed = time.time() - start
+    rows_per_sec = computed / elapsed if elapsed > 0 and computed > 0 else float('nan')
+    eta = (total - done) / rows_per_sec if rows_per_sec > 0 else float('nan')
+    return {'rows_done': done, 'rows_total': total, 'rows_per_sec': rows_per_sec,
+            'eta': eta, 'elapsed': elapsed}
+
+
+def print_progress(info):
+    '''
+    A progress callback that prints the progress (see progress_info) on one line.
+    '''
+    print(f"{info['rows_done']}/{info['rows_total']} rows, {info['rows_per_sec']:.0f} \
+rows/sec, ETA {info['eta']:.0f} s", flush=True)
@@ -0,0 +1,479 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with dataframes
+import pandas as pd
+# To work with arrays
+import numpy as np
+# To read the backend selection from the environment
+import os
+# To share the compiled schedules between threads and run batches in a thread pool
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+
+# Import required utility functions and constants from util module
+from util import *
+# The compiled (numba) backend, if numba is installed
+import kernels
+# The segment table backend
+import segments
+# Province specific rules
+import prov_rules
+
+##########################################################
+# The functions of this module do the same calculations as get_net (and the functions
+# it calls) in the tax_calculator module, but for whole arrays of gross incomes at once.
+# Instead of reading the tax rate dataframes for every single income, the tables of a
+# province are compiled once into a 'schedule' (a dictionary of numbers and small
+# arrays) and every step of the chain is done with numpy operations on all incomes.
+
+# Compiled schedules are kept here, keyed by (province, year), so that tax rate tables
+# are read from the disk only once per process. Schedules are read-only (see freeze), so
+# they are shared by all threads; the lock only guards building them.
+schedules = {}
+schedules_lock = threading.Lock()
+derived_caches.append(schedules)
+
+# The backend used by after_tax_vec: 'numpy' (default), 'numba' or 'segments'. It can
+# be set with the TAX_CALC_BACKEND environment variable or set_backend at runtime.
+backends = ['numpy', 'numba', 'segments']
+backend = 'numpy'
+
+
+def set_backend(name='auto'):
+    '''
+    Selects the backend of after_tax_vec.
+
+    Parameters
+    ----------
+    name: 'numpy', 'numba', 'segments' (see the segments module) or 'auto' (numba if
+          it is installed, otherwise numpy).
+
+    Returns
+    -------
+    The name of the selected backend.
+    '''
+    global backend
+    if name == 'auto':
+        name = 'numba' if kernels.numba is not None else 'numpy'
+    if name not in backends:
+        raise CustomException(f"The backend must be one of {backends} or 'auto'.")
+    if name == 'numba' and kernels.numba is None:
+        raise CustomException("The numba backend needs numba to be installed, install it \
+with: pip install numba")
+    backend = name
+    return backend
+
+
+def make_schedule(Federal_df, prov_df):
+    '''
+    Compiles the federal and provincial tax rate tables of a province into a schedule.
+
+    Parameters
+    ----------
+    Federal_df: The federal tax information dataframe.
+    prov_df: The provincial tax information dataframe for a province.
+
+    Returns
+    -------
+    sched: A dictionary with all the rates, thresholds and limits get_net needs.
+    '''
+    prov = prov_df['province'][0]
+    sched = {'province': prov}
+
+        ### CPP and EI (QC has different CPP and EI rates)
+    cpp_rate = Federal_df['CPP_rate'][0] if prov != 'QC' else Federal_df['CPP_rate'][2]
+    sched['cpp_rate'] = cpp_rate
+    sched['cpp_be'] = Federal_df['CPP_be'][0]
+    sched['cpp_max'] = (Federal_df['CPP_max_pensionable'][0] - sched['cpp_be']) * \
+                       cpp_rate / 100
+
+        # Starting 2024 a 2nd additional CPP contribution (CPP2) should be deducted
+    if levels(Federal_df)['EI_max_contribution'] == 3:
+        sched['cpp2'] = (Federal_df['CPP_max_pensionable'][0],
+                         Federal_df['CPP_max_pensionable'][1],
+                         Federal_df['CPP_max_pensionable'][2])
+    else:
+        sched['cpp2'] = None
+
+    ei_rate = Federal_df['EI_rate'][0] if prov != 'QC' else Federal_df['EI_rate'][1]
+    sched['ei_rate'] = ei_rate
+    sched['ei_max'] = Federal_df['EI_max_contribution'][0] * ei_rate / 100
+
+        ### Federal and provincial tax brackets, bpa and credits
+    for level, df in [('fed', Federal_df), ('prov', prov_df)]:
+        thresh = df['Threshold'].dropna().values.astype(float)
+        sched[level + '_thresh'] = np.concatenate(([0.], thresh))
+        sched[level + '_cumul'] = np.concatenate(([0.], df['cumul_bracket'].values[:len(thresh)]))
+        sched[level + '_rate'] = df['Rate'].values[:len(thresh) + 1].astype(float)
+        sched[level + '_bpa'] = compile_bpa(df, level)
+        sched[level + '_credit_rate'] = df['Rate'][0] / 100
+
+        # The CPP base contributions rate (see get_credit). Note that, like get_fed_tax,
+        # the federal tax uses the federal table to pick the rate.
+    sched['fed_cbc'] = Federal_df['CPP_rate'][1] / Federal_df['CPP_rate'][0]
+    if levels(Federal_df).get('fed_abatement', 0) > 0:
+        sched['fed_cbc'] = Federal_df['CPP_rate'][3] / Federal_df['CPP_rate'][2]
+
+    sched['prov_cbc'] = Federal_df['CPP_rate'][1] / Federal_df['CPP_rate'][0]
+
+    sched['employ_credit'] = Federal_df['employ_amount'][0] * Federal_df['Rate'][0] / 100
+
+        ### Province specific rules (see prov_rules): their entries (None or empty if
+        ### not applicable) and the plan of the rules that apply
+    entries, sched['plan'] = prov_rules.compile_plan(Federal_df, prov_df)
+    sched.update(entries)
+        # If the compiled kernels (and the cents chain) can calculate the schedule
+    sched['hard_coded'] = prov_rules.hard_coded(sched['plan'])
+
+    return freeze(sched)
+
+
+def freeze(table):
+    '''
+    Makes a dictionary of numbers and arrays (like a schedule) read-only so that it can
+    be safely shared between threads: arrays can not be written to anymore and the
+    dictionary itself can not be changed.
+
+    Parameters
+    ----------
+    table: A dictionary.
+
+    Returns
+    -------
+    A read-only view of the dictionary.
+    '''
+    for value in table.values():
+        if isinstance(value, np.ndarray):
+            value.flags.writeable = False
+    return MappingProxyType(table)
+
+
+def compile_bpa(df, level):
+    '''
+    Turns the bpa rules of a table (see tune_bpa) into a (bpa, low, high, slope) tuple so
+    that bpa = bpa - slope * (clip(gross_inc, low, high) - low) for every income.
+
+    Parameters
+    ----------
+    df: Province or federal tax rate table (dataframe).
+    level: 'fed' or 'prov'. Provinces with a single bpa value have no tuning.
+
+    Returns
+    -------
+    A tuple of four floats.
+    '''
+    bpa = df['bpa'][0]
+    bpa_levels = levels(df)['bpa']
+
+    if level == 'prov' and bpa_levels <= 1:
+        return (bpa, 0., 0., 0.)
+
+        # Thresholds and rate given in the bpa column (as of 2024 only 'NS')
+    if bpa_levels == 4:
+        return (bpa, df['bpa'][1], df['bpa'][2], df['bpa'][3] / 100)
+
+        # Otherwise the 2nd last and the last tax thresholds are used
+    last_thresh_ind = levels(df)['Threshold'] - 1
+    penultimat_thresh = df['Threshold'][last_thresh_ind - 1]
+    last_thresh = df['Threshold'][last_thresh_ind]
+    return (bpa, penultimat_thresh, last_thresh,
+            df['bpa'][1] / (last_thresh - penultimat_thresh))
+
+
+def load_schedule(prov, year):
+    '''
+    Returns the compiled schedule of a province for a year. It is compiled only the first
+    time a (province, year) is requested (from the tables of read_tables).
+
+    Parameters
+    ----------
+    prov: Province.
+    year: Tax year.
+
+    Returns
+    -------
+    sched: See make_schedule.
+    '''
+    key = (prov.upper(), year)
+    if key not in schedules:
+        with schedules_lock:
+            if key not in schedules:
+                tables = read_tables(year)
+                schedules[key] = make_schedule(tables['Federal'], tables[prov.upper()])
+    return schedules[key]
+
+
+def tune_bpa_vec(gross_incs, bpa):
+    '''
+    Vectorized tune_bpa.
+
+    Parameters
+    ----------
+    gross_incs: An array of gross incomes.
+    bpa: A compiled bpa tuple (see compile_bpa).
+
+    Returns
+    -------
+    An array of basic personal amounts.
+    '''
+    full, low, high, slope = bpa
+    if slope == 0:
+        return np.full(len(gross_incs), full)
+    return full - slope * (np.clip(gross_incs, low, high) - low)
+
+
+def bracket_tax_vec(taxable_incs, thresh, cumul, rate):
+    '''
+    Calculates the tax of the brackets (before credits) for an array of taxable incomes.
+
+    Parameters
+    ----------
+    taxable_incs: An array of taxable incomes.
+    thresh, cumul, rate: Compiled thresholds (with a leading 0), cumulative bracket
+                         taxes (with a leading 0) and rates of a tax table.
+
+    Returns
+    -------
+    An array of taxes.
+    '''
+        # Number of thresholds the income is strictly greater than (leading 0 excluded)
+    inds = np.searchsorted(thresh[1:], taxable_incs, side='left')
+    return cumul[inds] + rate[inds] * (taxable_incs - thresh[inds]) / 100
+
+
+def get_cpp_vec(gross_incs, sched):
+    '''
+    Vectorized get_cpp plus get_cpp_additional (if CPP2 applies).
+
+    Parameters
+    ----------
+    gross_incs: An array of gross incomes.
+    sched: The compiled schedule of the province.
+
+    Returns
+    -------
+    cpp: An array of CPP deductions (CPP2 included).
+    cpp2: An array of the additional CPP deductions.
+    '''
+    cpp = np.minimum(np.maximum(gross_incs - sched['cpp_be'], 0) * sched['cpp_rate'] / 100,
+                     sched['cpp_max'])
+    if sched['cpp2'] is None:
+        return cpp, np.zeros(len(gross_incs))
+
+    cpp_thresh1, cpp_thresh2, cpp2_rate = sched['cpp2']
+    cpp2 = (np.clip(gross_incs, cpp_thresh1, cpp_thresh2) - cpp_thresh1) * cpp2_rate / 100
+    return cpp + cpp2, cpp2
+
+
+def get_ei_vec(gross_incs, sched):
+    '''
+    Vectorized get_ei.
+    '''
+    return np.minimum(gross_incs * sched['ei_rate'] / 100, sched['ei_max'])
+
+
+def get_taxable_vec(gross_incs, cpp, cbc):
+    '''
+    Net taxable income is gross income minus part of cpp (see get_fed_tax).
+    '''
+    return np.where(gross_incs > cpp, gross_incs - (1 - cbc) * cpp, 0)
+
+
+def get_fed_tax_vec(gross_incs, sched, cpp, ei):
+    '''
+    Vectorized get_fed_tax.
+
+    Parameters
+    ----------
+    gross_incs: An array of gross incomes.
+    sched: The compiled schedule of the province.
+    cpp, ei: Arrays of CPP and EI deductions.
+
+    Returns
+    -------
+    fed_tax: An array of federal taxes.
+    '''
+    fed_exempt = tune_bpa_vec(gross_incs, sched['fed_bpa'])
+    credit = (ei + sched['fed_cbc'] * cpp + fed_exempt) * sched['fed_credit_rate'] + \
+             sched['employ_credit']
+
+    taxable_incs = get_taxable_vec(gross_incs, cpp, sched['fed_cbc'])
+    fed_tax = bracket_tax_vec(taxable_incs, sched['fed_thresh'], sched['fed_cumul'],
+                              sched['fed_rate'])
+    fed_tax = np.where((fed_tax > credit) & (taxable_incs > fed_exempt), fed_tax - credit, 0)
+
+        # The rules of the province on the federal tax (the QC abatement)
+    for _, func in prov_rules.hooked(sched, 'fed_tax'):
+        fed_tax = func(sched, fed_tax)
+
+    return fed_tax
+
+
+def get_health_prem_vec(taxable_incs, sched):
+    '''
+    Vectorized get_health_prem.
+    '''
+    inds = np.searchsorted(sched['health_thresh'], taxable_incs, side='left')
+    prev = np.maximum(inds - 1, 0)
+    health_prem = sched['health_limit'][prev] + \
+        (taxable_incs - sched['health_thresh'][prev]) * sched['health_rate'][inds] / 100
+    health_prem = np.where(health_prem > sched['health_limit'][inds],
+                           sched['health_limit'][inds], health_prem)
+    return np.where(inds > 0, health_prem, 0)
+
+
+def get_qpip_vec(gross_incs, sched):
+    '''
+    Vectorized get_qpip.
+    '''
+    qpip_max, qpip_rate = sched['qpip']
+    return np.minimum(gross_incs, qpip_max) * qpip_rate / 100
+
+
+def get_prov_tax_vec(gross_incs, sched, cpp, ei):
+    '''
+    Vectorized get_prov_tax.
+
+    Parameters
+    ----------
+    gross_incs: An array of gross incomes.
+    sched: The compiled schedule of the province.
+    cpp, ei: Arrays of CPP and EI deductions.
+
+    Returns
+    -------
+    A dictionary of arrays: prov_tax (surtax, health premium and QPIP included), and the
+    output of every rule of prov_rules (surtax, health_prem and qpip).
+    '''
+    n = len(gross_incs)
+    prov_exempt = tune_bpa_vec(gross_incs, sched['prov_bpa'])
+    taxable_incs = get_taxable_vec(gross_incs, cpp, sched['prov_cbc'])
+
+        # Incomes below the exemption (or, for the rules like the NB phase out, below
+        # their thresholds) pay no provincial tax at all.
+    exempt = taxable_incs <= prov_exempt
+    for _, func in prov_rules.hooked(sched, 'exempt'):
+        exempt |= func(sched, taxable_incs)
+
+    prov_tax = bracket_tax_vec(taxable_incs, sched['prov_thresh'], sched['prov_cumul'],
+                               sched['prov_rate'])
+
+        # The amounts of the rules of the province (surtax, health premium, QPIP, ...),
+        # 0 for the rules it does not have
+    parts = {}
+    for rule, func in prov_rules.hooked(sched, 'prov_tax'):
+        parts[rule['output']] = func(sched, gross_incs, taxable_incs, prov_tax)
+        prov_tax = prov_tax + parts[rule['output']]
+
+    credit = (ei + sched['prov_cbc'] * cpp + prov_exempt) * sched['prov_credit_rate']
+    prov_tax = np.where(prov_tax > credit, prov_tax - credit, 0)
+
+    result = {'prov_tax': np.where(exempt, 0, prov_tax)}
+    for output in prov_rules.outputs():
+        result[output] = np.where(exempt, 0, parts[output]) if output in parts else np.zeros(n)
+    return result
+
+
+def get_net_vec(gross_incs, sched):
+    '''
+    Vectorized get_net. Unlike get_net, all the components of the calculation are
+    returned and net incomes are not rounded.
+
+    Parameters
+    ----------
+    gross_incs: An array of gross incomes.
+    sched: The compiled schedule of the province.
+
+    Returns
+    -------
+    result: A dictionary of arrays: CPP, CPP2, EI, fed_tax, prov_tax, the outputs of
+            the rules (surtax, health_prem, qpip), total_deduction and net_income.
+    '''
+    gross_incs = np.asarray(gross_incs, dtype=float)
+    cpp, cpp2 = get_cpp_vec(gross_incs, sched)
+    ei = get_ei_vec(gross_incs, sched)
+    fed_tax = get_fed_tax_vec(gross_incs, sched, cpp, ei)
+    prov = get_prov_tax_vec(gross_incs, sched, cpp, ei)
+
+    total_deduction = fed_tax + prov['prov_tax'] + cpp + ei
+
+    result = {'CPP': cpp,
+              'CPP2': cpp2,
+              'EI': ei,
+              'fed_tax': fed_tax,
+              'prov_tax': prov['prov_tax'],
+              **{output: prov[output] for output in prov_rules.outputs()},
+              'total_deduction': total_deduction,
+              'net_income': gross_incs - total_deduction}
+
+    return result
+
+
+def after_tax_vec(gross_incs, prov='ON', year=2023):
+    '''
+    Calculates the after_tax incomes for an array of gross incomes like after_tax but
+    with numpy operations over the whole array (or the compiled kernel, see set_backend,
+    unless the province has a rule the kernel does not have, see prov_rules.hard_coded).
+
+    Parameters
+    ----------
+    gross_incs: An array of before_tax incomes.
+    prov: Province.
+    year: Tax year.
+
+    Returns
+    -------
+    net_incs: An array of after_tax incomes (rounded to dollars).
+    '''
+    gross_incs, prov, year = clinic(gross_incs, prov, year)
+    sched = load_schedule(prov, year)
+    if backend == 'numba' and sched['hard_coded']:
+        return kernels.net_numba(gross_incs, sched)
+    if backend == 'segments':
+        net_incs = np.round(segments.segments_net(gross_incs, segments.load_segments(prov, year)))
+    else:
+        net_incs = np.round(get_net_vec(gross_incs, sched)['net_income'])
+    return np.where(gross_incs <= 0, 0, net_incs)
+
+
+def after_tax_threads(gross_incs, prov='ON', year=2023, workers=None, chunk_size=500000):
+    '''
+    Calculates the after_tax incomes of a large array like after_tax_vec, but splits it
+    into chunks that are processed in parallel by a pool of threads. The numpy and
+    numba kernels release the GIL while they work, so threads run on all cores without
+    the cost of starting processes.
+
+    Parameters
+    ----------
+    gross_incs: An array of before_tax incomes.
+    prov: Province.
+    year: Tax year.
+    workers: Number of threads (by default, the number of cores).
+    chunk_size: Number of incomes per chunk.
+
+    Returns
+    -------
+    net_incs: An array of after_tax incomes (rounded to dollars).
+    '''
+    gross_incs, prov, year = clinic(gross_incs, prov, year)
+        # Build the schedule (and segment table) once, before the threads start
+    load_schedule(prov, year)
+    if backend == 'segments':
+        segments.load_segments(prov, year)
+
+    net_incs = np.empty(len(gross_incs))
+
+    def run(start):
+        end = start + chunk_size
+        net_incs[start:end] = after_tax_vec(gross_incs[start:end], prov, year)
+
+    with ThreadPoolExecutor(workers) as executor:
+        list(executor.map(run, range(0, len(gross_incs), chunk_size)))
+
+    return net_incs
+
+
+if 'TAX_CALC_BACKEND' in os.environ:
+    set_backend(os.environ['TAX_CALC_BACKEND'])
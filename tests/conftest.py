@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To find the modules of src and the data folder
+import os
+import sys
+import shutil
+import pytest
+
+##########################################################
+# The modules of src import each other by name and read the tax rate tables from
+# '../data' (relative to src), so the tests run from src like the package does. The
+# tests that write to the data folder work on a copy of it (see data_copy).
+
+src = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path.insert(0, src)
+os.chdir(src)
+
+
+@pytest.fixture
+def data_copy(tmp_path):
+    '''
+    Runs a test from the src folder of a temporary copy of the data folder, and reads
+    the tables and polynomials of the real one again after it.
+    '''
+    import util
+
+    shutil.copytree(os.path.join(src, '..', 'data'), tmp_path / 'data')
+    os.mkdir(tmp_path / 'src')
+    os.chdir(tmp_path / 'src')
+    yield tmp_path
+    os.chdir(src)
+    for year in list(util.year_tables):
+        util.read_tables(year, refresh=True)
+    util.year_polys.clear()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with arrays
+import numpy as np
+import pytest
+
+from util import *
+from vector_calc import after_tax_vec
+from tax_calculator import before_tax_vec
+
+pa = pytest.importorskip('pyarrow')
+import pyarrow.parquet as pq
+import arrow_io
+
+##########################################################
+# The Arrow combos against the array functions, row by row, over tables of several
+# batches (with plain and dictionary encoded provinces and integer incomes), the Parquet
+# file and the checks of the input.
+
+years = [year for year in available_years() if read_polys(year) is not None]
+pytestmark = pytest.mark.skipif(len(years) == 0, reason="No polynomials in ../data")
+
+rng = np.random.default_rng(7)
+
+
+def make_table(n=600, batches=3, dictionary=False):
+    incs = rng.integers(0, 300000, n)
+    provs = rng.choice(['ON', 'QC', 'bc', 'NS'], n)
+    table_years = rng.choice(years, n)
+    table = pa.table({'income': incs, 'province': provs, 'year': table_years})
+    if dictionary:
+        table = table.set_column(1, 'province', table.column(1).dictionary_encode())
+    return pa.Table.from_batches(table.to_batches(max_chunksize=n // batches)), \
+        incs, provs, table_years
+
+
+def expected(func, incs, provs, table_years):
+    results = np.empty(len(incs))
+    for i in range(len(incs)):
+        results[i] = func(np.array([incs[i]], dtype=float), provs[i], int(table_years[i]))[0]
+    return results
+
+
+@pytest.mark.parametrize('dictionary', [False, True])
+def test_after_tax_combo_arrow_matches_after_tax_vec(dictionary):
+    table, incs, provs, table_years = make_table(dictionary=dictionary)
+    assert table.column(0).num_chunks == 3
+    result = arrow_io.after_tax_combo_arrow(table)
+    assert result.column_names == ['income', 'province', 'year', 'after_tax']
+    assert np.array_equal(result.column('after_tax').to_numpy(),
+                          expected(after_tax_vec, incs, provs, table_years))
+
+
+def test_before_tax_combo_arrow_to_parquet(tmp_path):
+    table, incs, provs, table_years = make_table(n=200, batches=2)
+    file = str(tmp_path / 'before_tax.parquet')
+    result = arrow_io.before_tax_combo_arrow(table, file)
+    assert np.array_equal(result.column('before_tax').to_numpy(),
+                          expected(before_tax_vec, incs, provs, table_years))
+    assert pq.read_table(file).equals(result)
+
+
+def test_input_checks():
+    with pytest.raises(CustomException):
+        arrow_io.after_tax_combo_arrow(pa.table({'income': [1.], 'province': ['ON']}))
+    with pytest.raises(CustomException):
+        arrow_io.after_tax_combo_arrow(pa.table({'income': [1., None], 'province': ['ON'] * 2,
+                                                 'year': [years[0]] * 2}))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with dataframes and arrays
+import pandas as pd
+import numpy as np
+import pytest
+
+from util import *
+import tax_calculator
+from tax_calculator import err_codes
+from vector_calc import after_tax_vec
+
+##########################################################
+# The bulk combos on a frame of valid and invalid rows: every error code of err_codes
+# is given to the rows it is for (the calculation fails for a year without
+# polynomials), the valid rows get the results of the array functions and the others
+# NaN.
+
+poly_years = [year for year in available_years() if read_polys(year) is not None]
+no_poly_years = [year for year in available_years() if read_polys(year) is None]
+pytestmark = pytest.mark.skipif(len(poly_years) == 0 or len(no_poly_years) == 0,
+                                reason="Needs years with and without polynomials in ../data")
+
+
+def mixed_frame():
+    year = poly_years[-1]
+    rows = [(50000, 'ON', year, 'ok'),
+            (None, 'ON', year, 'income missing or not a number'),
+            ('abc', 'QC', year, 'income missing or not a number'),
+            (-10, 'ON', year, 'negative income'),
+            (50000, 'XX', year, 'unknown province'),
+            (50000, 'ON', 1999, 'unknown year'),
+            (50000, 'ON', no_poly_years[0], 'calculation failed'),
+            (120000, 'qc', year, 'ok')]
+    df = pd.DataFrame([row[:3] for row in rows], columns=['income', 'province', 'year'])
+    return df, np.array([err_codes[row[3]] for row in rows])
+
+
+def test_before_tax_combo_bulk_error_codes():
+    df, expected = mixed_frame()
+    result, summary = tax_calculator.before_tax_combo_bulk(df)
+
+    assert np.array_equal(result['error_code'], expected)
+    assert set(result['error_code']) == set(err_codes.values())
+    assert summary == {err: int((expected == code).sum()) for err, code in err_codes.items()}
+    assert result['before_tax'][expected != 0].isna().all()
+    year = poly_years[-1]
+    assert result['before_tax'][0] == tax_calculator.before_tax_vec(np.array([50000.]), 'ON', year)[0]
+    assert result['before_tax'][7] == tax_calculator.before_tax_vec(np.array([120000.]), 'QC', year)[0]
+    assert result.columns.tolist()[:3] == df.columns.tolist()
+
+
+def test_after_tax_combo_bulk_calculates_the_year_without_polynomials():
+    df, expected = mixed_frame()
+    expected[expected == err_codes['calculation failed']] = err_codes['ok']
+    result, summary = tax_calculator.after_tax_combo_bulk(df)
+    assert np.array_equal(result['error_code'], expected)
+    assert result['after_tax'][6] == after_tax_vec(np.array([50000.]), 'ON', no_poly_years[0])[0]
+
+
+def test_too_few_columns():
+    derived_incs, errors, summary = tax_calculator.before_after_inc_bulk(
+        pd.DataFrame({'income': [1, 2], 'province': ['ON', 'ON']}), after_tax_vec)
+    assert np.isnan(derived_incs).all()
+    assert (errors == err_codes['calculation failed']).all()
+    assert summary == {'calculation failed': 2}
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with arrays
+import numpy as np
+import pytest
+
+from util import *
+import kernels
+import cents
+
+##########################################################
+# The compiled cents kernel against the numpy cents chain (they do the same integer
+# operations, so the results must be identical).
+
+years = available_years()
+pytestmark = [pytest.mark.skipif(len(years) == 0, reason="No tax rate tables in ../data"),
+              pytest.mark.skipif(kernels.numba is None, reason="numba is not installed")]
+
+
+@pytest.mark.parametrize('rounding', cents.roundings)
+@pytest.mark.parametrize('prov', provinces)
+def test_net_cents_numba_matches_get_net_cents(prov, rounding):
+    rng = np.random.default_rng(0)
+        # Random cents, and ties of the rounding to dollars
+    gross_cents = np.concatenate((rng.integers(-100, 50000000, 20000),
+                                  rng.integers(0, 500000, 2000) * 100 + 50))
+    csched = cents.load_cents_schedule(prov, years[-1])
+
+    net_cents = cents.get_net_cents(gross_cents, csched, rounding)['net_income']
+    net_cents = np.where(gross_cents <= 0, 0, net_cents)
+
+    assert np.array_equal(kernels.net_cents_numba(gross_cents, csched, rounding), net_cents)
+    assert np.array_equal(kernels.net_cents_numba(gross_cents, csched, rounding, dollars=True),
+                          cents.div_round(net_cents, 100, rounding))
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with dataframes and arrays
+import pandas as pd
+import numpy as np
+import os
+import pytest
+
+from util import *
+import tax_calculator
+
+##########################################################
+# combo_chunked resumes an interrupted run from its checkpoints (only the chunks that
+# were not done are calculated) with the output of an uninterrupted run, and drops the
+# checkpoints of another dataframe.
+
+years = [year for year in available_years() if read_polys(year) is not None]
+pytestmark = pytest.mark.skipif(len(years) == 0, reason="No polynomials in ../data")
+
+
+class Interrupt(Exception):
+    pass
+
+
+def combos(n=250):
+    rng = np.random.default_rng(5)
+    df = pd.DataFrame({'income': rng.integers(0, 300000, n).astype(float),
+                       'province': rng.choice(['ON', 'QC', 'BC'], n),
+                       'year': rng.choice(years, n)})
+    df.loc[3, 'income'] = -1
+    return df
+
+
+@pytest.mark.parametrize('kind', ['after_tax', 'before_tax'])
+def test_combo_chunked_resumes_after_an_interruption(tmp_path, kind):
+    df = combos()
+    checkpoint_dir = str(tmp_path / 'checkpoints')
+    expected, expected_summary = tax_calculator.combo_chunked(df, kind, chunk_size=60)
+
+    def interrupt(info):
+        if info['rows_done'] >= 120:
+            raise Interrupt()
+    with pytest.raises(Interrupt):
+        tax_calculator.combo_chunked(df, kind, checkpoint_dir, 60, interrupt)
+    assert len([file for file in os.listdir(checkpoint_dir) if file.startswith('chunk-')]) == 2
+
+    progress = []
+    result, summary = tax_calculator.combo_chunked(df, kind, checkpoint_dir, 60, progress.append)
+    assert [info['rows_done'] for info in progress] == [180, 240, 250]
+    assert result.equals(expected)
+    assert summary == expected_summary
+
+        # Another dataframe in the same folder starts from scratch
+    progress = []
+    other = df.iloc[::-1].reset_index(drop=True)
+    result, _ = tax_calculator.combo_chunked(other, kind, checkpoint_dir, 60, progress.append)
+    assert [info['rows_done'] for info in progress] == [60, 120, 180, 240, 250]
+    assert result.equals(tax_calculator.combo_chunked(other, kind, chunk_size=60)[0])
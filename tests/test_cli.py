@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with dataframes and arrays
+import pandas as pd
+import numpy as np
+# To work on a copy of the data and run the daemon
+import os
+import shutil
+import threading
+import pytest
+
+from util import *
+import cli
+from vector_calc import after_tax_vec
+
+##########################################################
+# The command line tool: a one-shot round trip (gross to net and back, both written as
+# integers), the combo modes, the daemon (the same output as a one-shot call) and the
+# tables read again when their files change.
+
+years = [year for year in available_years() if read_polys(year) is not None]
+pytestmark = pytest.mark.skipif(len(years) == 0, reason="No polynomials in ../data")
+
+gross_incs = np.array([0., 15000., 48000.5, 90000., 250000.])
+
+
+def run(tmp_path, args, text):
+    input_file, output_file = tmp_path / 'input.csv', tmp_path / 'output.csv'
+    input_file.write_text(text)
+    assert cli.main(args + [str(input_file), '-o', str(output_file)]) == 0
+    return pd.read_csv(output_file)
+
+
+def test_one_shot_round_trip(tmp_path):
+    year = years[-1]
+    args = ['--local', '--prov', 'QC', '--year', str(year)]
+    net = run(tmp_path, ['after_tax'] + args, '\n'.join(map(str, gross_incs)))
+    assert net['after_tax'].dtype == np.int64
+    assert np.array_equal(net['after_tax'], np.round(after_tax_vec(gross_incs, 'QC', year)))
+
+    gross = run(tmp_path, ['before_tax'] + args, net[['after_tax']].to_csv(index=False))
+    assert gross['before_tax'].dtype == np.int64
+    assert np.allclose(gross['before_tax'], gross_incs, rtol=0.01, atol=100)
+
+
+def test_combo_modes_write_integers(tmp_path):
+    text = pd.DataFrame({'income': [50000, 'x', 80000], 'province': ['ON', 'ON', 'BC'],
+                         'year': [years[-1]] * 3}).to_csv(index=False)
+    for mode in ['after_tax', 'before_tax']:
+        df = run(tmp_path, [mode + '_combo', '--local'], text)
+        assert df[mode].dtype == np.float64  # The row with an error has no value
+        assert df[mode].isna().tolist() == [False, True, False]
+        lines = (tmp_path / 'output.csv').read_text().splitlines()
+        assert '.' not in lines[1].split(',')[3]
+
+
+def test_daemon_serves_the_one_shot_output(tmp_path):
+    socket_path = str(tmp_path / 'cli.sock')
+    thread = threading.Thread(target=cli.serve, args=(socket_path,))
+    thread.start()
+    try:
+        for _ in range(600):
+            if cli.call_daemon({'mode': 'ping'}, socket_path) is not None:
+                break
+            thread.join(0.1)
+        text = '\n'.join(map(str, gross_incs))
+        args = ['after_tax', '--year', str(years[-1]), '--socket', socket_path]
+        served = run(tmp_path, args, text)
+        assert cli.main(['--reload', '--socket', socket_path]) == 0
+        assert served.equals(run(tmp_path, args + ['--local'], text))
+    finally:
+        assert cli.main(['--stop', '--socket', socket_path]) == 0
+        thread.join()
+    assert not os.path.exists(socket_path)
+
+
+def test_changed_tables_are_read_again(tmp_path):
+    year = years[-1]
+    shutil.copytree('../data/tax_rates_' + str(year), tmp_path / 'data' / ('tax_rates_' + str(year)))
+    os.mkdir(tmp_path / 'src')
+    cwd = os.getcwd()
+    os.chdir(tmp_path / 'src')
+    try:
+        cli.loaded_fingerprints.clear()
+        assert cli.refresh_changed([year]) == [year]
+        assert cli.refresh_changed([year]) == []
+        before = after_tax_vec(gross_incs, 'ON', year)
+
+        table = '../data/tax_rates_' + str(year) + '/ON.csv'
+        rates = pd.read_csv(table)
+        rates.loc[0, 'Rate'] = rates.loc[0, 'Rate'] + 5
+        rates.to_csv(table, index=False)
+        assert cli.refresh_changed([year]) == [year]
+        assert not np.array_equal(after_tax_vec(gross_incs, 'ON', year), before)
+    finally:
+        os.chdir(cwd)
+        cli.loaded_fingerprints.clear()
+        read_tables(year, refresh=True)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with arrays
+import numpy as np
+import pytest
+
+from util import *
+import distribution
+import vector_calc
+from tax_calculator import get_net
+
+##########################################################
+# The histogram transform against the component values of vector_calc: a histogram of
+# narrow bins (with empty bins between them) is almost a list of incomes, so its totals
+# and net income histogram are the ones of the incomes in the middle of the bins. The
+# provinces transformed together must give the results of every province alone. The
+# net income range of a gross income band contains get_net at every sampled income of
+# the band, and its mean is inside it.
+
+years = available_years()
+pytestmark = pytest.mark.skipif(len(years) == 0, reason="No tax rate tables in ../data")
+
+incomes = np.linspace(100, 400000, 97)
+edges = np.sort(np.concatenate((incomes - 0.0005, incomes + 0.0005)))
+counts = np.zeros(len(edges) - 1)
+counts[::2] = np.arange(1, len(incomes) + 1)
+new_edges = np.linspace(-0.5, 300000.5, 61)
+
+
+@pytest.mark.parametrize('prov', provinces)
+def test_histogram_transform_matches_incomes(prov):
+    result = distribution.histogram_transform(edges, counts, prov, years[0],
+                                              {'net_income': new_edges})
+    net = vector_calc.get_net_vec(incomes, vector_calc.load_schedule(prov, years[0]))
+    weights = counts[::2]
+
+    for column in distribution.components:
+        assert result['totals'][column] == pytest.approx((weights * net[column]).sum(),
+                                                         rel=1e-6, abs=1)
+    expected, _ = np.histogram(net['net_income'], new_edges, weights=weights)
+    assert np.allclose(result['histograms']['net_income'], expected, atol=1e-6)
+
+
+def test_histogram_transform_all_matches_one_province():
+    rng = np.random.default_rng(0)
+    gross_edges = np.linspace(0, 500000, 501)
+    gross_counts = rng.random(500) * 100
+    results = distribution.histogram_transform_all(gross_edges, gross_counts, years[0],
+                                                   per_bin=True)
+
+    for prov in provinces:
+        result = distribution.histogram_transform(gross_edges, gross_counts, prov,
+                                                  years[0], per_bin=True)
+        for column in result['totals']:
+            assert results[prov]['totals'][column] == pytest.approx(result['totals'][column])
+            assert np.allclose(results[prov]['bin_totals'][column],
+                               result['bin_totals'][column])
+            assert result['totals'][column] == pytest.approx(result['bin_totals'][column].sum())
+        assert np.allclose(results[prov]['histograms']['net_income'],
+                           result['histograms']['net_income'])
+
+
+@pytest.mark.parametrize('prov', ['ON', 'QC', 'NS', 'NB', 'PE'])
+def test_band_net_contains_get_net(prov):
+    year = years[-1]
+    tables = read_tables(year)
+    rng = np.random.default_rng(13)
+    lows = np.concatenate((rng.uniform(0, 300000, 15), [0, 50000]))
+    highs = lows + np.concatenate((rng.uniform(0, 60000, 15), [20000, 0]))
+    result = distribution.band_net(lows, highs, prov, year)
+
+    for i in range(len(lows)):
+        samples = np.linspace(lows[i], highs[i], 20)
+        nets = np.array([get_net(inc, tables['Federal'], prov, tables[prov]) if inc > 0
+                         else 0 for inc in samples])
+            # get_net is rounded to dollars
+        assert (nets >= result['min_net'][i] - 0.5).all()
+        assert (nets <= result['max_net'][i] + 0.5).all()
+        assert result['min_net'][i] <= result['mean_net'][i] <= result['max_net'][i]
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with arrays
+import numpy as np
+# To work on a copy of the data
+import os
+import shutil
+import pytest
+
+from util import *
+import inverse
+
+##########################################################
+# The inverse tables saved by save_inverse (on a copy of the data folder) are read back
+# by read_inverse as they were built.
+
+years = available_years()
+pytestmark = pytest.mark.skipif(len(years) == 0, reason="No tax rate tables in ../data")
+
+
+def test_save_and_read_inverse(tmp_path):
+    year = years[-1]
+    shutil.copytree('../data/tax_rates_' + str(year), tmp_path / 'data' / ('tax_rates_' + str(year)))
+    os.mkdir(tmp_path / 'src')
+    cwd = os.getcwd()
+    os.chdir(tmp_path / 'src')
+    try:
+        bounds = inverse.save_inverse(year, ['ON', 'QC'], max_error=1)
+        assert os.path.isfile('../data/tax_rates_' + str(year) + '/inverse-' + str(year) + '.csv')
+        tables = inverse.read_inverse(year)
+    finally:
+        os.chdir(cwd)
+
+    assert sorted(tables) == ['ON', 'QC']
+    for prov, table in tables.items():
+        built = inverse.load_inverse(prov, year, 1)
+        assert np.array_equal(table['net'], built['net'])
+        assert np.array_equal(table['gross'], built['gross'])
+        assert table['max_error'] == pytest.approx(bounds[prov]) and bounds[prov] <= 1
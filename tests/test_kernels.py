@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with arrays
+import numpy as np
+import pytest
+
+from util import *
+from tax_calculator import get_net
+import vector_calc
+import segments
+import kernels
+
+##########################################################
+# The compiled (numba) backend against the reference chain (get_net, one income at a
+# time) for every province and year that has tax rate tables.
+
+years = available_years()
+pytestmark = [pytest.mark.skipif(len(years) == 0, reason="No tax rate tables in ../data"),
+              pytest.mark.skipif(kernels.numba is None, reason="numba is not installed")]
+
+
+def edge_incomes(year, prov):
+    '''
+    The gross incomes at and 1 dollar around the values of the tables where the net
+    income has a kink (tax thresholds, CPP and EI maximums, the bpa phase-outs of NS, YT
+    and the federal table), the tax thresholds converted to gross incomes (see
+    segments.known_breaks) and a coarse grid.
+    '''
+    tables = read_tables(year)
+    Federal_df, prov_df = tables['Federal'], tables[prov]
+    values = [Federal_df['Threshold'], prov_df['Threshold'], Federal_df['CPP_be'],
+              Federal_df['CPP_max_pensionable'], Federal_df['EI_max_contribution'][:1]]
+    for df in [Federal_df, prov_df]:
+        if levels(df)['bpa'] == 4:
+            values.append(df['bpa'][1:3])
+    values.append(segments.known_breaks(vector_calc.load_schedule(prov, year), 5000000))
+    values = np.concatenate([np.asarray(value, dtype=float) for value in values])
+    values = values[~np.isnan(values)]
+
+    incs = np.concatenate(((values[:, None] + np.array([-1, 0, 1])).ravel(),
+                           np.arange(0, 500001, 5000), [1, 1000000, 5000000]))
+    return np.unique(incs[incs >= 0])
+
+
+@pytest.mark.parametrize('year', years)
+@pytest.mark.parametrize('prov', provinces)
+def test_net_numba_matches_get_net(year, prov):
+    gross_incs = edge_incomes(year, prov)
+    tables = read_tables(year)
+    expected = np.array([get_net(gross_inc, tables['Federal'], prov, tables[prov])
+                         if gross_inc > 0 else 0 for gross_inc in gross_incs])
+
+    net_incs = kernels.net_numba(gross_incs, vector_calc.load_schedule(prov, year))
+
+    bad = np.flatnonzero(net_incs != expected)
+    assert len(bad) == 0, f"{prov} {year}: {list(zip(gross_incs[bad][:5], expected[bad][:5], net_incs[bad][:5]))}"
+
+
+def test_set_backend_numba():
+    previous = vector_calc.backend
+    try:
+        assert vector_calc.set_backend('numba') == 'numba'
+        gross_incs = np.array([0., 25000., 60000., 150000., 400000.])
+        tables = read_tables(years[-1])
+        expected = [get_net(gross_inc, tables['Federal'], 'ON', tables['ON'])
+                    if gross_inc > 0 else 0 for gross_inc in gross_incs]
+        assert list(vector_calc.after_tax_vec(gross_incs, 'ON', years[-1])) == expected
+    finally:
+        vector_calc.set_backend(previous)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with arrays
+import numpy as np
+import pytest
+
+from util import *
+import lazy_result
+from vector_calc import get_net_vec, load_schedule
+
+##########################################################
+# The columns of a LazyResult are the ones of get_net_vec, and reading a column only
+# calculates the part of the chain it depends on (see LazyResult.computed).
+
+years = available_years()
+pytestmark = pytest.mark.skipif(len(years) == 0, reason="No tax rate tables in ../data")
+
+gross_incs = np.concatenate((np.linspace(0, 600000, 301), [1, 15000.5, 49999.99]))
+
+
+@pytest.mark.parametrize('year', years)
+@pytest.mark.parametrize('prov', provinces)
+def test_columns_match_get_net_vec(year, prov):
+    result = lazy_result.lazy_after_tax(gross_incs, prov, year)
+    expected = get_net_vec(gross_incs, load_schedule(prov, year))
+    assert sorted(result.keys()) == sorted(expected.keys())
+    for name in expected:
+        assert np.array_equal(result[name], expected[name], equal_nan=True), name
+    assert np.array_equal(result['net'], expected['net_income'], equal_nan=True)
+
+
+def test_reading_a_column_computes_only_its_dependencies():
+    result = lazy_result.lazy_after_tax(gross_incs, 'ON', years[-1])
+    assert result.computed() == []
+
+    result['EI']
+    assert result.computed() == ['EI']
+
+    result['cpp']
+    assert sorted(result.computed()) == ['CPP', 'EI', 'cpp_parts']
+
+    result['fed_tax']
+    computed = set(result.computed())
+    assert computed == {'CPP', 'EI', 'cpp_parts', 'fed_exempt', 'fed_taxable', 'fed_tax'}
+    assert not any(name.startswith('prov') or name.startswith('due_') for name in computed)
+    assert 'net_income' not in computed
+
+        # Reading a column again calculates nothing
+    memo = dict(result.memo)
+    result['fed_tax']
+    assert all(result.memo[name] is memo[name] for name in memo)
+    assert set(result.computed()) == computed
+
+    with pytest.raises(KeyError):
+        result['not_a_column']
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with dataframes and arrays
+import pandas as pd
+import numpy as np
+import pytest
+
+from util import *
+import mem_profile
+import tax_calculator
+
+##########################################################
+# profile_memory reports a stage per (province, year) group of the bulk functions, and
+# the stages of the scalar chain are the ones of the real work (the tables are read and
+# every income is calculated), not of an error path.
+
+years = available_years()
+pytestmark = pytest.mark.skipif(len(years) < 2, reason="Not enough tax years in ../data")
+
+
+def test_after_tax_combo_bulk_stages_per_group():
+    df = pd.DataFrame({'income': [50000., 80000., 120000., 30000., -5.],
+                       'province': ['ON', 'on', 'QC', 'QC', 'AB'],
+                       'year': [years[-1], years[-1], years[0], years[-1], years[0]]})
+    (result, summary), report = mem_profile.profile_memory(tax_calculator.after_tax_combo_bulk, df)
+
+    groups = {(record['province'], record['year']) for record in report
+              if record['stage'] == 'calculation'}
+    assert groups == {('ON', years[-1]), ('QC', years[0]), ('QC', years[-1])}
+    assert {'total', 'copy', 'checks', 'grouping'} <= {record['stage'] for record in report}
+    assert summary == {'ok': 4, 'negative income': 1}
+    assert result['after_tax'].notna().sum() == 4
+
+
+def test_after_tax_stages_are_the_real_work():
+    gross_incs = np.array([40000., 90000.])
+    net_incs, report = mem_profile.profile_memory(tax_calculator.after_tax, gross_incs,
+                                                  'ON', years[-1])
+    assert net_incs is not None and len(net_incs) == 2
+    stages = [record['stage'] for record in report]
+    assert 'read tables' in stages and 'income loop' in stages
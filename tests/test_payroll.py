@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with arrays
+import numpy as np
+import pytest
+
+from util import *
+import tax_calculator
+from payroll import new_ytd_state, payroll_run
+
+##########################################################
+# Payroll mode against the annual (scalar) functions: over a year of a constant salary
+# the period deductions add up to the annual CPP, CPP2, EI and QPIP (also when their
+# maximums are reached in the middle of the year) and the withheld income tax adds up
+# to the annual tax estimate.
+
+years = available_years()
+pytestmark = pytest.mark.skipif(len(years) == 0, reason="No tax rate tables in ../data")
+
+periods_per_year = 26
+salaries = np.array([15000., 45000., 70000., 95000., 250000.])
+
+
+def annual_contributions(gross_inc, prov, year):
+        # The same arguments as get_net
+    tables = read_tables(year)
+    Federal_df, prov_df = tables['Federal'], tables[prov]
+    cpp_rate = Federal_df['CPP_rate'][0] if prov != 'QC' else Federal_df['CPP_rate'][2]
+    cpp_be = Federal_df['CPP_be'][0]
+    cpp_max = (Federal_df['CPP_max_pensionable'][0] - cpp_be) * cpp_rate / 100
+    ei_rate = Federal_df['EI_rate'][0] if prov != 'QC' else Federal_df['EI_rate'][1]
+    ei_max = Federal_df['EI_max_contribution'][0] * ei_rate / 100
+
+    cpp2 = 0
+    if levels(Federal_df)['EI_max_contribution'] == 3:
+        cpp2 = tax_calculator.get_cpp_additional(gross_inc, Federal_df)
+    qpip = tax_calculator.get_qpip(prov_df, gross_inc) if 'QPIP' in prov_df else 0
+    return {'CPP': tax_calculator.get_cpp(gross_inc, cpp_rate, cpp_max, cpp_be),
+            'CPP2': cpp2,
+            'EI': tax_calculator.get_ei(gross_inc, ei_rate, ei_max),
+            'qpip': qpip}
+
+
+def run_year(prov, year):
+    state = new_ytd_state(len(salaries))
+    pay_periods = [salaries / periods_per_year] * periods_per_year
+    periods = list(payroll_run(pay_periods, prov, year, periods_per_year, state))
+    totals = {key: np.sum([period[key] for period in periods], axis=0)
+              for key in ['CPP', 'CPP2', 'EI', 'qpip', 'income_tax']}
+    return periods, totals, state
+
+
+@pytest.mark.parametrize('prov', ['ON', 'QC'])
+def test_periods_add_up_to_the_annual_contributions(prov):
+    year = years[-1]
+    periods, totals, state = run_year(prov, year)
+
+    for i, salary in enumerate(salaries):
+        annual = annual_contributions(salary, prov, year)
+        for key in annual:
+            assert totals[key][i] == pytest.approx(annual[key], abs=1e-6)
+            assert state[key][i] == pytest.approx(totals[key][i])
+    assert np.allclose(totals['income_tax'], state['annual_tax'])
+
+
+@pytest.mark.parametrize('prov', ['ON', 'QC'])
+def test_maximums_reached_mid_year(prov):
+    year = years[-1]
+    periods, totals, state = run_year(prov, year)
+    high = len(salaries) - 1
+    pay = salaries[high] / periods_per_year
+
+    keys = ['CPP', 'EI'] + (['qpip'] if prov == 'QC' else []) + \
+           (['CPP2'] if levels(read_tables(year)['Federal'])['EI_max_contribution'] == 3
+            else [])
+    for key in keys:
+        deductions = np.array([period[key][high] for period in periods])
+            # A partial deduction in the period the maximum is reached and none after
+        assert deductions[-1] == 0
+        partial = (deductions > 0) & (deductions < deductions.max())
+        assert 1 <= partial.sum() <= 2
+        last = np.flatnonzero(deductions > 0)[-1]
+        assert 0 < last < periods_per_year - 1
+        assert totals[key][high] == pytest.approx(annual_contributions(pay * periods_per_year,
+                                                                       prov, year)[key])
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with dataframes and arrays
+import pandas as pd
+import numpy as np
+import pytest
+
+from util import *
+import tax_calculator
+
+##########################################################
+# get_poly (on a copy of the data folder) only refits the provinces whose tax rate table
+# has changed since the polynomials were saved, and keeps the saved polynomials of the
+# others.
+
+years = [year for year in available_years() if read_polys(year) is not None]
+pytestmark = pytest.mark.skipif(len(years) == 0, reason="No polynomials in ../data")
+
+
+def test_get_poly_refits_only_changed_provinces(data_copy, capsys):
+    year = years[-1]
+    path = '../data/tax_rates_' + str(year) + '/'
+        # Bring the saved polynomials up to date with the tables first
+    tax_calculator.get_poly(year)
+    assert tax_calculator.get_poly(year) is None
+    saved = pd.read_csv(path + 'polynomials-' + str(year) + '.csv')
+
+    rates = pd.read_csv(path + 'ON.csv')
+    rates.loc[0, 'Rate'] = rates.loc[0, 'Rate'] + 2
+    rates.to_csv(path + 'ON.csv', index=False)
+    read_tables(year, refresh=True)
+
+    coeff_dict = tax_calculator.get_poly(year)
+    assert sorted(coeff_dict) == ['ON_high', 'ON_low']
+    refitted = pd.read_csv(path + 'polynomials-' + str(year) + '.csv')
+    assert list(refitted.columns) == list(saved.columns)
+    others = [column for column in saved.columns if not column.startswith('ON_')]
+        # (the same up to the precision of the csv file)
+    assert np.allclose(refitted[others], saved[others], rtol=1e-12, atol=0)
+    assert not np.allclose(refitted['ON_low'], saved['ON_low'], rtol=1e-6, atol=0)
+    assert load_poly(year)[1] == rates_fingerprints(year)
+    assert tax_calculator.get_poly(year) is None
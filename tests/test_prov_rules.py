@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with arrays
+import numpy as np
+import pytest
+
+from util import *
+import vector_calc
+import prov_rules
+import lazy_result
+import kernels
+import cents
+import golden
+
+##########################################################
+# A rule registered at runtime: the schedules compiled before it are dropped, the
+# chains that implement the rules of the tax rate tables themselves (the compiled
+# kernels and the cents chain) refuse a plan with it, the numba backend falls back to
+# numpy for it and the lazy results have its output column.
+
+years = available_years()
+pytestmark = pytest.mark.skipif(len(years) == 0, reason="No tax rate tables in ../data")
+
+gross_incs = np.linspace(0, 300000, 31)
+
+
+@pytest.fixture
+def levy():
+    vector_calc.load_schedule('AB', years[0])
+    prov_rules.register_rule('levy', ['Rate'],
+                             compile=lambda Federal_df, prov_df: {'levy_rate': 0.01},
+                             off={'levy_rate': 0.},
+                             hooks={'prov_tax': lambda sched, gross_incs, taxable_incs,
+                                    prov_tax: gross_incs * sched['levy_rate']},
+                             output='levy')
+    yield
+    del prov_rules.rules['levy']
+    clear_derived()
+
+
+def test_register_rule_drops_schedules(levy):
+    assert len(vector_calc.schedules) == 0
+    sched = vector_calc.load_schedule('AB', years[0])
+    assert 'levy' in sched['plan'] and not sched['hard_coded']
+
+
+def test_hard_coded_chains_refuse_new_rules(levy):
+    sched = vector_calc.load_schedule('AB', years[0])
+    with pytest.raises(CustomException):
+        kernels.pack_schedule(sched)
+    with pytest.raises(CustomException):
+        cents.after_tax_cents(gross_incs, 'AB', years[0])
+
+
+def test_numba_backend_falls_back_to_numpy(levy):
+    expected = np.round(vector_calc.get_net_vec(
+        gross_incs, vector_calc.load_schedule('AB', years[0]))['net_income'])
+    expected = np.where(gross_incs <= 0, 0, expected)
+    previous = vector_calc.backend
+    try:
+        if kernels.numba is not None:
+            vector_calc.set_backend('numba')
+        assert np.array_equal(vector_calc.after_tax_vec(gross_incs, 'AB', years[0]), expected)
+    finally:
+        vector_calc.set_backend(previous)
+    assert np.array_equal(golden.numba_engine(gross_incs, 'AB', years[0]), expected)
+
+
+def test_lazy_result_has_new_outputs(levy):
+    result = lazy_result.lazy_after_tax(gross_incs, 'AB', years[0])
+    assert 'levy' in result and 'levy' in result.keys()
+    assert np.allclose(result['levy'][-1], gross_incs[-1] * 0.01)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with dataframes and arrays
+import pandas as pd
+import numpy as np
+# To work on a copy of the data
+import os
+import shutil
+import pytest
+
+from util import *
+import result_cache
+
+##########################################################
+# The cache on a copy of the data folder: editing a tax rate drops the results of its
+# year and the misses are calculated from the edited table, not from the tables read
+# before.
+
+years = available_years()
+pytestmark = pytest.mark.skipif(len(years) == 0, reason="No tax years in ../data")
+
+
+@pytest.fixture
+def data_copy(tmp_path):
+    year = years[-1]
+    shutil.copytree('../data/tax_rates_' + str(year), tmp_path / 'data' / ('tax_rates_' + str(year)))
+    os.mkdir(tmp_path / 'src')
+    cwd = os.getcwd()
+    os.chdir(tmp_path / 'src')
+    yield year, tmp_path
+    os.chdir(cwd)
+    read_tables(year, refresh=True)
+    result_cache.seen_fingerprints.clear()
+
+
+def test_edited_rate_changes_the_result(data_copy):
+    year, tmp_path = data_copy
+    file = str(tmp_path / 'cache.sqlite')
+    df = pd.DataFrame({'income': [30000., 60000.], 'province': ['ON', 'ON'],
+                       'year': [year, year]})
+
+    before, stats = result_cache.cached_combo(df, 'after_tax', file)
+    again, stats = result_cache.cached_combo(df, 'after_tax', file)
+    assert stats['hits'] == 2
+    assert (again['after_tax'] == before['after_tax']).all()
+
+        # Another rate of the first bracket
+    table = '../data/tax_rates_' + str(year) + '/ON.csv'
+    rates = pd.read_csv(table)
+    rates.loc[0, 'Rate'] = rates.loc[0, 'Rate'] + 5
+    rates.to_csv(table, index=False)
+
+    after, stats = result_cache.cached_combo(df, 'after_tax', file)
+    assert stats['misses'] == 2
+    assert (after['after_tax'] != before['after_tax']).all()
+    read_tables(year, refresh=True)
+    expected = result_cache.engine('after_tax')[1](df['income'].to_numpy(), 'ON', year)
+    assert np.allclose(after['after_tax'], expected)
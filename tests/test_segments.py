@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with arrays
+import numpy as np
+import pytest
+
+from util import *
+from tax_calculator import get_net
+import segments
+
+##########################################################
+# The segment tables against the reference chain (get_net, one income at a time) 1
+# dollar before and after every break of the table, and at the break itself where the
+# net income is continuous (a break on a jump, like the one of a surtax, is only
+# located to the tol of build_segments, so the side it is on is not defined), for every
+# province and year that has tax rate tables. The raise deltas (for increments that are
+# the same for all employees or one per employee, including a pay cut and no raise) are
+# the difference of two get_net calls.
+
+years = available_years()
+pytestmark = pytest.mark.skipif(len(years) == 0, reason="No tax rate tables in ../data")
+
+
+@pytest.mark.parametrize('year', years)
+@pytest.mark.parametrize('prov', provinces)
+def test_segments_net_matches_get_net(year, prov):
+    table = segments.load_segments(prov, year)
+    breaks, slope, intercept = table['breaks'], table['slope'], table['intercept']
+    continuous = np.abs(slope[:-1] * breaks[1:] + intercept[:-1] -
+                        (slope[1:] * breaks[1:] + intercept[1:])) < 0.01
+    gross_incs = np.unique(np.concatenate((breaks - 1, breaks + 1, breaks[1:][continuous])))
+    gross_incs = gross_incs[gross_incs > 0]
+    tables = read_tables(year)
+    expected = np.array([get_net(gross_inc, tables['Federal'], prov, tables[prov])
+                         for gross_inc in gross_incs])
+
+    net_incs = np.round(segments.segments_net(gross_incs, table))
+
+    bad = np.flatnonzero(net_incs != expected)
+    assert len(bad) == 0, f"{prov} {year}: {list(zip(gross_incs[bad][:5], expected[bad][:5], net_incs[bad][:5]))}"
+
+
+@pytest.mark.parametrize('prov', ['ON', 'QC', 'NS', 'NB'])
+def test_raise_deltas_match_get_net(prov):
+    year = years[-1]
+    tables = read_tables(year)
+    rng = np.random.default_rng(11)
+    base_incs = rng.integers(5000, 400000, 40).astype(float) + 0.25
+    increments = np.array([0, 750, 2500, 15000, -3000])
+    result = segments.raise_deltas(base_incs, increments, prov, year)
+
+    def net(gross_inc):
+        return get_net(gross_inc, tables['Federal'], prov, tables[prov]) if gross_inc > 0 else 0
+    base_net = np.array([net(inc) for inc in base_incs])
+    expected = np.array([[net(inc + increment) for increment in increments]
+                         for inc in base_incs]) - base_net[:, None]
+    assert np.array_equal(result['base_net'], base_net)
+    assert np.array_equal(result['delta'], expected)
+    assert np.isnan(result['marginal_rate'][:, 0]).all()
+
+        # One increment per employee (a matrix of one scenario)
+    own = rng.integers(0, 20000, (len(base_incs), 1)).astype(float)
+    expected = np.array([net(inc + increment) for inc, increment in zip(base_incs, own[:, 0])])
+    assert np.array_equal(segments.raise_deltas(base_incs, own, prov, year)['delta'][:, 0],
+                          expected - base_net)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with dataframes and arrays
+import pandas as pd
+import numpy as np
+# To age a claim
+import os
+import time
+import pytest
+
+from util import *
+import shards
+from tax_calculator import after_tax_combo_bulk
+
+##########################################################
+# A sharded run on one machine, step by step: make (again, with nothing to do), claim,
+# a worker that takes over the shard of a dead worker (a claim older than the lease)
+# but not the one of a live worker, and the merge, which gives the output of
+# after_tax_combo_bulk on the whole input.
+
+years = available_years()
+pytestmark = pytest.mark.skipif(len(years) == 0, reason="No tax rate tables in ../data")
+
+
+def test_make_claim_takeover_merge(tmp_path):
+    rng = np.random.default_rng(3)
+    n = 50
+    df = pd.DataFrame({'income': rng.integers(0, 250000, n).astype(float),
+                       'province': rng.choice(['ON', 'qc', 'AB'], n),
+                       'year': rng.choice(years, n)})
+    df.loc[5, 'province'] = 'XX'
+    df.loc[9, 'income'] = -1
+    input_file, output_file = str(tmp_path / 'combos.csv'), str(tmp_path / 'result.csv')
+    df.to_csv(input_file, index=False)
+    shard_dir = str(tmp_path / 'shards')
+
+    manifest = shards.make_shards(input_file, shard_dir, rows_per_range=20)
+    assert manifest['ranges'] == [20, 20, 10]
+    assert sum(shard['rows'] for shard in manifest['shards']) == n
+    assert shards.make_shards(input_file, shard_dir, rows_per_range=20) == manifest
+    ids = [shard['id'] for shard in manifest['shards']]
+
+        # A worker that died long ago and one that is still working
+    assert shards.claim(shard_dir, ids[0], lease=60)
+    old = time.time() - 3600
+    os.utime(os.path.join(shard_dir, 'claims', ids[0]), (old, old))
+    assert shards.claim(shard_dir, ids[1], lease=60)
+    assert not shards.claim(shard_dir, ids[1], lease=60)
+    assert shards.progress(shard_dir) == {'shards': len(ids), 'done': 0, 'claimed': 2,
+                                          'waiting': len(ids) - 2}
+
+    assert shards.run_worker(shard_dir, lease=60) == len(ids) - 1
+    assert shards.progress(shard_dir)['claimed'] == 1
+    with pytest.raises(CustomException):
+        shards.merge_shards(shard_dir, output_file)
+
+        # The live worker is given up on too
+    assert shards.run_worker(shard_dir, lease=0) == 1
+    summary = shards.merge_shards(shard_dir, output_file)
+
+    expected, expected_summary = after_tax_combo_bulk(df)
+    result = pd.read_csv(output_file)
+    assert summary == expected_summary
+    assert result['error_code'].tolist() == expected['error_code'].tolist()
+    assert np.array_equal(result['after_tax'], expected['after_tax'], equal_nan=True)
+    assert result['province'].tolist() == df['province'].tolist()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# To work with arrays
+import numpy as np
+import pytest
+
+from util import *
+import tax_calculator
+from vector_calc import after_tax_vec
+
+##########################################################
+# before_tax_vec against before_tax (one net income at a time) over the regions of
+# before_tax up to $500000 (zero, below the bpa, the low and high polynomials), for every
+# province of the years that have polynomials. Above $500000 both use
+# gross_for_high_net_arr, whose scalar version (like the other scalar functions of
+# before_tax) must give the results of the array version (NaN where a table has no
+# value, like both). after_tax (on the tables of read_tables) against after_tax_vec. The
+# provincial credit leaves no tax (not the tax before the credit) when it is greater.
+
+years = [year for year in available_years() if read_polys(year) is not None]
+pytestmark = pytest.mark.skipif(len(years) == 0, reason="No polynomials in ../data")
+
+net_incs = np.concatenate((np.linspace(0, 495000, 100), [-5, 199999.5, 200000, 499999.5]))
+
+
+@pytest.mark.parametrize('year', years)
+@pytest.mark.parametrize('prov', provinces)
+def test_before_tax_vec_matches_before_tax(year, prov, capsys):
+    expected = np.array(tax_calculator.before_tax(net_incs, prov, year), dtype=float)
+    assert np.array_equal(tax_calculator.before_tax_vec(net_incs, prov, year), expected)
+
+
+def test_scalar_functions_match_array_functions():
+    tables = read_tables(years[0])
+    Federal_df = tables['Federal']
+    for prov in provinces:
+        prov_df = tables[prov]
+        incs = np.linspace(1, 800000, 41)
+        assert np.array_equal([tax_calculator.gross_for_low_net(inc, Federal_df, prov_df)
+                               for inc in incs],
+                              tax_calculator.gross_for_low_net_arr(incs, Federal_df, prov_df),
+                              equal_nan=True)
+        assert np.array_equal([tax_calculator.gross_for_high_net(inc, Federal_df, prov_df)
+                               for inc in incs],
+                              tax_calculator.gross_for_high_net_arr(incs, Federal_df, prov_df),
+                              equal_nan=True)
+        assert np.array_equal([tax_calculator.tune_bpa(inc, Federal_df) for inc in incs],
+                              tax_calculator.tune_bpa_arr(incs, Federal_df), equal_nan=True)
+
+
+@pytest.mark.parametrize('prov', provinces)
+def test_after_tax_reads_the_tables_of_read_tables(prov):
+    gross_incs = np.linspace(0, 400000, 41)
+    assert np.array_equal(tax_calculator.after_tax(gross_incs, prov, years[0]),
+                          after_tax_vec(gross_incs, prov, years[0]))
+
+
+@pytest.mark.parametrize('prov', ['ON', 'BC', 'AB'])
+def test_prov_credit_greater_than_the_tax_leaves_no_tax(prov):
+    tables = read_tables(years[0])
+    Federal_df, prov_df = tables['Federal'], tables[prov]
+    cpp_rate, cpp_be = Federal_df['CPP_rate'][0], Federal_df['CPP_be'][0]
+    cpp_max = (Federal_df['CPP_max_pensionable'][0] - cpp_be) * cpp_rate / 100
+    ei_rate = Federal_df['EI_rate'][0]
+    ei_max = Federal_df['EI_max_contribution'][0] * ei_rate / 100
+
+        # Just above the bpa the credit (of the bpa, CPP and EI) is greater than the tax
+    prov_taxes = []
+    for inc in prov_df['bpa'][0] + np.linspace(1, 10000, 200):
+        cpp = tax_calculator.get_cpp(inc, cpp_rate, cpp_max, cpp_be)
+        ei = tax_calculator.get_ei(inc, ei_rate, ei_max)
+        prov_taxes.append(tax_calculator.get_prov_tax(inc, Federal_df, prov_df, cpp, ei)[0])
+    prov_taxes = np.array(prov_taxes)
+    assert prov_taxes[0] == 0
+    assert (np.diff(prov_taxes) >= 0).all()
+    assert prov_taxes[-1] > 0
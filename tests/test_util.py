@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import pytest
+
+from util import *
+import vector_calc
+
+##########################################################
+# The counts of levels (only the tables of read_tables are counted once, a copy or a
+# slice of one is counted again), the caches emptied when the tables are read again and
+# the tables being read-only.
+
+years = available_years()
+pytestmark = pytest.mark.skipif(len(years) == 0, reason="No tax rate tables in ../data")
+
+
+def test_levels_of_derived_tables():
+    df = read_tables(years[0])['Federal']
+    assert levels(df) is levels(df)
+    assert levels(df.copy()) == levels(df)
+    assert levels(df.head(1))['Threshold'] == 1
+
+
+def test_refresh_clears_schedules():
+    vector_calc.load_schedule('ON', years[0])
+    assert len(vector_calc.schedules) > 0
+    read_tables(years[0], refresh=True)
+    assert len(vector_calc.schedules) == 0
+
+
+def test_tables_are_read_only():
+    df = read_tables(years[0])['ON']
+    with pytest.raises(ValueError):
+        df.loc[0, 'Rate'] = 10
+    with pytest.raises(ValueError):
+        df.iloc[0, list(df.columns).index('Threshold')] = 0
+    edited = df.copy()
+    edited.loc[0, 'Rate'] = 10
+    assert edited.loc[0, 'Rate'] == 10 and df.loc[0, 'Rate'] != 10